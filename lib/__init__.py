@@ -1,7 +1,13 @@
 from . import common
 from . import googleapi
+from . import googlefake
 from . import bugzilla
 from . import parallel
 from . import remotemachine
 from . import argconfig
 from . import kernel
+from . import datacache
+from . import testindex
+from . import timelinepool
+from . import fleet
+from . import ingest
@@ -20,6 +20,7 @@
 #    API for interfacing with a bugzilla account and reading and submitting
 #    issue definitions for stress testing.
 
+import os
 import sys
 import base64
 import time
@@ -28,11 +29,15 @@ import json
 import requests
 import configparser
 import pickle
+import threading
+import os.path as op
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 try:
 	from urllib import urlencode
+	from urlparse import urlparse
 except ImportError:
-	from urllib.parse import urlencode
+	from urllib.parse import urlencode, urlparse
 
 def webrequest(url, retry=0):
 	try:
@@ -48,7 +53,63 @@ def webrequest(url, retry=0):
 		return webrequest(url, retry+1)
 	return res.json()
 
-def getissues(urlprefix, depissue):
+class ResponseCache:
+	# bug attachment responses stored on disk by bug id and last change
+	# time, so unchanged bugs are never downloaded twice
+	def __init__(self, urlprefix, folder=''):
+		self.folder = ''
+		self.hits = self.misses = 0
+		if not folder:
+			home = os.getenv('HOME')
+			if not home:
+				return
+			folder = op.join(home, '.bugzillacache')
+		host = urlparse(urlprefix).netloc or 'local'
+		folder = op.join(folder, re.sub('[^a-zA-Z0-9\.\-]', '_', host))
+		try:
+			os.makedirs(folder, exist_ok=True)
+		except:
+			return
+		if os.access(folder, os.W_OK):
+			self.folder = folder
+	def file(self, id):
+		return op.join(self.folder, '%s.json' % id)
+	def get(self, id, changed):
+		if not self.folder or not changed:
+			return None
+		try:
+			with open(self.file(id), 'r') as fp:
+				data = json.load(fp)
+		except:
+			return None
+		if data.get('last_change_time') != changed:
+			return None
+		return data.get('response')
+	def put(self, id, changed, response):
+		if not self.folder or not changed:
+			return
+		tmp = '%s.%d.%d' % (self.file(id), os.getpid(), threading.get_ident())
+		try:
+			with open(tmp, 'w') as fp:
+				json.dump({'last_change_time': changed, 'response': response}, fp)
+			os.rename(tmp, self.file(id))
+		except:
+			if op.exists(tmp):
+				os.remove(tmp)
+
+def getattachments(urlprefix, bug, cache):
+	id = '%d' % bug['id']
+	changed = bug.get('last_change_time', '')
+	res = cache.get(id, changed)
+	if res is not None:
+		cache.hits += 1
+		return res
+	cache.misses += 1
+	res = webrequest('%s/bug/%s/attachment' % (urlprefix, id))
+	cache.put(id, changed, res)
+	return res
+
+def getissues(urlprefix, depissue, cachedir='', threads=8):
 	out = dict()
 	params = {
 #		'bug_status'	: ['NEW','ASSIGNED','REOPENED','VERIFIED','NEEDINFO','CLOSED'],
@@ -61,10 +122,13 @@ def getissues(urlprefix, depissue):
 		return out
 	bugs = res['bugs']
 	showurl = urlprefix.replace('rest', 'show_bug') + '?id={0}'
-	for bug in bugs:
+	# the attachments are pulled concurrently, cached ones are not refetched
+	cache = ResponseCache(urlprefix, cachedir)
+	with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+		results = pool.map(lambda b:getattachments(urlprefix, b, cache), bugs)
+		attachments = list(results)
+	for bug, res in zip(bugs, attachments):
 		id = '%d' % bug['id']
-		url = '%s/bug/%s/attachment' % (urlprefix, id)
-		res = webrequest(url)
 		if 'bugs' not in res or id not in res['bugs']:
 			continue
 		idef = ''
@@ -107,40 +171,32 @@ def regexmatch(mstr, line):
 		return True
 	return False
 
-def device_title_match(dev, namestr, devstr, drvstr):
-	# get driver string if found
+class Regex:
+	# a match string from an issue.def compiled once, same semantics
+	# as regexmatch: substring or regex match from the start
+	def __init__(self, mstr):
+		self.mstr = mstr
+		try:
+			self.re = re.compile(mstr)
+		except:
+			self.re = None
+	def match(self, line):
+		if self.mstr in line:
+			return True
+		return True if self.re and self.re.match(line) else False
+
+def deviceTitle(dev):
+	# split a device title into name, device id, and driver
 	name, devid, drv = '', dev, ''
 	if ' {' in dev:
 		m = re.match('^(?P<x>.*) \{(?P<y>\S*)\}.*', dev)
 		if m:
 			devid, drv = m.groups()
-	# get device id if found
 	if ' [' in devid:
 		m = re.match('^(?P<x>.*) \[(?P<y>\S*)\]$', devid)
 		if m:
 			name, devid = m.groups()
-	if drvstr:
-		if not drv or not regexmatch(drvstr, drv):
-			return False
-	if namestr:
-		if not name or not regexmatch(namestr, name):
-			return False
-	if devstr:
-		if not devid or not regexmatch(devstr, devid):
-			return False
-	return True
-
-def check_issue(host, vals, issues, testruns, bugdata):
-	matches = []
-	for val in vals:
-		for issue in issues:
-			if host in issue['urls'] and regexmatch(val, issue['line']):
-				for test in issue['urls'][host]:
-					if test not in matches:
-						matches.append(test)
-	if len(matches) > 0:
-		bugdata['found'] = matches[0]
-		bugdata['count'] = len(matches)
+	return (name, devid, drv)
 
 def getComparison(mstr):
 	greater = True
@@ -158,76 +214,6 @@ def getComparison(mstr):
 		return ('', -1, greater)
 	return (name, target, greater)
 
-def check_call_time(mstrs, testruns, bugdata):
-	checks = []
-	# gather items needed for match checks
-	for mstr in mstrs:
-		callstr, target, greater = getComparison(mstr)
-		if not callstr or target < 0:
-				continue
-		name, args, tm = functionInfo(callstr)
-		checks.append((name, args, target, greater))
-	match = {'count':0,'worst':0,'url':''}
-	for data in testruns:
-		found = False
-		for name, args, target, greater in checks:
-			for f in data['funclist']:
-				n, a, t = functionInfo(f)
-				if not regexmatch(name, n):
-					continue
-				argmatch = True
-				for arg in args:
-					if arg not in a or not regexmatch(args[arg], a[arg]):
-						argmatch = False
-				if not argmatch or t < 0:
-					continue
-				# match found
-				if (greater and t > target) or (not greater and t < target):
-					if not match['url'] or \
-						(greater and t > match['worst']) or \
-						(not greater and t < match['worst']):
-						# worst case found
-						match['worst'] = t
-						match['url'] = data['url']
-					found = True
-		if found:
-			match['count'] += 1
-	bugdata['found'] = match['url']
-	bugdata['count'] = match['count']
-
-def check_device_time(mstrs, testruns, bugdata):
-	checks = []
-	# gather items needed for match checks
-	for phase, mstr in mstrs:
-		devstr, target, greater = getComparison(mstr)
-		if not devstr or target < 0:
-			continue
-		name, devid, drv = deviceInfo(devstr)
-		checks.append((phase, name, devid, drv, target, greater))
-	match = {'count':0,'worst':0,'url':''}
-	for data in testruns:
-		found = False
-		for phase, name, devid, drv, target, greater in checks:
-			if phase not in data['devlist']:
-				continue
-			for dev in data['devlist'][phase]:
-				if not device_title_match(dev, name, devid, drv):
-					continue
-				val = data['devlist'][phase][dev]
-				if (greater and val > target) or (not greater and val < target):
-					# match found
-					if not match['url'] or \
-						(greater and val > match['worst']) or \
-						(not greater and val < match['worst']):
-						# worst case found
-						match['worst'] = val
-						match['url'] = data['url']
-					found = True
-		if found:
-			match['count'] += 1
-	bugdata['found'] = match['url']
-	bugdata['count'] = match['count']
-
 def functionInfo(text):
 	# function time is at the end
 	tm = -1
@@ -248,21 +234,6 @@ def functionInfo(text):
 			args[atmp[0].strip()] = atmp[-1].strip()
 	return (name, args, tm)
 
-def find_function(mstr, testruns):
-	name, args, tm = functionInfo(mstr)
-	for data in testruns:
-		for f in data['funclist']:
-			n, a, t = functionInfo(f)
-			if not regexmatch(name, n):
-				continue
-			argmatch = True
-			for arg in args:
-				if arg not in a or not regexmatch(args[arg], a[arg]):
-					argmatch = False
-			if argmatch:
-				return True
-	return False
-
 def deviceInfo(text):
 	name = devid = drv = ''
 	for val in text.split(','):
@@ -277,51 +248,216 @@ def deviceInfo(text):
 			devid = val
 	return (name, devid, drv)
 
-def find_device(mstr, testruns):
-	name, devid, drv = deviceInfo(mstr)
-	for data in testruns[:10]:
-		for phase in data['devlist']:
-			for dev in data['devlist'][phase]:
-				if device_title_match(dev, name, devid, drv):
+class FunctionMatch:
+	def __init__(self, mstr):
+		name, args, tm = functionInfo(mstr)
+		self.name = Regex(name)
+		self.args = [(a, Regex(args[a])) for a in args]
+	def argmatch(self, args):
+		for arg, rx in self.args:
+			if arg not in args or not rx.match(args[arg]):
+				return False
+		return True
+
+class DeviceMatch:
+	def __init__(self, mstr):
+		name, devid, drv = deviceInfo(mstr)
+		self.name = Regex(name) if name else None
+		self.devid = Regex(devid) if devid else None
+		self.drv = Regex(drv) if drv else None
+	def match(self, title):
+		name, devid, drv = title
+		if self.drv and (not drv or not self.drv.match(drv)):
+			return False
+		if self.name and (not name or not self.name.match(name)):
+			return False
+		if self.devid and (not devid or not self.devid.match(devid)):
+			return False
+		return True
+
+class TestrunIndex:
+	# per-multitest lookup tables built once and shared by all the bugs:
+	# functions by name and devices by phase and title
+	def __init__(self, testruns, host='', issues=[]):
+		self.testruns = testruns
+		self.funcs = dict()
+		self.devs = dict()
+		self.titles = dict()
+		self.reqdevs = set()
+		self.issues = []
+		for i in range(len(testruns)):
+			data = testruns[i]
+			for f in data['funclist']:
+				n, a, t = functionInfo(f)
+				if n not in self.funcs:
+					self.funcs[n] = []
+				self.funcs[n].append((i, a, t))
+			for phase in data['devlist']:
+				if phase not in self.devs:
+					self.devs[phase] = dict()
+				for dev in data['devlist'][phase]:
+					if dev not in self.titles:
+						self.titles[dev] = deviceTitle(dev)
+					if dev not in self.devs[phase]:
+						self.devs[phase][dev] = []
+					self.devs[phase][dev].append((i, data['devlist'][phase][dev]))
+					# device requirements only look at the first 10 tests
+					if i < 10:
+						self.reqdevs.add(dev)
+		for issue in issues:
+			if host in issue['urls']:
+				self.issues.append((issue['line'], issue['urls'][host]))
+	def functions(self, fm):
+		# every (test index, args, time) whose name and args match
+		out = []
+		for n in self.funcs:
+			if not fm.name.match(n):
+				continue
+			for i, a, t in self.funcs[n]:
+				if fm.argmatch(a):
+					out.append((i, t))
+		return out
+	def devices(self, phase, dm):
+		out = []
+		if phase not in self.devs:
+			return out
+		for dev in self.devs[phase]:
+			if dm.match(self.titles[dev]):
+				out += self.devs[phase][dev]
+		return out
+	def hasfunction(self, fm):
+		for n in self.funcs:
+			if not fm.name.match(n):
+				continue
+			for i, a, t in self.funcs[n]:
+				if fm.argmatch(a):
 					return True
-	return False
+		return False
+	def hasdevice(self, dm):
+		for dev in self.reqdevs:
+			if dm.match(self.titles[dev]):
+				return True
+		return False
+	def worstcase(self, values, bugdata):
+		# values is a list of (test index, value, greater) that exceeded the
+		# target, the earliest test with the worst value is the one reported
+		worst, url, tests = 0, '', set()
+		for i, val, greater in sorted(values, key=lambda v:v[0]):
+			if not url or (greater and val > worst) or \
+				(not greater and val < worst):
+				worst, url = val, self.testruns[i]['url']
+			tests.add(i)
+		bugdata['found'] = url
+		bugdata['count'] = len(tests)
 
-def bugzilla_check(buglist, desc, testruns, issues):
-	out = []
-	for id in buglist:
-		if not buglist[id]['def']:
-			continue
-		# check each bug to see if it is applicable and exists
-		applicable = True
-		# parse the config file which describes the issue
+class IssueMatcher:
+	# an issue.def parsed and compiled once per buglist entry
+	def __init__(self, idef):
+		self.valid = False
+		self.reqs, self.checkI, self.checkD, self.checkC = [], [], [], []
 		config = configparser.ConfigParser()
-		if isinstance(buglist[id]['def'], str):
-			data = buglist[id]['def']
-		else:
-			data = buglist[id]['def'].decode()
-		config.readfp(StringIO(data))
-		sections = config.sections()
+		data = idef if isinstance(idef, str) else idef.decode()
+		config.read_string(data)
 		req = idesc = ''
-		for key in sections:
+		for key in config.sections():
 			if key.lower() == 'requirements':
 				req = key
 			elif key.lower() == 'description':
 				idesc = key
-		# verify that this system & multitest meets the requirements
 		if req:
 			for key in config.options(req):
 				val = config.get(req, key)
-				if key.lower() == 'mode':
-					applicable = (desc['mode'] in val)
-				elif key.lower() == 'device':
-					applicable = find_device(val, testruns)
+				if key.lower() == 'device':
+					self.reqs.append(('device', DeviceMatch(val)))
 				elif key.lower() == 'call':
-					applicable = find_function(val, testruns)
+					self.reqs.append(('call', FunctionMatch(val)))
+				elif key.lower() == 'mode':
+					self.reqs.append(('mode', val))
 				else:
-					applicable = (val.lower() in desc['sysinfo'].lower())
-				if not applicable:
-					break
-		if not applicable or not idesc:
+					self.reqs.append(('sysinfo', val.lower()))
+		if not idesc:
+			return
+		self.valid = True
+		for key in config.options(idesc):
+			val = config.get(idesc, key)
+			if key.lower().startswith('dmesgregex'):
+				self.checkI.append(Regex(val))
+			elif key.lower() in ['devicesuspend', 'deviceresume']:
+				devstr, target, greater = getComparison(val)
+				if devstr and target >= 0:
+					self.checkD.append((key[6:].lower(), DeviceMatch(devstr),
+						target, greater))
+			elif key.lower() == 'calltime':
+				callstr, target, greater = getComparison(val)
+				if callstr and target >= 0:
+					self.checkC.append((FunctionMatch(callstr), target, greater))
+	def applicable(self, desc, index):
+		sysinfo = ''
+		for type, val in self.reqs:
+			if type == 'mode':
+				ok = (desc['mode'] in val)
+			elif type == 'device':
+				ok = index.hasdevice(val)
+			elif type == 'call':
+				ok = index.hasfunction(val)
+			else:
+				if not sysinfo:
+					sysinfo = desc['sysinfo'].lower()
+				ok = (val in sysinfo)
+			if not ok:
+				return False
+		return self.valid
+	def check_issue(self, index, bugdata):
+		matches = []
+		for rx in self.checkI:
+			for line, tests in index.issues:
+				if not rx.match(line):
+					continue
+				for test in tests:
+					if test not in matches:
+						matches.append(test)
+		if len(matches) > 0:
+			bugdata['found'] = matches[0]
+			bugdata['count'] = len(matches)
+	def check_device_time(self, index, bugdata):
+		values = []
+		for phase, dm, target, greater in self.checkD:
+			for i, val in index.devices(phase, dm):
+				if (greater and val > target) or (not greater and val < target):
+					values.append((i, val, greater))
+		index.worstcase(values, bugdata)
+	def check_call_time(self, index, bugdata):
+		values = []
+		for fm, target, greater in self.checkC:
+			for i, t in index.functions(fm):
+				if t < 0:
+					continue
+				if (greater and t > target) or (not greater and t < target):
+					values.append((i, t, greater))
+		index.worstcase(values, bugdata)
+
+# compiled issue matchers, keyed by bug id and reused while the def is unchanged
+matchers = dict()
+
+def issue_matcher(id, idef):
+	if id in matchers and matchers[id][0] == idef:
+		return matchers[id][1]
+	matchers[id] = (idef, IssueMatcher(idef))
+	return matchers[id][1]
+
+def bugzilla_check(buglist, desc, testruns, issues):
+	out = []
+	index = None
+	for id in buglist:
+		if not buglist[id]['def']:
+			continue
+		im = issue_matcher(id, buglist[id]['def'])
+		if not im.valid:
+			continue
+		if not index:
+			index = TestrunIndex(testruns, desc['host'], issues)
+		# verify that this system & multitest meets the requirements
+		if not im.applicable(desc, index):
 			continue
 		# check for the existence of the issue in the data
 		bugdata = {
@@ -331,21 +467,12 @@ def bugzilla_check(buglist, desc, testruns, issues):
 			'count': 0,
 			'found': '',
 		}
-		checkI, checkD, checkC = [], [], []
-		for key in config.options(idesc):
-			val = config.get(idesc, key)
-			if key.lower().startswith('dmesgregex'):
-				checkI.append(val)
-			elif key.lower() in ['devicesuspend', 'deviceresume']:
-				checkD.append((key[6:].lower(), val))
-			elif key.lower() == 'calltime':
-				checkC.append(val)
-		if not bugdata['found'] and len(checkI) > 0:
-			check_issue(desc['host'], checkI, issues, testruns, bugdata)
-		if not bugdata['found'] and len(checkD) > 0:
-			check_device_time(checkD, testruns, bugdata)
-		if not bugdata['found'] and len(checkC) > 0:
-			check_call_time(checkC, testruns, bugdata)
+		if not bugdata['found'] and len(im.checkI) > 0:
+			im.check_issue(index, bugdata)
+		if not bugdata['found'] and len(im.checkD) > 0:
+			im.check_device_time(index, bugdata)
+		if not bugdata['found'] and len(im.checkC) > 0:
+			im.check_call_time(index, bugdata)
 		out.append(bugdata)
 	return out
 
@@ -387,8 +514,9 @@ def html_table(testruns, bugs, desc):
 
 	return html+'</table>\n'
 
-def pm_stress_test_issues():
-	return getissues('http://bugzilla.kernel.org/rest.cgi', '178231')
+def pm_stress_test_issues(urlprefix='http://bugzilla.kernel.org/rest.cgi',
+	depissue='178231', cachedir='', threads=8):
+	return getissues(urlprefix, depissue, cachedir, threads)
 
 def pickle_file_test_issues(bugfile):
 	try:
@@ -434,7 +562,7 @@ def regex_test(issuedef, logfile):
 
 if __name__ == '__main__':
 
-	import argparse, os
+	import argparse
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-l', '-list', action='store_true',
 		help='list bugs and show issue.def contents')
@@ -446,6 +574,15 @@ if __name__ == '__main__':
 		help='verify an issue.def file is formatted correctly')
 	parser.add_argument('-regextest', nargs=2, metavar=('issuedef', 'log'),
 		help='search a dmesg log for matches with an issue.def file')
+	parser.add_argument('-url', metavar='urlprefix',
+		default='http://bugzilla.kernel.org/rest.cgi',
+		help='bugzilla rest url (default: bugzilla.kernel.org)')
+	parser.add_argument('-blocks', metavar='id', default='178231',
+		help='tracker bug which blocks all the issues (default: 178231)')
+	parser.add_argument('-cachedir', metavar='folder', default='',
+		help='attachment response cache (default: ~/.bugzillacache)')
+	parser.add_argument('-threads', metavar='count', type=int, default=8,
+		help='number of concurrent attachment requests (default: 8)')
 	args = parser.parse_args()
 
 	if args.configtest:
@@ -479,7 +616,8 @@ if __name__ == '__main__':
 		sys.exit(1)
 
 	print('Collecting remote bugs and issue.def files from bugzilla(s)...')
-	bugs = pm_stress_test_issues()
+	bugs = pm_stress_test_issues(args.url, args.blocks, args.cachedir,
+		args.threads)
 	print('%d BUGS FOUND' % len(bugs))
 
 	if args.p:
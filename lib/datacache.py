@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# DataCache library
+# Copyright (c) 2020, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Authors:
+#    Todd Brandt <todd.e.brandt@linux.intel.com>
+#
+# Description:
+#    Transactional store for the multitest summary data cache. Each
+#    multitest is a single row keyed by its absolute path, so updates are
+#    per-multitest upserts instead of a full rewrite of the cache file.
+
+import os
+import sys
+import sqlite3
+import os.path as op
+
+keylist = ['datetime', 'rc', 'kernel', 'fullmode', 'host', 'machine',
+	'target', 'count', 'pass', 'testtime', 'smax', 'smed', 'smin',
+	'rmax', 'rmed', 'rmin', 's0ix', 'gid', 'pc10', 'wifi',
+	'biosdate', 'wifidrv']
+indexlist = ['kernel', 'host', 'fullmode', 'rc']
+
+def defaultpaths():
+	home = os.getenv('HOME')
+	if not home:
+		return ('', '')
+	return (op.join(home, '.multitestdata.db'), op.join(home, '.multitestdata'))
+
+class DataCache:
+	timeout = 300
+	def __init__(self, file, textfile=''):
+		self.file = file
+		create = not op.exists(file)
+		self.db = sqlite3.connect(file, timeout=self.timeout,
+			isolation_level=None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		cols = ', '.join(['"%s" TEXT' % k for k in keylist])
+		self.db.execute('CREATE TABLE IF NOT EXISTS multitests '\
+			'(path TEXT PRIMARY KEY, %s)' % cols)
+		for key in indexlist:
+			self.db.execute('CREATE INDEX IF NOT EXISTS idx_%s '\
+				'ON multitests ("%s")' % (key, key))
+		if create:
+			try:
+				os.chmod(file, 0o664)
+			except:
+				pass
+			if textfile and op.exists(textfile):
+				self.importtext(textfile)
+	def close(self):
+		if self.db:
+			self.db.close()
+			self.db = None
+	def row(self, path, info):
+		out = [path]
+		for key in keylist:
+			out.append(str(info[key]) if key in info else '')
+		return out
+	def upsert(self, entries):
+		# entries is a dict of multitest path -> info dict
+		if len(entries) < 1:
+			return 0
+		cols = ', '.join(['"%s"' % k for k in keylist])
+		vals = ', '.join(['?' for k in range(len(keylist) + 1)])
+		upd = ', '.join(['"%s"=excluded."%s"' % (k, k) for k in keylist])
+		sql = 'INSERT INTO multitests (path, %s) VALUES (%s) '\
+			'ON CONFLICT(path) DO UPDATE SET %s' % (cols, vals, upd)
+		rows = [self.row(p, entries[p]) for p in sorted(entries)]
+		self.db.execute('BEGIN IMMEDIATE')
+		try:
+			self.db.executemany(sql, rows)
+		except:
+			self.db.execute('ROLLBACK')
+			raise
+		self.db.execute('COMMIT')
+		return len(rows)
+	def remove(self, paths):
+		self.db.execute('BEGIN IMMEDIATE')
+		self.db.executemany('DELETE FROM multitests WHERE path = ?',
+			[(p,) for p in paths])
+		self.db.execute('COMMIT')
+	def parseline(self, line):
+		val = line.strip().split('|')
+		if len(val) < 2 or not val[0].strip():
+			return ('', None)
+		info = dict()
+		for i in range(len(keylist)):
+			info[keylist[i]] = val[i+1] if i+1 < len(val) else ''
+		return (val[0].strip(), info)
+	def importtext(self, file):
+		entries = dict()
+		with open(file, 'r') as fp:
+			for line in fp:
+				path, info = self.parseline(line)
+				if path:
+					entries[path] = info
+		return self.upsert(entries)
+	def exporttext(self, fp):
+		for row in self.select():
+			fp.write('%s\n' % '|'.join([row['path']] + [row[k] for k in keylist]))
+	def select(self, where=None, order='path'):
+		sql, args = 'SELECT * FROM multitests', []
+		if where:
+			cond = []
+			for key in sorted(where):
+				if key != 'path' and key not in keylist:
+					continue
+				vals = where[key] if isinstance(where[key], list) else [where[key]]
+				cond.append('"%s" IN (%s)' % (key, ','.join(['?' for v in vals])))
+				args += vals
+			if len(cond) > 0:
+				sql += ' WHERE ' + ' AND '.join(cond)
+		if order:
+			sql += ' ORDER BY "%s"' % order
+		cur = self.db.execute(sql, args)
+		names = [d[0] for d in cur.description]
+		for row in cur:
+			yield dict(zip(names, row))
+	def kernels(self, kernels):
+		return self.select({'kernel': kernels}, 'datetime')
+	def paths(self):
+		return [r[0] for r in self.db.execute('SELECT path FROM multitests')]
+	def gids(self):
+		out = dict()
+		for r in self.db.execute('SELECT gid FROM multitests WHERE gid != ""'):
+			out[r[0]] = 1
+		return out
+
+def opencache(file='', textfile=None):
+	dbfile, txtfile = defaultpaths()
+	file = file if file else dbfile
+	textfile = txtfile if textfile is None else textfile
+	if not file:
+		return None
+	dir = op.dirname(op.abspath(file))
+	if not os.access(dir, os.W_OK) or \
+		(op.exists(file) and not os.access(file, os.W_OK)):
+		return None
+	return DataCache(file, textfile)
+
+# ----------------- MAIN --------------------
+# exec start (skipped if script is loaded as library)
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-db', metavar='file', default='',
+		help='sqlite data cache (default: ~/.multitestdata.db)')
+	parser.add_argument('-import', metavar='file', dest='importfile',
+		help='import a pipe-delimited multitestdata file into the cache')
+	parser.add_argument('-export', action='store_true',
+		help='print the cache in the old pipe-delimited format')
+	parser.add_argument('-kernel', metavar='name', action='append',
+		help='list the entries for a kernel (can be used multiple times)')
+	args = parser.parse_args()
+
+	cache = opencache(args.db)
+	if not cache:
+		print('ERROR: data cache is not writable')
+		sys.exit(1)
+	if args.importfile:
+		if not op.exists(args.importfile):
+			print('ERROR: %s does not exist' % args.importfile)
+			sys.exit(1)
+		print('%d entries imported' % cache.importtext(args.importfile))
+	if args.export:
+		cache.exporttext(sys.stdout)
+	if args.kernel:
+		for row in cache.kernels(args.kernel):
+			print('|'.join([row['path']] + [row[k] for k in keylist]))
+	cache.close()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Fleet library
+# Copyright (c) 2020, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Authors:
+#    Todd Brandt <todd.e.brandt@linux.intel.com>
+#
+# Description:
+#    Runs the same operation across a list of RemoteMachines concurrently
+#    from a single asyncio loop, with a per-host timeout and a cap on the
+#    number of hosts in flight. The ssh backend can be swapped for a fake
+#    one so sweeps can be run and timed without any lab machines.
+
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE, STDOUT, DEVNULL
+
+class SSHBackend:
+	sshargs = ['-oBatchMode=yes', '-oStrictHostKeyChecking=no',
+		'-oConnectTimeout=10']
+	async def execute(self, args, timeout):
+		proc = await asyncio.create_subprocess_exec(*args,
+			stdin=DEVNULL, stdout=PIPE, stderr=STDOUT)
+		try:
+			out, err = await asyncio.wait_for(proc.communicate(), timeout)
+		except asyncio.TimeoutError:
+			proc.kill()
+			await proc.wait()
+			return (-1, '')
+		except asyncio.CancelledError:
+			proc.kill()
+			raise
+		return (proc.returncode, out.decode('utf-8', 'ignore'))
+	async def ping(self, m, wait=5):
+		rc, out = await self.execute(['ping', '-q', '-c', '1', '-W',
+			'%d' % wait, m.addr], wait + 5)
+		return rc == 0
+	async def ssh(self, m, cmd, timeout=60):
+		args = ['ssh'] + self.sshargs + ['%s@%s' % (m.user, m.addr), cmd]
+		rc, out = await self.execute(args, timeout)
+		if rc < 0:
+			return 'SSH TIMEOUT: %s' % cmd
+		return out
+	async def local(self, cmd, timeout=60):
+		rc, out = await self.execute(['sh', '-c', cmd], timeout)
+		return rc == 0
+
+class FakeSSH:
+	# stand-in for SSHBackend, every host is up and running kernel with
+	# the given latency per call unless it's listed in down or hang
+	def __init__(self, kernel='', latency=0, down=[], hang=[], hosts=dict()):
+		self.kernel = kernel
+		self.latency = latency
+		self.down = set(down)
+		self.hang = set(hang)
+		self.hosts = hosts
+		self.calls = self.active = self.peak = 0
+	async def call(self, delay):
+		self.calls += 1
+		self.active += 1
+		self.peak = max(self.peak, self.active)
+		try:
+			await asyncio.sleep(delay)
+		finally:
+			self.active -= 1
+	async def ping(self, m, wait=5):
+		await self.call(wait if m.host in self.down else self.latency)
+		return m.host not in self.down
+	async def ssh(self, m, cmd, timeout=60):
+		if m.host in self.hang:
+			await self.call(3600)
+		if m.host in self.down:
+			await self.call(timeout)
+			return 'SSH TIMEOUT: %s' % cmd
+		await self.call(self.latency)
+		if cmd == 'hostname':
+			return '%s\n' % self.hosts.get(m.host, m.host)
+		if cmd == 'cat /proc/version':
+			return 'Linux version %s (fake@fake) #1 SMP\n' % self.kernel
+		return ''
+	async def local(self, cmd, timeout=60):
+		await self.call(0)
+		return True
+
+class Fleet:
+	maxhosts = 32
+	def __init__(self, backend=None, count=0, timeout=300):
+		self.backend = backend if backend else SSHBackend()
+		self.count = count if count > 0 else self.maxhosts
+		self.timeout = timeout
+		# blocking RemoteMachine calls run here, one thread per slot
+		self.pool = ThreadPoolExecutor(max_workers=self.count)
+	async def checkhost(self, m):
+		# non-interactive RemoteMachine.checkhost
+		if not await self.backend.ping(m, 5):
+			return 'offline'
+		for i in range(4):
+			h = (await self.backend.ssh(m, 'hostname', 60)).strip()
+			if 'Permanently added' in h:
+				continue
+			elif 'REMOTE HOST IDENTIFICATION HAS CHANGED' in h:
+				await self.backend.local('ssh-keygen -R "%s"' % m.addr)
+				continue
+			break
+		if m.host != h:
+			if 'refused' in h.lower() or 'denied' in h.lower():
+				return 'ssh permission denied'
+			else:
+				return 'wrong host (actual=%s)' % h
+		return ''
+	async def kernel_version(self, m):
+		for i in range(3):
+			version = (await self.backend.ssh(m, 'cat /proc/version', 120)).strip()
+			if version.startswith('Linux'):
+				return version.split()[2]
+			await asyncio.sleep(1)
+		return version
+	async def online(self, m):
+		return await self.checkhost(m)
+	async def ready(self, m, kernel):
+		res = await self.checkhost(m)
+		if res:
+			return res
+		kver = await self.kernel_version(m)
+		if kernel != kver:
+			return 'wrong kernel (actual=%s)' % kver
+		return ''
+	async def call(self, m, func, *args):
+		# run a blocking RemoteMachine method, e.g. fleet.call(m, m.reboot, kver)
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.pool, func, *args)
+	async def host(self, slots, m, op, args):
+		async with slots:
+			try:
+				return await asyncio.wait_for(op(m, *args), self.timeout)
+			except asyncio.TimeoutError:
+				return 'TIMEOUT'
+	async def gather(self, machines, op, args):
+		slots = asyncio.Semaphore(self.count)
+		res = await asyncio.gather(*[self.host(slots, m, op, args) \
+			for m in machines])
+		return dict(zip([m.host for m in machines], res))
+	def sweep(self, machines, op, *args):
+		# run op(m, *args) on every machine, returns host -> result
+		if len(machines) < 1:
+			return dict()
+		return asyncio.run(self.gather(machines, op, args))
+	def close(self):
+		self.pool.shutdown(wait=False)
+
+# ----------------- MAIN --------------------
+# exec start (skipped if script is loaded as library)
+if __name__ == '__main__':
+	import argparse
+	from lib.remotemachine import RemoteMachine
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-kernel', metavar='version', default='',
+		help='kernel the machines should be running (ready check)')
+	parser.add_argument('-multi', metavar='number', type=int, default=0,
+		help='maximum number of hosts checked at once (default: 32)')
+	parser.add_argument('-timeout', metavar='seconds', type=int, default=300,
+		help='timeout for each host')
+	parser.add_argument('-fake', metavar='number', type=int, default=0,
+		help='sweep this many fake hosts instead of a machine list')
+	parser.add_argument('-latency', metavar='seconds', type=float, default=0.3,
+		help='latency of each fake ssh call')
+	parser.add_argument('machines', metavar='file', nargs='?', default='',
+		help='machine list file (flag host addr user on each line)')
+	args = parser.parse_args()
+
+	machines, backend = [], None
+	if args.fake > 0:
+		for i in range(args.fake):
+			machines.append(RemoteMachine('user', 'host%03d' % i, '10.0.0.%d' % i))
+		backend = FakeSSH(args.kernel, args.latency)
+	elif args.machines:
+		with open(args.machines, 'r') as fp:
+			for line in fp:
+				f = line.split()
+				if line.startswith('#') or len(f) < 3 or len(f) > 4:
+					continue
+				machines.append(RemoteMachine(f[-1], f[-3], f[-2]))
+	else:
+		parser.print_help()
+		sys.exit(1)
+
+	fleet = Fleet(backend, args.multi, args.timeout)
+	start = time.time()
+	if args.kernel:
+		res = fleet.sweep(machines, fleet.ready, args.kernel)
+	else:
+		res = fleet.sweep(machines, fleet.online)
+	for host in sorted(res):
+		print('%30s: %s' % (host, res[host] if res[host] else 'ok'))
+	print('%d hosts checked in %.3fs' % (len(res), time.time() - start))
+	if backend:
+		print('%d fake ssh calls, %d at once' % (backend.calls, backend.peak))
+	fleet.close()
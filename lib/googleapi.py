@@ -22,7 +22,9 @@
 import os
 import sys
 import time
+import json
 import fcntl
+import atexit
 import os.path as op
 from lib.common import pprint
 
@@ -30,28 +32,214 @@ httplib2 = discovery = ofile = oclient = otools = None
 gdrive = 0
 gsheet = 0
 lockfile = '/tmp/googleapi.lock'
+lockfp, lockdepth = None, 0
 gdriveids = dict()
+# gdrive path -> id cache shared by all processes, entries expire after a day
+idcachefile = op.join(os.getenv('HOME'), '.gdriveids') if os.getenv('HOME') else ''
+idcachettl = 86400
+idcacheloaded = False
+idcachepending = dict()
+# token bucket shared by all processes using the same google account,
+# the rate drops by ratebackoff on a quota error (at most once per
+# cooldown) and recovers by a fraction of ratemax every second
+ratefile = '/tmp/googleapi.rate'
+ratemax = 10.0
+ratemin = 0.1
+rateburst = 10.0
+ratebackoff = 0.75
+raterecover = 0.01
+ratecooldown = 2.0
 
 def mutex_lock(wait=1):
-	global lockfile
+	global lockfile, lockfp, lockdepth
+	# the lock is re-entrant within a process
+	if lockdepth > 0:
+		lockdepth += 1
+		return lockfp
 	fp, i, success = None, 0, False
 	while i < wait and not success:
 		success = True
 		try:
-			fp = open(lockfile, 'w')
+			fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+			fp = os.fdopen(fd, 'w')
 			fcntl.flock(fp, fcntl.LOCK_NB | fcntl.LOCK_EX)
 		except:
+			if fp:
+				fp.close()
+				fp = None
 			success = False
 			time.sleep(1)
 		i += 1
 	if not success:
 		print('googleapi could not get a lock')
 		sys.exit(1)
+	try:
+		os.chmod(lockfile, 0o666)
+	except:
+		pass
+	lockfp, lockdepth = fp, 1
 	return fp
 
 def mutex_unlock(fp):
+	global lockfp, lockdepth
+	lockdepth -= 1
+	if lockdepth > 0:
+		return
+	# leave the file in place, removing it would let a waiting process
+	# and a new one both hold the lock
+	lockfp, lockdepth = None, 0
 	fp.close()
-	os.remove(lockfile)
+
+def idcache_read():
+	if not idcachefile or not op.exists(idcachefile):
+		return dict()
+	try:
+		with open(idcachefile, 'r') as fp:
+			data = json.load(fp)
+	except:
+		return dict()
+	return data if isinstance(data, dict) else dict()
+
+def idcache_load():
+	global gdriveids, idcacheloaded
+	if idcacheloaded:
+		return
+	idcacheloaded = True
+	now = time.time()
+	for gpath, val in idcache_read().items():
+		if gpath in gdriveids or not isinstance(val, list) or len(val) != 2:
+			continue
+		if now - val[1] < idcachettl:
+			gdriveids[gpath] = val[0]
+
+def idcache_write(updates, drops=[]):
+	# the cache has its own lock, separate from the api mutex which can be
+	# held for a whole upload. it's only a cache, so if another process
+	# is writing it this write is skipped rather than waited for
+	if not idcachefile or (not updates and not drops):
+		return True
+	if not os.access(op.dirname(idcachefile), os.W_OK) or \
+		(op.exists(idcachefile) and not os.access(idcachefile, os.W_OK)):
+		return True
+	try:
+		lock = open(idcachefile+'.lock', 'w')
+	except:
+		return False
+	try:
+		fcntl.flock(lock, fcntl.LOCK_NB | fcntl.LOCK_EX)
+	except:
+		lock.close()
+		return False
+	data, now = idcache_read(), time.time()
+	for gpath in list(data):
+		if gpath in drops or not isinstance(data[gpath], list) or \
+			len(data[gpath]) != 2 or now - data[gpath][1] >= idcachettl:
+			del data[gpath]
+	for gpath in updates:
+		data[gpath] = [updates[gpath], now]
+	tmp = '%s.%d' % (idcachefile, os.getpid())
+	try:
+		with open(tmp, 'w') as fp:
+			json.dump(data, fp)
+		os.rename(tmp, idcachefile)
+	except:
+		if op.exists(tmp):
+			os.remove(tmp)
+	lock.close()
+	return True
+
+def idcache_set(gpath, id):
+	global gdriveids, idcachepending
+	gdriveids[gpath] = id
+	idcachepending[gpath] = id
+	if len(idcachepending) >= 32:
+		idcache_flush()
+
+def idcache_drop(gpath):
+	global gdriveids, idcachepending
+	# drops are written immediately so no other process uses a stale id
+	if gpath in gdriveids:
+		del gdriveids[gpath]
+	if gpath in idcachepending:
+		del idcachepending[gpath]
+	idcache_write(dict(), [gpath])
+
+def idcache_flush():
+	global idcachepending
+	if len(idcachepending) > 0:
+		updates, idcachepending = idcachepending, dict()
+		if not idcache_write(updates):
+			# try again on the next flush
+			updates.update(idcachepending)
+			idcachepending = updates
+
+atexit.register(idcache_flush)
+
+def ratelimit_update(func):
+	# run func(state, now) on the shared bucket state under its own lock
+	try:
+		fd = os.open(ratefile, os.O_RDWR | os.O_CREAT, 0o666)
+	except:
+		return None
+	fp = os.fdopen(fd, 'r+')
+	try:
+		os.fchmod(fd, 0o666)
+	except:
+		pass
+	fcntl.flock(fp, fcntl.LOCK_EX)
+	try:
+		state = json.loads(fp.read() or '{}')
+	except:
+		state = dict()
+	now = time.time()
+	if not isinstance(state, dict) or 'tokens' not in state:
+		state = {'tokens': rateburst, 'rate': ratemax, 'last': now, 'throttled': 0}
+	# refill the bucket and let the rate creep back up
+	elapsed = max(0, now - state['last'])
+	state['rate'] = min(ratemax, state['rate'] + raterecover * ratemax * elapsed)
+	state['tokens'] = min(rateburst, state['tokens'] + state['rate'] * elapsed)
+	state['last'] = now
+	out = func(state, now)
+	fp.seek(0)
+	fp.truncate()
+	fp.write(json.dumps(state))
+	fp.flush()
+	fcntl.flock(fp, fcntl.LOCK_UN)
+	fp.close()
+	return out
+
+def ratelimit_acquire(count=1):
+	# take the tokens now, going negative reserves a place in line, then
+	# wait until the bucket would have refilled to cover them
+	def take(state, now):
+		state['tokens'] -= count
+		if state['tokens'] >= 0:
+			return 0
+		return -state['tokens'] / state['rate']
+	wait = ratelimit_update(take)
+	if wait:
+		time.sleep(wait)
+	return wait
+
+def ratelimit_throttle():
+	def backoff(state, now):
+		# many callers see the same quota error, only the first one counts
+		if now - state.get('throttled', 0) >= ratecooldown:
+			state['rate'] = max(ratemin, state['rate'] * ratebackoff)
+			state['throttled'] = now
+		# drain the bucket so every caller sits out about a second
+		state['tokens'] = min(state['tokens'], -state['rate'])
+		return state['rate']
+	return ratelimit_update(backoff)
+
+def ratelimited(e):
+	status = getattr(getattr(e, 'resp', None), 'status', 0)
+	if status == 429:
+		return True
+	for msg in ['Rate Limit Exceeded', 'rateLimitExceeded', 'Quota exceeded']:
+		if msg in str(e):
+			return True
+	return False
 
 def getfile(file):
 	dir = os.path.dirname(os.path.realpath(__file__))
@@ -124,6 +312,16 @@ def setupGoogleAPIs():
 		print('Your credentials.json file appears valid, please delete it to re-run setup')
 	return 0
 
+def initFakeGoogleAPIs(latency=0, quota=0):
+	global gsheet, gdrive, idcachefile, ratefile
+	from lib.googlefake import FakeBackend
+	backend = FakeBackend(latency, quota)
+	gdrive, gsheet = backend.services()
+	# fake ids and throttling must never leak into the real account's state
+	idcachefile = ''
+	ratefile = '/tmp/googleapi-fake.rate'
+	return backend
+
 def initGoogleAPIs(force=False):
 	global gsheet, gdrive
 
@@ -131,6 +329,15 @@ def initGoogleAPIs(force=False):
 	if not force and gdrive and gsheet:
 		return
 
+	# GOOGLEAPI_FAKE=<latency>[,<quota>] runs against an in-memory backend
+	if os.getenv('GOOGLEAPI_FAKE') is not None:
+		try:
+			val = [float(v) for v in os.getenv('GOOGLEAPI_FAKE').split(',')]
+		except:
+			val = []
+		initFakeGoogleAPIs(*val[:2])
+		return
+
 	loadGoogleLibraries()
 	SCOPES = 'https://www.googleapis.com/auth/spreadsheets https://www.googleapis.com/auth/drive'
 	cf = getfile('credentials.json')
@@ -148,6 +355,8 @@ def initGoogleAPIs(force=False):
 def google_api_command(cmd, arg1=None, arg2=None, arg3=None, retry=0):
 	global gsheet, gdrive
 
+	if cmd not in ['initdrive', 'initsheet']:
+		ratelimit_acquire()
 	try:
 		if cmd == 'list':
 			ffmt = 'nextPageToken,files({0})'
@@ -173,9 +382,17 @@ def google_api_command(cmd, arg1=None, arg2=None, arg3=None, retry=0):
 		elif cmd == 'delete':
 			return gdrive.files().delete(fileId=arg1).execute()
 		elif cmd == 'move':
-			file = gdrive.files().get(fileId=arg1, fields='parents').execute()
-			oldpar = ','.join(file.get('parents'))
+			# the old parents can be given to save a lookup
+			if arg3:
+				oldpar = arg3
+			else:
+				file = gdrive.files().get(fileId=arg1, fields='parents').execute()
+				oldpar = ','.join(file.get('parents'))
 			return gdrive.files().update(fileId=arg1, addParents=arg2, removeParents=oldpar, fields='id, parents').execute()
+		elif cmd == 'renamemove':
+			# rename and move in one request, arg3 is the current parent
+			return gdrive.files().update(fileId=arg1, body={'name':arg2[0]},
+				addParents=arg2[1], removeParents=arg3, fields='id, parents').execute()
 		elif cmd == 'upload':
 			return gdrive.files().create(body=arg1, media_body=arg2, fields='id').execute()
 		elif cmd == 'createsheet':
@@ -190,21 +407,76 @@ def google_api_command(cmd, arg1=None, arg2=None, arg3=None, retry=0):
 		if retry >= 10:
 			print('ERROR: %s\n' % str(e))
 			sys.exit(1)
-		if 'User Rate Limit Exceeded' in str(e) or 'Quota exceeded' in str(e):
-			p, g = os.getpid(), os.getpgrp()
-			d = (p - g) % 10 if p != g else 1
-			d = 10 if d == 0 else d
-			d += 5
-			print('RETRYING %s: Rate Limit Exceeded (GID %d, PID %d, WAIT %d sec)' % (cmd, g, p, d))
-			time.sleep(d)
+		if ratelimited(e):
+			# the wait happens in the shared bucket on the next acquire
+			rate = ratelimit_throttle()
+			print('RETRYING %s: Rate Limit Exceeded (PID %d, RATE %.2f/sec)' % \
+				(cmd, os.getpid(), rate if rate else 0))
 		else:
 			print('RETRYING %s: %s' % (cmd, str(e)))
 			time.sleep(3)
 		return google_api_command(cmd, arg1, arg2, arg3, retry+1)
 	return False
 
+def drive_request(cmd, arg1=None, arg2=None, arg3=None):
+	if cmd == 'delete':
+		return gdrive.files().delete(fileId=arg1)
+	elif cmd == 'get':
+		return gdrive.files().get(fileId=arg1, fields='parents')
+	elif cmd == 'rename':
+		return gdrive.files().update(fileId=arg1, body={'name':arg2}, fields='name')
+	elif cmd == 'move' and arg3:
+		return gdrive.files().update(fileId=arg1, addParents=arg2,
+			removeParents=arg3, fields='id, parents')
+	return None
+
+def google_api_batch(cmds, size=100):
+	# run a list of (cmd, arg1, arg2, arg3) drive commands as batch requests,
+	# anything that can't be batched or that fails is run on its own
+	global gdrive
+	out, single = [None for c in cmds], []
+	if not hasattr(gdrive, 'new_batch_http_request'):
+		single = list(range(len(cmds)))
+		cmds = [tuple(c) for c in cmds]
+	else:
+		cmds = [tuple(c) + (None,)*(4-len(c)) for c in cmds]
+	failed, throttled = [], []
+	def callback(id, res, err):
+		if err is not None:
+			failed.append(int(id))
+			if ratelimited(err):
+				throttled.append(int(id))
+		else:
+			out[int(id)] = res
+	batch, count = None, 0
+	for i in range(len(cmds)):
+		if i in single:
+			continue
+		req = drive_request(*cmds[i])
+		if req is None:
+			single.append(i)
+			continue
+		if not batch:
+			batch = gdrive.new_batch_http_request(callback=callback)
+		batch.add(req, request_id='%d' % i)
+		count += 1
+		if count >= size:
+			# every call in a batch counts against the quota
+			ratelimit_acquire(count)
+			batch.execute()
+			batch, count = None, 0
+	if batch:
+		ratelimit_acquire(count)
+		batch.execute()
+	if len(throttled) > 0:
+		ratelimit_throttle()
+	for i in sorted(single + failed):
+		out[i] = google_api_command(*cmds[i])
+	return out
+
 def gdrive_find(gpath):
 	global gdriveids
+	idcache_load()
 	# cache the whole file path
 	if gpath in gdriveids and gdriveids[gpath]:
 		return gdriveids[gpath]
@@ -219,11 +491,11 @@ def gdrive_find(gpath):
 	if not pid:
 		return ''
 	if not file or file == '.':
-		gdriveids[gpath] = pid
+		idcache_set(gpath, pid)
 		return pid
 	out = gdrive_get(pid, file)
 	if len(out) > 0 and 'id' in out[0]:
-		gdriveids[gpath] = out[0]['id']
+		idcache_set(gpath, out[0]['id'])
 		return out[0]['id']
 	return ''
 
@@ -232,6 +504,7 @@ def gdrive_mkdir(dir='', readonly=False):
 	fmime, pid, cpath = 'application/vnd.google-apps.folder', 'root', ''
 	if not dir:
 		return pid
+	idcache_load()
 	if not readonly:
 		lock = mutex_lock(60)
 	for subdir in dir.split('/'):
@@ -244,7 +517,8 @@ def gdrive_mkdir(dir='', readonly=False):
 			(fmime, pid, subdir)
 		out = google_api_command('list', query)
 		if len(out) > 0 and 'id' in out[0]:
-			gdriveids[cpath] = pid = out[0]['id']
+			pid = out[0]['id']
+			idcache_set(cpath, pid)
 			continue
 		# create the subdir
 		if readonly:
@@ -253,8 +527,9 @@ def gdrive_mkdir(dir='', readonly=False):
 			metadata = {'name': subdir, 'mimeType': fmime, 'parents': [pid]}
 			file = google_api_command('create', metadata)
 			pid = file.get('id')
-			gdriveids[cpath] = pid
+			idcache_set(cpath, pid)
 	if not readonly:
+		idcache_flush()
 		mutex_unlock(lock)
 	return pid
 
@@ -263,29 +538,31 @@ def gdrive_get(folder, name):
 	return google_api_command('list', query)
 
 def gdrive_delete(folder, name):
-	global gdriveids
-	for item in gdrive_get(folder, name):
+	items = gdrive_get(folder, name)
+	for item in items:
 		print('deleting duplicate - %s (%s)' % (item['name'], item['id']))
-		google_api_command('delete', item['id'])
+	google_api_batch([('delete', item['id']) for item in items])
 	gpath = os.path.join(folder, name)
-	del gdriveids[gpath]
+	idcache_drop(gpath)
 
 def gdrive_backup(folder, name):
-	global gdriveids
 	gpath = os.path.join(folder, name)
 	fid = gdrive_find(folder)
 	id = gdrive_find(gpath)
 	if not id or not fid:
 		return False
 	bfid = gdrive_mkdir(os.path.join(folder, 'old'))
+	# get all the existing backup names in one query
+	query = 'trashed = false and \'%s\' in parents and name contains \'%s\'' % \
+		(bfid, name.replace('\'', '\\\''))
+	used = [f['name'] for f in google_api_command('list', query)]
 	i, append = 1, '.bak'
-	while len(gdrive_get(bfid, name+append)) > 0:
+	while name+append in used:
 		append = '.bak%d' % i
 		i += 1
 	print('moving duplicate - %s -> old/%s%s' % (name, name, append))
-	google_api_command('rename', id, name+append)
-	file = google_api_command('move', id, bfid)
-	del gdriveids[gpath]
+	google_api_command('renamemove', id, (name+append, bfid), fid)
+	idcache_drop(gpath)
 	return True
 
 def color(str, color=31):
@@ -305,14 +582,12 @@ def gdrive_get_backup_files(gid):
 	return out
 
 def get_used_gids():
-	datafile = os.path.join(os.getenv('HOME'), '.multitestdata')
-	if not os.path.exists(datafile):
+	from lib.datacache import opencache
+	cache = opencache()
+	if not cache:
 		return dict()
-	out, fp = dict(), open(datafile, 'r')
-	for line in fp:
-		id = line.strip().split('|')[-1]
-		out[id] = 1
-	fp.close()
+	out = cache.gids()
+	cache.close()
 	return out
 
 def gdrive_command_simple(cmd, gpath, arg=None):
@@ -357,16 +632,17 @@ def gdrive_command_simple(cmd, gpath, arg=None):
 			if 'folder' not in file['mimeType']:
 				continue
 			if file['name'] == 'old':
-				list = gdrive_get_backup_files(file['id'])
+				list, cmds = gdrive_get_backup_files(file['id']), []
 				for gid in list:
 					if gid in arg:
 						pprint(color('%s/old/%s' % (gpath, list[gid]), 32))
 					else:
 						if cmd == 'bclear':
 							pprint(color('%s/old/%s' % (gpath, list[gid]), 31))
-							google_api_command('delete', gid)
+							cmds.append(('delete', gid))
 						else:
 							pprint('%s/old/%s' % (gpath, list[gid]))
+				google_api_batch(cmds)
 			else:
 				gdrive_command_simple(cmd, op.join(gpath,file['name']), arg)
 	elif cmd in ['files', 'clear']:
@@ -397,7 +673,7 @@ def gdrive_upload(local, remote):
 	if dir and dir not in ['.', '/']:
 		fid = gdrive_mkdir(dir)
 		if fid:
-			file = google_api_command('move', res['id'], fid)
+			file = google_api_command('move', res['id'], fid, 'root')
 	print('https://drive.google.com/open?id=%s' % res['id'])
 	return True
 
@@ -416,7 +692,7 @@ def gdrive_sheet(local, remote):
 	if dir and dir not in ['.', '/']:
 		fid = gdrive_mkdir(dir)
 		if fid:
-			file = google_api_command('move', res['id'], fid)
+			file = google_api_command('move', res['id'], fid, 'root')
 	print('https://drive.google.com/open?id=%s' % res['id'])
 	return True
 
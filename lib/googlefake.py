@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# GoogleFake library
+# Copyright (c) 2020, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Authors:
+#    Todd Brandt <todd.e.brandt@linux.intel.com>
+#
+# Description:
+#    In-memory stand-in for the google drive v3 and sheets v4 services.
+#    Implements only the calls made by googleapi, with an optional per
+#    request latency, a requests per second quota, and call counters, so
+#    report generation can be run and timed without network access or
+#    credentials.
+
+import re
+import time
+
+FOLDER = 'application/vnd.google-apps.folder'
+SHEET = 'application/vnd.google-apps.spreadsheet'
+
+class FakeError(Exception):
+	pass
+
+class FakeRequest:
+	def __init__(self, backend, func):
+		self.backend = backend
+		self.func = func
+	def execute(self):
+		self.backend.request()
+		return self.func()
+
+class FakeBatch:
+	def __init__(self, backend, callback=None):
+		self.backend = backend
+		self.callback = callback
+		self.items = []
+	def add(self, request, callback=None, request_id=None):
+		if len(self.items) >= 100:
+			raise FakeError('batch request limit exceeded')
+		if request_id is None:
+			request_id = '%d' % len(self.items)
+		self.items.append((request_id, request, callback))
+	def execute(self):
+		# the whole batch is a single round trip, each call uses quota
+		self.backend.request(0)
+		self.backend.batches += 1
+		for id, request, callback in self.items:
+			res, err = None, None
+			try:
+				self.backend.usequota()
+				res = request.func()
+			except Exception as e:
+				err = e
+			cb = callback if callback else self.callback
+			if cb:
+				cb(id, res, err)
+
+class FakeFiles:
+	def __init__(self, backend):
+		self.b = backend
+	def list(self, q='', orderBy=None, pageSize=100, fields='', pageToken=None):
+		return FakeRequest(self.b, lambda:self.b.listfiles(q, pageSize, pageToken))
+	def get(self, fileId, fields=''):
+		return FakeRequest(self.b, lambda:self.b.getfile(fileId))
+	def create(self, body, media_body=None, fields=''):
+		return FakeRequest(self.b, lambda:self.b.newfile(body))
+	def update(self, fileId, body=None, addParents=None, removeParents=None, fields=''):
+		return FakeRequest(self.b,
+			lambda:self.b.updatefile(fileId, body, addParents, removeParents))
+	def delete(self, fileId):
+		return FakeRequest(self.b, lambda:self.b.deletefile(fileId))
+
+class FakeSpreadsheets:
+	def __init__(self, backend):
+		self.b = backend
+	def create(self, body):
+		return FakeRequest(self.b, lambda:self.b.newsheet(body))
+	def batchUpdate(self, spreadsheetId, body):
+		return FakeRequest(self.b, lambda:self.b.formatsheet(spreadsheetId, body))
+
+class FakeDrive:
+	def __init__(self, backend):
+		self.b = backend
+	def files(self):
+		return FakeFiles(self.b)
+	def new_batch_http_request(self, callback=None):
+		return FakeBatch(self.b, callback)
+
+class FakeSheets:
+	def __init__(self, backend):
+		self.b = backend
+	def spreadsheets(self):
+		return FakeSpreadsheets(self.b)
+
+class FakeBackend:
+	qterm = re.compile('^(?P<a>\S*) *(?P<op>=|!=|in|contains) *(?P<b>.*)$')
+	def __init__(self, latency=0, quota=0):
+		self.latency = latency
+		self.quota = quota
+		self.window = []
+		self.files = dict()
+		self.next = 0
+		self.requests = self.batches = self.throttled = 0
+	def usequota(self):
+		if self.quota <= 0:
+			return
+		now = time.time()
+		self.window = [t for t in self.window if now - t < 1.0]
+		if len(self.window) >= self.quota:
+			self.throttled += 1
+			raise FakeError('User Rate Limit Exceeded')
+		self.window.append(now)
+	def request(self, quota=1):
+		self.requests += 1
+		if self.latency > 0:
+			time.sleep(self.latency)
+		if quota:
+			self.usequota()
+	def newid(self):
+		self.next += 1
+		return 'fake%06d' % self.next
+	def unquote(self, val):
+		val = val.strip()
+		if len(val) > 1 and val[0] == '\'' and val[-1] == '\'':
+			return val[1:-1]
+		return val
+	def match(self, file, term):
+		m = self.qterm.match(term.strip())
+		if not m:
+			raise FakeError('unsupported query: %s' % term)
+		a, op, b = m.group('a'), m.group('op'), m.group('b')
+		if op == 'in' and b == 'parents':
+			return self.unquote(a) in file['parents']
+		b = self.unquote(b)
+		if a == 'trashed':
+			val = 'false'
+		elif a in file:
+			val = file[a]
+		else:
+			raise FakeError('unsupported query field: %s' % a)
+		if op == '=':
+			return val == b
+		elif op == '!=':
+			return val != b
+		elif op == 'contains':
+			return b in val
+		return False
+	def listfiles(self, q, pageSize, pageToken):
+		terms = [t for t in re.split(' and ', q) if t.strip()] if q else []
+		out = []
+		for id in sorted(self.files):
+			file = self.files[id]
+			if all(self.match(file, t) for t in terms):
+				out.append(file)
+		start = int(pageToken) if pageToken else 0
+		res = {'files': [dict(f) for f in out[start:start+pageSize]]}
+		if start + pageSize < len(out):
+			res['nextPageToken'] = '%d' % (start + pageSize)
+		return res
+	def getfile(self, id):
+		if id not in self.files:
+			raise FakeError('File not found: %s' % id)
+		return dict(self.files[id])
+	def newfile(self, body, id=''):
+		id = id if id else self.newid()
+		self.files[id] = {
+			'id': id,
+			'name': body.get('name', 'Untitled'),
+			'mimeType': body.get('mimeType', 'text/plain'),
+			'parents': list(body.get('parents', ['root'])),
+			'createdTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+		}
+		return {'id': id}
+	def updatefile(self, id, body, addParents, removeParents):
+		if id not in self.files:
+			raise FakeError('File not found: %s' % id)
+		file = self.files[id]
+		if body and 'name' in body:
+			file['name'] = body['name']
+		if removeParents:
+			for p in removeParents.split(','):
+				if p in file['parents']:
+					file['parents'].remove(p)
+		if addParents:
+			for p in addParents.split(','):
+				if p not in file['parents']:
+					file['parents'].append(p)
+		return dict(file)
+	def deletefile(self, id):
+		if id not in self.files:
+			raise FakeError('File not found: %s' % id)
+		del self.files[id]
+		for f in self.files.values():
+			if id in f['parents']:
+				f['parents'].remove(id)
+		return ''
+	def newsheet(self, body):
+		title = body.get('properties', {}).get('title', 'Untitled')
+		id = self.newfile({'name': title, 'mimeType': SHEET})['id']
+		self.files[id]['sheet'] = body
+		return {
+			'spreadsheetId': id,
+			'spreadsheetUrl': 'https://docs.google.com/spreadsheets/d/%s' % id,
+		}
+	def formatsheet(self, id, body):
+		if id not in self.files:
+			raise FakeError('Spreadsheet not found: %s' % id)
+		return {'spreadsheetId': id, 'replies': [{} for r in body['requests']]}
+	def services(self):
+		return (FakeDrive(self), FakeSheets(self))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Ingest library
+# Copyright (c) 2020, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Authors:
+#    Todd Brandt <todd.e.brandt@linux.intel.com>
+#
+# Description:
+#    Durable job queue and folder watch for the multitest intake daemon.
+#    Archives dropped into the intake folder are checksummed and queued in
+#    a sqlite file, so queued and interrupted jobs survive a restart and
+#    the same archive submitted twice is only processed once. The folder
+#    is watched with inotify when it's available and polled otherwise.
+
+import os
+import sys
+import time
+import json
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import sqlite3
+import hashlib
+import os.path as op
+
+archives = ('.tar.gz', '.tar.xz', '.zip')
+
+def isarchive(name):
+	return not name.startswith('.') and name.endswith(archives)
+
+def checksum(file, cancel=None):
+	# cancel is checked between blocks, an empty sum means it gave up
+	h = hashlib.sha256()
+	with open(file, 'rb') as fp:
+		for block in iter(lambda:fp.read(1024*1024), b''):
+			if cancel and cancel():
+				return ''
+			h.update(block)
+	return h.hexdigest()
+
+class IngestQueue:
+	timeout = 300
+	def __init__(self, file, recover=False):
+		self.file = file
+		self.db = sqlite3.connect(file, timeout=self.timeout,
+			isolation_level=None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS jobs '\
+			'(id INTEGER PRIMARY KEY, path TEXT, sum TEXT, size INTEGER, '\
+			'state TEXT, added REAL, started REAL, finished REAL, rc INTEGER)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS idx_sum ON jobs (sum)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS idx_state ON jobs (state)')
+		# anything running when the daemon last stopped never finished
+		if recover:
+			self.db.execute("UPDATE jobs SET state='queued', started=NULL "\
+				"WHERE state='running'")
+	def close(self):
+		if self.db:
+			self.db.close()
+			self.db = None
+	def add(self, path, sum, size):
+		# returns the new job id, or 0 if this archive was already taken
+		self.db.execute('BEGIN IMMEDIATE')
+		try:
+			dup = self.db.execute("SELECT id FROM jobs WHERE sum = ? AND "\
+				"state IN ('queued', 'running', 'done')", (sum,)).fetchone()
+			cur = self.db.execute('INSERT INTO jobs (path, sum, size, state, added) '\
+				'VALUES (?, ?, ?, ?, ?)', (path, sum, size,
+				'duplicate' if dup else 'queued', time.time()))
+		except:
+			self.db.execute('ROLLBACK')
+			raise
+		self.db.execute('COMMIT')
+		return 0 if dup else cur.lastrowid
+	def claim(self):
+		# oldest queued job as (id, path), marked as running
+		self.db.execute('BEGIN IMMEDIATE')
+		row = self.db.execute("SELECT id, path FROM jobs WHERE state = 'queued' "\
+			"ORDER BY id LIMIT 1").fetchone()
+		if row:
+			self.db.execute("UPDATE jobs SET state='running', started=? "\
+				"WHERE id = ?", (time.time(), row[0]))
+		self.db.execute('COMMIT')
+		return row
+	def finish(self, id, rc):
+		self.db.execute('UPDATE jobs SET state=?, finished=?, rc=? WHERE id = ?',
+			('done' if rc == 0 else 'failed', time.time(), rc, id))
+	def pending(self):
+		# paths that are queued or running, they're still in the intake
+		return set([r[0] for r in self.db.execute("SELECT path FROM jobs "\
+			"WHERE state IN ('queued', 'running')")])
+	def counts(self):
+		out = dict()
+		for state in ['queued', 'running', 'done', 'failed', 'duplicate']:
+			out[state] = 0
+		for r in self.db.execute('SELECT state, count(*) FROM jobs GROUP BY state'):
+			out[r[0]] = r[1]
+		return out
+	def jobs(self, states=[]):
+		sql, args = 'SELECT * FROM jobs', []
+		if states:
+			sql += ' WHERE state IN (%s)' % ','.join(['?' for s in states])
+			args = states
+		cur = self.db.execute(sql + ' ORDER BY id', args)
+		names = [d[0] for d in cur.description]
+		for row in cur:
+			yield dict(zip(names, row))
+
+class FolderWatch:
+	# wait() returns the names written or moved into the folder, or None
+	# when the caller should rescan the whole folder (polling, overflow)
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_TO = 0x80
+	IN_Q_OVERFLOW = 0x4000
+	def __init__(self, folder, poll=False):
+		self.folder = folder
+		self.fd = -1
+		if not poll:
+			self.inotify()
+	def inotify(self):
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+			if fd < 0:
+				return
+			if libc.inotify_add_watch(fd, self.folder.encode(),
+				self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+				os.close(fd)
+				return
+			self.fd = fd
+		except:
+			self.fd = -1
+	def mode(self):
+		return 'inotify' if self.fd >= 0 else 'polling'
+	def wait(self, timeout):
+		if self.fd < 0:
+			time.sleep(timeout)
+			return None
+		try:
+			r, w, x = select.select([self.fd], [], [], timeout)
+		except InterruptedError:
+			return []
+		if not r:
+			return []
+		try:
+			buf = os.read(self.fd, 65536)
+		except OSError as e:
+			if e.errno == errno.EAGAIN:
+				return []
+			raise
+		out, i = [], 0
+		while i + 16 <= len(buf):
+			wd, mask, cookie, size = struct.unpack_from('iIII', buf, i)
+			name = buf[i+16:i+16+size].rstrip(b'\0').decode('utf-8', 'ignore')
+			i += 16 + size
+			if mask & self.IN_Q_OVERFLOW:
+				return None
+			if name:
+				out.append(name)
+		return out
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+def readstatus(file):
+	try:
+		with open(file, 'r') as fp:
+			return json.load(fp)
+	except:
+		return dict()
+
+def writestatus(file, status):
+	tmp = '%s.%d' % (file, os.getpid())
+	with open(tmp, 'w') as fp:
+		json.dump(status, fp)
+	os.rename(tmp, file)
+
+# ----------------- MAIN --------------------
+# exec start (skipped if script is loaded as library)
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-state', metavar='value', default='',
+		help='only list jobs in this state (queued/running/done/failed/duplicate)')
+	parser.add_argument('intake', metavar='folder',
+		help='intake folder of a stressreport -daemon')
+	args = parser.parse_args()
+
+	file = op.join(args.intake, '.ingest.db')
+	if not op.exists(file):
+		print('ERROR: %s has no ingest queue' % args.intake)
+		sys.exit(1)
+	queue = IngestQueue(file)
+	for job in queue.jobs([args.state] if args.state else []):
+		t = job['finished'] if job['finished'] else job['added']
+		print('%6d %-9s %s %s' % (job['id'], job['state'],
+			time.strftime('%y%m%d-%H%M%S', time.localtime(t)), job['path']))
+	print(', '.join(['%d %s' % (v, k) for k, v in queue.counts().items()]))
+	queue.close()
@@ -26,6 +26,9 @@ import sys
 import re
 import shutil
 import time
+import json
+import fcntl
+import hashlib
 from tempfile import mkdtemp
 from subprocess import call, Popen, PIPE
 from lib.common import mystarttime, pprint, printlines, ascii, runcmd
@@ -92,11 +95,19 @@ def clean(src, kconfig, latest=False):
 	runcmd('make -C %s distclean' % src, True)
 	runcmd('cp %s %s' % (kconfig, op.join(src, '.config')), True)
 
-def build(src, pkgfmt, name):
+def build(src, pkgfmt, name, jobs=0, cache=None):
+	key = cache.key(src, pkgfmt, name) if cache else ''
+	if key:
+		hit = cache.get(key, op.dirname(op.abspath(src)))
+		if hit:
+			pprint('Using cached build of %s' % hit[1])
+			return hit
 	try:
 		numcpu = int(runcmd('getconf _NPROCESSORS_ONLN', False, False)[0])
 	except:
 		numcpu = 2
+	if jobs > 0:
+		numcpu = jobs
 	if pkgfmt == 'rpm' and not runcmd('which rpmbuild', False, False):
 		doError('rpmbuild is required to build rpm packages')
 	runcmd('make -C %s olddefconfig' % src, True)
@@ -126,6 +137,8 @@ def build(src, pkgfmt, name):
 				packages.append(op.basename(file))
 			else:
 				doError('build log format error, unable to find rpm package names')
+	if key and len(packages) > 0:
+		cache.put(key, outdir, kver, packages)
 	return (outdir, kver, packages)
 
 def move_packages(src, dst, packages):
@@ -210,3 +223,203 @@ def bisect_step(src, state):
 		doError('invalid bisect state, need good, bad, or skip: %s' % state)
 	out = runcmd('git -C %s bisect %s' % (src, state), True)
 	return bisect_step_info(out)
+
+class BuildCache:
+	# kernel packages stored by a hash of everything that goes into the
+	# build: commit, uncommitted changes and new files (patches), .config,
+	# format, and name, least recently used entries go once the cache is
+	# over maxsize
+	def __init__(self, dir, maxsize=20*1024*1024*1024):
+		self.dir = dir
+		self.maxsize = maxsize
+		if not op.exists(dir):
+			os.makedirs(dir)
+	def key(self, src, pkgfmt, name):
+		config = op.join(src, '.config')
+		if not isgit(src) or not op.exists(config):
+			return ''
+		h = hashlib.sha256()
+		h.update(('%s\n%s\n' % (pkgfmt, name)).encode())
+		h.update(runcmd('git -C %s rev-parse HEAD' % src, False)[0].encode())
+		p = Popen(['git', '-C', src, 'diff', 'HEAD'], stdout=PIPE, stderr=PIPE)
+		for data in iter(lambda: p.stdout.read(65536), b''):
+			h.update(data)
+		if p.wait() != 0:
+			return ''
+		# git diff doesn't see files a patch adds, so hash those too
+		p = Popen(['git', '-C', src, 'ls-files', '-z', '--others',
+			'--exclude-standard'], stdout=PIPE, stderr=PIPE)
+		out = p.communicate()[0]
+		if p.returncode != 0:
+			return ''
+		for file in sorted(out.split(b'\0')):
+			path = op.join(src.encode(), file)
+			if not file or not op.isfile(path):
+				continue
+			h.update(b'untracked %s\n' % file)
+			with open(path, 'rb') as fp:
+				for data in iter(lambda: fp.read(65536), b''):
+					h.update(data)
+		with open(config, 'rb') as fp:
+			h.update(fp.read())
+		return h.hexdigest()
+	def lock(self):
+		fp = open(op.join(self.dir, '.lock'), 'w')
+		fcntl.flock(fp, fcntl.LOCK_EX)
+		return fp
+	def info(self, key):
+		try:
+			with open(op.join(self.dir, key, 'info.json'), 'r') as fp:
+				return json.load(fp)
+		except:
+			return None
+	def get(self, key, outdir):
+		# copy the cached packages to outdir, (outdir, kver, packages) or None
+		lock, info = self.lock(), self.info(key)
+		if info:
+			# the lock keeps the entry from being evicted mid copy
+			os.utime(op.join(self.dir, key, 'info.json'))
+			for file in info['packages']:
+				tmp = op.join(outdir, '.%s.%d' % (file, os.getpid()))
+				shutil.copyfile(op.join(self.dir, key, file), tmp)
+				os.rename(tmp, op.join(outdir, file))
+		lock.close()
+		if not info:
+			return None
+		return (outdir, info['kver'], list(info['packages']))
+	def put(self, key, outdir, kver, packages):
+		tmp = op.join(self.dir, '.%s.%d' % (key, os.getpid()))
+		if op.exists(tmp):
+			shutil.rmtree(tmp)
+		os.makedirs(tmp)
+		size = 0
+		for file in packages:
+			shutil.copyfile(op.join(outdir, file), op.join(tmp, file))
+			size += op.getsize(op.join(tmp, file))
+		with open(op.join(tmp, 'info.json'), 'w') as fp:
+			json.dump({'kver': kver, 'packages': packages, 'size': size}, fp)
+		lock = self.lock()
+		if op.exists(op.join(self.dir, key)):
+			shutil.rmtree(tmp)
+		else:
+			os.rename(tmp, op.join(self.dir, key))
+		self.evict()
+		lock.close()
+	def entries(self):
+		# (last used, size, key) for everything in the cache, oldest first
+		out = []
+		for key in os.listdir(self.dir):
+			file = op.join(self.dir, key, 'info.json')
+			if key.startswith('.') or not op.exists(file):
+				continue
+			info = self.info(key)
+			out.append((op.getmtime(file), info['size'] if info else 0, key))
+		return sorted(out)
+	def evict(self):
+		entries = self.entries()
+		total = sum([e[1] for e in entries])
+		# always keep the newest entry, even if it's over the limit
+		for used, size, key in entries[:-1]:
+			if total <= self.maxsize:
+				break
+			shutil.rmtree(op.join(self.dir, key))
+			total -= size
+		return total
+
+def worktree(src, dir, commit):
+	# a detached checkout of commit in dir, reused across calls so the
+	# build objects from the last commit make the next build incremental
+	if not op.exists(op.join(dir, '.git')):
+		if not op.exists(op.dirname(dir)):
+			os.makedirs(op.dirname(dir))
+		runcmd('git -C %s worktree add --detach --force %s %s' % \
+			(src, dir, commit), True)
+		return
+	runcmd('git -C %s reset -q --hard' % dir)
+	runcmd('git -C %s checkout -q --detach %s' % (dir, commit), True)
+
+def worktree_remove(src, dir):
+	runcmd('git -C %s worktree remove --force %s' % (src, dir), False, False)
+
+class BisectState:
+	# k-ary bisect over the git history, a round tests several commits
+	# at once and every result narrows the range, the results are saved
+	# to a json file so an interrupted bisect can be resumed
+	def __init__(self, file, src, kgood, kbad, kpath=''):
+		self.file = file
+		self.src = src
+		self.info = {'good': kgood, 'bad': kbad, 'path': kpath}
+		self.results = []
+		if op.exists(file):
+			with open(file, 'r') as fp:
+				data = json.load(fp)
+			if data.get('info') != self.info:
+				doError('%s is from a different bisect, remove it to start over' % file)
+			self.results = data.get('results', [])
+		self.goods = [self.rev(kgood)]
+		# the first bad commit is an ancestor of every bad one, so it's in
+		# their common ancestry, which heads are the newest commits of
+		self.bads = [self.rev(kbad)]
+		self.heads = list(self.bads)
+		self.skips = []
+		for r in self.results:
+			self.apply(r['commit'], r['state'])
+	def rev(self, name):
+		return runcmd('git -C %s rev-parse %s^{commit}' % (self.src, name), False)[0]
+	def save(self):
+		tmp = '%s.%d' % (self.file, os.getpid())
+		with open(tmp, 'w') as fp:
+			json.dump({'info': self.info, 'results': self.results}, fp, indent=1)
+		os.rename(tmp, self.file)
+	def revlist(self):
+		# commits that could be the first bad one, oldest first
+		cmd = 'git -C %s rev-list --topo-order --reverse %s --not %s' % \
+			(self.src, ' '.join(self.heads), ' '.join(self.goods))
+		if self.info['path']:
+			cmd += ' -- %s' % self.info['path']
+		return [c for c in runcmd(cmd, False) if c]
+	def mergebase(self, args):
+		cmd = 'git -C %s merge-base %s' % (self.src, args)
+		return [c for c in runcmd(cmd, False) if c]
+	def apply(self, commit, state):
+		if state == 'good':
+			self.goods.append(commit)
+		elif state == 'bad':
+			# narrow the heads to what they have in common with this one
+			self.bads.append(commit)
+			heads = []
+			for h in self.heads:
+				heads += [c for c in self.mergebase('--all %s %s' % (h, commit)) \
+					if c not in heads]
+			if len(heads) > 1:
+				heads = self.mergebase('--independent %s' % ' '.join(heads))
+			if heads:
+				self.heads = heads
+		elif state == 'skip':
+			self.skips.append(commit)
+	def record(self, commit, state, host='', kver=''):
+		self.results.append({'commit': commit, 'state': state,
+			'host': host, 'kernel': kver, 'time': time.strftime('%y%m%d-%H%M%S')})
+		self.apply(commit, state)
+		self.save()
+	def candidates(self):
+		# untested commits left
+		return [c for c in self.revlist() \
+			if c not in self.bads and c not in self.skips]
+	def pick(self, count):
+		# count commits evenly spaced through the candidates
+		list = self.candidates()
+		count = min(count, len(list))
+		out = []
+		for i in range(count):
+			c = list[(i + 1) * len(list) // (count + 1)]
+			if c not in out:
+				out.append(c)
+		return out
+	def done(self):
+		return len(self.candidates()) < 1
+	def remaining(self):
+		# the commits that could still be the first bad one, if there's
+		# more than one the skipped commits are in the way
+		return [c for c in self.revlist() if c not in self.bads] + \
+			[c for c in self.heads if c in self.bads]
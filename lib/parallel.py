@@ -27,49 +27,252 @@ import time
 import os.path as op
 from subprocess import call, Popen, PIPE
 from datetime import date, datetime, timedelta
-from threading import Thread
+from threading import Thread, Lock, Event, Semaphore
 import psutil
 import signal
 import fcntl
+import resource
+import selectors
+import heapq
+import multiprocessing
+from queue import Queue, Empty
+from collections import deque
+from multiprocessing.connection import wait as mpwait
 
 def ascii(text):
 	return text.decode('ascii', 'ignore')
 
-def permission_to_run(name, count, wait, pfunc=None):
-	fps, i, success = [], 0, False
-	for idx in range(count):
-		file = '/tmp/%s%d.lock' % (name, idx)
-		fps.append(open(file, 'w'))
+class SlotSemaphore:
+	# a counting semaphore shared by every process using the same name,
+	# made of count lock files in /tmp so a slot is freed if its holder
+	# dies. Waiters queue in ticket order, each one blocked on the lock of
+	# the waiter ahead of it, so only the head of the queue looks for a
+	# free slot and slots are handed out first come first served. The
+	# last waiter to leave the queue removes its .q and .ticket files.
+	def __init__(self, name, count, dir='/tmp'):
+		self.name = name
+		self.count = count
+		self.dir = dir
+		self.fp = None
+		self.slot = -1
+		self.ticket = 0
+		self.position = 0
+		self.waited = 0.0
+	def path(self, suffix):
+		return op.join(self.dir, '%s%s' % (self.name, suffix))
+	def openfile(self, file, mode):
+		fp = open(file, mode)
 		try:
 			os.chmod(file, 0o666)
 		except:
 			pass
-	while i < wait and not success:
-		for fp in fps:
+		return fp
+	def trylock(self):
+		for idx in range(self.count):
+			fp = self.openfile(self.path('%d.lock' % idx), 'w')
 			try:
 				fcntl.flock(fp, fcntl.LOCK_NB | fcntl.LOCK_EX)
-				success = fp
+			except:
+				fp.close()
+				continue
+			self.fp, self.slot = fp, idx
+			return True
+		return False
+	def samefile(self, fp, file):
+		# fp is still the file at this path, it wasn't removed while we
+		# were waiting for its lock
+		try:
+			return os.fstat(fp.fileno()).st_ino == os.stat(file).st_ino
+		except:
+			return False
+	def waitlock(self, fps, mode, timeout):
+		# block on the lock of any of fps for up to timeout seconds, and
+		# return the indexes of the ones locked. Each lock is taken by a
+		# forked child on the inherited descriptor, flock locks belong to
+		# the open file so they're ours once the child has them, and a
+		# child still blocked at the deadline is killed instead of leaving
+		# a thread stuck in flock. A lock a child took but didn't report
+		# goes when the caller closes that fp.
+		r, w = os.pipe()
+		pids = []
+		for i in range(len(fps)):
+			pid = os.fork()
+			if pid == 0:
+				try:
+					os.close(r)
+					fcntl.flock(fps[i], mode)
+					os.write(w, b'%d\n' % i)
+				except:
+					os._exit(1)
+				os._exit(0)
+			pids.append(pid)
+		os.close(w)
+		sel = selectors.DefaultSelector()
+		sel.register(r, selectors.EVENT_READ)
+		sel.select(max(0, timeout))
+		sel.close()
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGKILL)
+			except:
+				pass
+			try:
+				os.waitpid(pid, 0)
+			except:
+				pass
+		data = b''
+		while True:
+			buf = os.read(r, 4096)
+			if not buf:
+				break
+			data += buf
+		os.close(r)
+		return sorted([int(i) for i in data.split()])
+	def enqueue(self):
+		# take the next ticket and lock our place in line before anyone
+		# behind us can look for it
+		while True:
+			ctr = self.openfile(self.path('.ticket'), 'a+')
+			fcntl.flock(ctr, fcntl.LOCK_EX)
+			if self.samefile(ctr, self.path('.ticket')):
+				break
+			ctr.close()
+		ctr.seek(0)
+		try:
+			last = int(ctr.read().strip() or 0)
+		except:
+			last = 0
+		self.ticket = last + 1
+		ctr.seek(0)
+		ctr.truncate()
+		ctr.write('%d' % self.ticket)
+		ctr.flush()
+		qfp = self.openfile(self.path('.q%d' % self.ticket), 'w')
+		fcntl.flock(qfp, fcntl.LOCK_EX)
+		fcntl.flock(ctr, fcntl.LOCK_UN)
+		ctr.close()
+		self.position = 0
+		for t in range(last, 0, -1):
+			if not op.exists(self.path('.q%d' % t)):
 				break
+			self.position += 1
+		return qfp
+	def dequeue(self, qfp, state):
+		# tell the waiter behind us whether we left with a slot or not
+		qfp.write(state)
+		qfp.flush()
+		try:
+			os.remove(self.path('.q%d' % self.ticket))
+		except:
+			pass
+		qfp.close()
+		self.cleanup()
+	def cleanup(self):
+		# if nobody is left in the queue, remove the .q files of waiters
+		# that died in it and the ticket counter. A live waiter holds the
+		# lock of its own .q file, and nobody can join while we hold the
+		# counter's lock, so an enqueue blocked on it finds it removed
+		# and starts a new one.
+		file = self.path('.ticket')
+		try:
+			ctr = open(file, 'r')
+		except:
+			return
+		stale = []
+		try:
+			fcntl.flock(ctr, fcntl.LOCK_EX)
+			if not self.samefile(ctr, file):
+				return
+			prefix = self.name + '.q'
+			for f in os.listdir(self.dir):
+				if not f.startswith(prefix) or not f[len(prefix):].isdigit():
+					continue
+				try:
+					fp = open(op.join(self.dir, f), 'r')
+				except:
+					continue
+				stale.append((f, fp))
+				fcntl.flock(fp, fcntl.LOCK_NB | fcntl.LOCK_EX)
+			for f, fp in stale:
+				os.remove(op.join(self.dir, f))
+			os.remove(file)
+		except:
+			pass
+		finally:
+			for f, fp in stale:
+				fp.close()
+			ctr.close()
+	def lockany(self, deadline):
+		# block until any slot is free or the deadline passes
+		fps = [self.openfile(self.path('%d.lock' % idx), 'w') \
+			for idx in range(self.count)]
+		got = self.waitlock(fps, fcntl.LOCK_EX, deadline - time.time())
+		for idx in range(self.count):
+			if got and idx == got[0]:
+				self.fp, self.slot = fps[idx], idx
+			else:
+				fps[idx].close()
+		return len(got) > 0
+	def waitturn(self, deadline):
+		# walk back past waiters that gave up or died until the one ahead
+		# of us has a slot or nobody is ahead
+		t = self.ticket - 1
+		while t > 0:
+			file = self.path('.q%d' % t)
+			try:
+				fp = open(file, 'r')
+			except:
+				return True
+			if not self.waitlock([fp], fcntl.LOCK_SH, deadline - time.time()):
+				fp.close()
+				return False
+			state = fp.read().strip()
+			fp.close()
+			if state == 'done':
+				return True
+			try:
+				os.remove(file)
 			except:
 				pass
-		if success:
-			break
-		if i == 0:
-			msg = 'waiting to execute, only %d processes allowed at a time' % count
+			t -= 1
+		return True
+	def acquire(self, timeout, pfunc=None):
+		start = time.time()
+		deadline = start + timeout
+		qfp = self.enqueue()
+		if self.position > 0 or not self.trylock():
 			if pfunc:
-				pfunc(msg)
-			else:
-				print(msg)
-		time.sleep(1)
-		i += 1
-	if not success:
+				pfunc('waiting to execute, only %d processes allowed at a time '\
+					'(%d ahead in queue)' % (self.count, self.position))
+			# at the head of the queue, the next released slot is ours
+			ok = self.waitturn(deadline) and \
+				(self.trylock() or self.lockany(deadline))
+			if not ok:
+				self.waited = time.time() - start
+				self.dequeue(qfp, 'abandon')
+				return False
+		self.waited = time.time() - start
+		self.dequeue(qfp, 'done')
+		if self.waited >= 1 and pfunc:
+			pfunc('slot %d acquired after waiting %.1f seconds' % \
+				(self.slot, self.waited))
+		return True
+	def release(self):
+		if self.fp:
+			fcntl.flock(self.fp, fcntl.LOCK_UN)
+			self.fp.close()
+			self.fp, self.slot = None, -1
+
+def permission_to_run(name, count, wait, pfunc=None):
+	sem = SlotSemaphore(name, count)
+	if not sem.acquire(wait, pfunc if pfunc else print):
 		msg = 'timed out waiting for a slot to execute %s' % name
 		if pfunc:
 			pfunc(msg)
 		else:
 			print(msg)
 		sys.exit(1)
-	return success
+	return sem.fp
 
 def findProcess(name, args=[]):
 	for proc in psutil.process_iter():
@@ -95,19 +298,340 @@ def findProcess(name, args=[]):
 			return True
 	return False
 
+# cgroup v2 files and their v1 equivalents
+cgroupfiles = {
+	'cpu': [('cpu.max', ''), ('cpu.cfs_quota_us', 'cpu.cfs_period_us')],
+	'memory': [('memory.max', 'memory.current'),
+		('memory.limit_in_bytes', 'memory.usage_in_bytes')],
+}
+
+def readval(file):
+	try:
+		with open(file, 'r') as fp:
+			return fp.readline().strip()
+	except:
+		return ''
+
+cgroupcache = dict()
+def cgroupdirs(controller):
+	# the cgroup folders this process is in for a controller, from the
+	# innermost up to the root, limits can be set at any level
+	if controller in cgroupcache:
+		return cgroupcache[controller]
+	out = cgroupcache[controller] = []
+	try:
+		fp = open('/proc/self/cgroup', 'r')
+		lines = fp.read().splitlines()
+		fp.close()
+	except:
+		return out
+	for line in lines:
+		f = line.split(':', 2)
+		if len(f) < 3:
+			continue
+		if not f[1]:
+			base = '/sys/fs/cgroup'
+			if not op.exists(op.join(base, 'cgroup.controllers')):
+				base = '/sys/fs/cgroup/unified'
+		elif controller in f[1].split(','):
+			base = op.join('/sys/fs/cgroup', f[1])
+			if not op.isdir(base):
+				base = op.join('/sys/fs/cgroup', controller)
+		else:
+			continue
+		path = f[2]
+		while True:
+			dir = op.join(base, path.lstrip('/'))
+			if op.isdir(dir) and dir not in out:
+				out.append(dir)
+			if path in ['', '/']:
+				break
+			path = op.dirname(path)
+	return out
+
+def cgroupcpus():
+	# the tightest cpu quota in cpus (rounded up), 0 if there isn't one
+	cpus = 0
+	for dir in cgroupdirs('cpu'):
+		for qfile, pfile in cgroupfiles['cpu']:
+			val = readval(op.join(dir, qfile)).split()
+			if pfile:
+				val.append(readval(op.join(dir, pfile)))
+			try:
+				quota, period = int(val[0]), int(val[1])
+			except:
+				continue
+			if quota > 0 and period > 0:
+				n = max(1, -(-quota // period))
+				cpus = n if cpus == 0 else min(cpus, n)
+	return cpus
+
+def cgroupmem():
+	# the tightest cgroup memory headroom in bytes, -1 if there isn't one
+	free = -1
+	for dir in cgroupdirs('memory'):
+		for lfile, ufile in cgroupfiles['memory']:
+			try:
+				limit = int(readval(op.join(dir, lfile)))
+				used = int(readval(op.join(dir, ufile)))
+			except:
+				continue
+			# v1 reports no limit as a huge number
+			if limit >= 1 << 60:
+				continue
+			val = max(0, limit - used)
+			free = val if free < 0 else min(free, val)
+	return free
+
+def cpulimit():
+	try:
+		cpus = len(os.sched_getaffinity(0))
+	except:
+		cpus = os.cpu_count() or 1
+	quota = cgroupcpus()
+	return min(cpus, quota) if quota > 0 else cpus
+
+def memavailable():
+	avail = -1
+	try:
+		fp = open('/proc/meminfo', 'r')
+		for line in fp:
+			if line.startswith('MemAvailable:'):
+				avail = int(line.split()[1]) * 1024
+				break
+		fp.close()
+	except:
+		pass
+	cgfree = cgroupmem()
+	if cgfree >= 0:
+		avail = cgfree if avail < 0 else min(avail, cgfree)
+	return avail
+
+def mempressure():
+	# percent of the last 10s some task was stalled on memory (PSI)
+	for f in readval('/proc/pressure/memory').split():
+		if f.startswith('avg10='):
+			try:
+				return float(f[6:])
+			except:
+				break
+	return 0.0
+
+pagesize = resource.getpagesize()
+def treerss(pid):
+	# rss of a process and all its descendants, straight from /proc
+	rss, stack = 0, [pid]
+	while len(stack) > 0:
+		pid = stack.pop()
+		try:
+			with open('/proc/%d/statm' % pid, 'r') as fp:
+				rss += int(fp.read().split()[1]) * pagesize
+			with open('/proc/%d/task/%d/children' % (pid, pid), 'r') as fp:
+				stack.extend([int(c) for c in fp.read().split()])
+		except:
+			continue
+	return rss
+
+class Admission:
+	# decides whether a pool can start another job: never more jobs than
+	# usable cpus, and only while available memory covers the expected
+	# need of the new job plus what the running jobs may still grow into.
+	# The expected need is the largest peak rss of any finished job, or
+	# jobmem (bytes) until one finishes. With neither, jobs are started one
+	# recheck period apart so the running ones show how big they get.
+	# One job is always allowed to run.
+	reserve = 256 * 1024 * 1024
+	pressure = 20.0
+	recheck = 1.0
+	def __init__(self, cpus=0, jobmem=0, baseline=0):
+		self.cpus = cpus if cpus > 0 else cpulimit()
+		self.jobmem = jobmem
+		# rss every job starts with and which isn't its own (forked pages)
+		self.baseline = baseline
+		self.peak = 0
+		self.waits = 0
+		self.laststart = 0
+	def record(self, maxrss):
+		self.peak = max(self.peak, maxrss - self.baseline)
+	def admit(self, pids):
+		if len(pids) >= self.cpus:
+			return False
+		if len(pids) > 0 and not self.room(pids):
+			self.waits += 1
+			return False
+		self.laststart = time.time()
+		return True
+	def room(self, pids):
+		if self.peak <= 0 and self.jobmem <= 0 and \
+			time.time() - self.laststart < self.recheck:
+			return False
+		if self.pressure > 0 and mempressure() >= self.pressure:
+			return False
+		avail = memavailable()
+		if avail < 0:
+			return True
+		used = [max(0, treerss(pid) - self.baseline) for pid in pids]
+		need = max([self.peak, self.jobmem] + used)
+		grow = sum([max(0, need - u) for u in used])
+		return avail - self.reserve - grow >= need
+
+# host reachability for AsyncProcess, every process running commands on a
+# host shares one HostMonitor which probes it every probeinterval seconds
+# and stays around for probelinger seconds after the last one finishes
+probeinterval = 3
+probelinger = 60
+hostprober = None
+hostmonitors = dict()
+hostmonitorlock = Lock()
+
+def pingprobe(host):
+	val = call('ping -q -c 3 %s > /dev/null 2>&1' % host, shell=True)
+	return val == 0
+
+class FakeProber:
+	# stand-in for pingprobe, hosts in down are unreachable
+	def __init__(self, down=[], latency=0):
+		self.down = set(down)
+		self.latency = latency
+		self.probes = dict()
+	def __call__(self, host):
+		self.probes[host] = self.probes.get(host, 0) + 1
+		if self.latency > 0:
+			time.sleep(self.latency)
+		return host not in self.down
+
+def setHostProber(prober=None, interval=0, linger=0):
+	global hostprober, probeinterval, probelinger
+	hostprober = prober
+	if interval > 0:
+		probeinterval = interval
+	if linger > 0:
+		probelinger = linger
+
+class HostMonitor:
+	def __init__(self, host):
+		self.host = host
+		self.users = 0
+		self.idle = time.time()
+		self.status = True
+		self.checked = 0
+		self.probes = 0
+		self.stopped = Event()
+		self.thread = Thread(target=self.monitor, daemon=True)
+		self.thread.start()
+	def monitor(self):
+		while True:
+			prober = hostprober if hostprober else pingprobe
+			self.status = prober(self.host)
+			self.checked = time.time()
+			self.probes += 1
+			if self.stopped.wait(probeinterval):
+				return
+			with hostmonitorlock:
+				if self.users < 1 and time.time() - self.idle > probelinger:
+					del hostmonitors[self.host]
+					return
+	def up(self, since=0):
+		# only a probe made after since can report the host as down
+		return self.status or self.checked < since
+	def release(self):
+		with hostmonitorlock:
+			self.users -= 1
+			if self.users < 1:
+				self.idle = time.time()
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+def hostMonitor(host):
+	with hostmonitorlock:
+		if host not in hostmonitors:
+			hostmonitors[host] = HostMonitor(host)
+		mon = hostmonitors[host]
+		mon.users += 1
+		return mon
+
+def stopHostMonitors():
+	with hostmonitorlock:
+		mons = list(hostmonitors.values())
+		hostmonitors.clear()
+	for mon in mons:
+		mon.stop()
+
+class OutputCapture:
+	# output of a child as it arrives: optionally written to logfile, with
+	# only the last maxsize bytes kept in memory (0 keeps it all), online
+	# called for each line, and any words in watch that appear are in found
+	maxline = 65536
+	def __init__(self, logfile='', maxsize=0, online=None, watch=[]):
+		self.logfile = logfile
+		self.maxsize = maxsize
+		self.online = online
+		self.watch = watch
+		self.found = set()
+		self.chunks = deque()
+		self.size = self.total = 0
+		self.partial = b''
+		self.fp = open(logfile, 'wb') if logfile else None
+	def write(self, data):
+		self.total += len(data)
+		if self.fp:
+			self.fp.write(data)
+		self.chunks.append(data)
+		self.size += len(data)
+		while self.maxsize > 0 and self.size - len(self.chunks[0]) >= self.maxsize:
+			self.size -= len(self.chunks.popleft())
+		if self.online or self.watch:
+			lines = (self.partial + data).split(b'\n')
+			self.partial = lines.pop()
+			if len(self.partial) > self.maxline:
+				lines.append(self.partial)
+				self.partial = b''
+			for line in lines:
+				self.line(ascii(line))
+	def line(self, line):
+		for word in self.watch:
+			if word in line:
+				self.found.add(word)
+		if self.online:
+			self.online(line)
+	def close(self):
+		if self.partial:
+			self.line(ascii(self.partial))
+			self.partial = b''
+		if self.fp:
+			self.fp.close()
+			self.fp = None
+	def text(self):
+		data = b''.join(self.chunks)
+		if self.maxsize > 0 and len(data) > self.maxsize:
+			# drop the partial first line left by the cut
+			data = data[-self.maxsize:]
+			data = data[data.find(b'\n')+1:]
+		return ascii(data)
+	def tail(self, count=10):
+		return '\n'.join(self.text().rstrip('\n').split('\n')[-count:])
+
 class AsyncProcess:
 	saveout = False
 	output = ''
 	complete = False
 	terminated = False
+	eof = False
+	pidfd = -1
+	maxrss = 0
 	cmd = ''
 	timeout = 1800
 	machine = ''
 	starttime = 0
-	def __init__(self, cmdstr, timeout, machine=''):
+	def __init__(self, cmdstr, timeout, machine='', logfile='', maxout=0,
+		online=None, watch=[]):
 		self.cmd = cmdstr
 		self.timeout = timeout
 		self.machine = machine
+		# how saved output is captured, see OutputCapture
+		self.capargs = (logfile, maxout, online, watch)
+		self.capture = None
 	def ping(self, count):
 		if not self.machine:
 			return True
@@ -150,140 +674,303 @@ class AsyncProcess:
 	def terminate(self):
 		self.killProcessTree(self.process.pid)
 		self.terminated = True
-	def processMonitor(self, tid):
-		while self.process.poll() == None:
-			t = int(time.time())
-			if (t - self.starttime) > self.timeout or not self.ping(3):
-				self.terminate()
-				break
-			time.sleep(1)
+	def deadline(self):
+		return self.starttime + self.timeout
+	def read(self):
+		# take whatever is in the pipe, False once the child closes it
+		try:
+			data = os.read(self.process.stdout.fileno(), 65536)
+		except BlockingIOError:
+			return None
+		if not data:
+			self.eof = True
+			return False
+		self.capture.write(data)
+		return True
+	def reap(self, block=False):
+		# wait4 instead of Popen.poll so the peak rss of the tree is known
+		if self.process.returncode != None:
+			return True
+		try:
+			pid, status, ru = os.wait4(self.process.pid, 0 if block else os.WNOHANG)
+		except ChildProcessError:
+			self.process.poll()
+			return True
+		if pid == 0:
+			return False
+		self.process.returncode = os.waitstatus_to_exitcode(status)
+		self.maxrss = ru.ru_maxrss * 1024
+		return True
+	def done(self):
+		if not self.reap():
+			return False
+		return not self.saveout or self.eof
+	def finish(self):
 		if self.saveout:
-			self.output = ascii(self.process.stdout.read())
+			# a killed tree may leave the pipe open, only take what's there
+			os.set_blocking(self.process.stdout.fileno(), False)
+			while self.read():
+				pass
+			self.process.stdout.close()
+			self.capture.close()
+			self.output = self.capture.text()
+		if self.pidfd >= 0:
+			os.close(self.pidfd)
+			self.pidfd = -1
+		self.reap(True)
 		self.complete = True
 	def runcmd(self):
-		self.starttime = int(time.time())
-		out = ''
-		self.complete = self.terminated = False
-		# create system monitor thread and process
-		self.thread = Thread(target=self.processMonitor, args=(0,))
-		self.process = Popen([self.cmd+' 2>&1'], shell=True, stdout=PIPE)
-		# start the process & monitor
-		self.thread.start()
-		for line in self.process.stdout:
-			out += ascii(line)
-		result = self.process.wait()
-		self.complete = True
-		return out
+		mon = hostMonitor(self.machine) if self.machine else None
+		self.runcmdasync(True)
+		sel = selectors.DefaultSelector()
+		sel.register(self.process.stdout, selectors.EVENT_READ)
+		while not self.eof:
+			now = time.time()
+			# the host status is cached, checking it doesn't fork anything
+			if now >= self.deadline() or (mon and not mon.up(self.starttime)):
+				self.terminate()
+				break
+			wait = self.deadline() - now
+			if mon:
+				wait = min(wait, 1)
+			if sel.select(wait):
+				self.read()
+		sel.close()
+		self.finish()
+		if mon:
+			mon.release()
+		return self.output
 	def runcmdasync(self, saveoutput=False):
-		self.starttime = int(time.time())
+		# start the command and return, the caller (e.g. MultiProcess)
+		# watches pidfd and the output pipe and calls finish when done
+		self.starttime = time.time()
 		self.saveout = saveoutput
-		self.complete = self.terminated = False
-		# create system monitor thread and process
-		self.thread = Thread(target=self.processMonitor, args=(0,))
+		self.complete = self.terminated = self.eof = False
+		self.output, self.pidfd = '', -1
+		if self.saveout:
+			self.capture = OutputCapture(*self.capargs)
 		if self.saveout:
 			self.process = Popen([self.cmd+' 2>&1'], shell=True, stdout=PIPE)
 		else:
 			self.process = Popen([self.cmd+' 2>&1'], shell=True)
-		# start the process & monitor
-		self.thread.start()
+		if hasattr(os, 'pidfd_open'):
+			try:
+				self.pidfd = os.pidfd_open(self.process.pid)
+			except OSError:
+				pass
 
 class MultiProcess:
-	pending = []
-	active = []
-	complete = []
-	rmq = []
-	cpus = 0
-	def __init__(self, cmdlist, timeout, verbose=False):
+	# without pidfd support child exits are checked at this interval
+	pollperiod = 0.1
+	def __init__(self, cmdlist, timeout, verbose=False, jobmem=0):
 		self.verbose = verbose
 		self.cpus = self.cpucount()
+		self.admission = Admission(self.cpus, jobmem)
+		self.pending = []
+		self.active = []
+		self.complete = []
+		# cmdlist can be strings or AsyncProcess objects
 		for cmd in cmdlist:
-			self.pending.append(AsyncProcess(cmd, timeout))
+			if not isinstance(cmd, AsyncProcess):
+				cmd = AsyncProcess(cmd, timeout)
+			self.pending.append(cmd)
 	def cpucount(self):
-		cpus = 0
-		fp = open('/proc/cpuinfo', 'r')
-		for line in fp:
-			if re.match('^processor[ \t]*:[ \t]*[0-9]*', line):
-				cpus += 1
-		fp.close()
-		return cpus
-	def emptytrash(self, tgt):
-		for item in self.rmq:
-			tgt.remove(item)
-		self.rmq = []
+		return cpulimit()
+	def start(self, cmd, saveout):
+		if self.verbose:
+			print('START: %s' % cmd.cmd)
+		cmd.runcmdasync(saveout)
+		self.active.append(cmd)
+		if cmd.pidfd >= 0:
+			self.sel.register(cmd.pidfd, selectors.EVENT_READ, cmd)
+		if saveout:
+			self.sel.register(cmd.process.stdout, selectors.EVENT_READ, cmd)
+		heapq.heappush(self.timeouts, (cmd.deadline(), id(cmd), cmd))
+	def unwatch(self, fileobj):
+		try:
+			self.sel.unregister(fileobj)
+		except:
+			pass
+	def stop(self, cmd, fails):
+		self.unwatch(cmd.pidfd)
+		if cmd.saveout:
+			self.unwatch(cmd.process.stdout)
+		cmd.finish()
+		self.admission.record(cmd.maxrss)
+		self.active.remove(cmd)
+		self.complete.append(cmd)
+		if cmd.terminated:
+			fails.append(cmd.cmd)
+		if self.verbose:
+			if cmd.terminated:
+				print('TERMINATED: %s' % cmd.cmd)
+			else:
+				print('COMPLETE: %s' % cmd.cmd)
 	def run(self, count=0, saveout=False):
-		fails = []
-		count = self.cpus if count < 1 else count
+		fails, self.timeouts = [], []
+		self.sel = selectors.DefaultSelector()
+		self.admission.cpus = self.cpus if count < 1 else count
 		while len(self.pending) > 0 or len(self.active) > 0:
+			# fill active queue with pending cmds (pending -> active)
+			while len(self.pending) > 0 and \
+				self.admission.admit([c.process.pid for c in self.active]):
+				self.start(self.pending.pop(0), saveout)
+			# sleep until a child exits, has output, or reaches its timeout
+			while len(self.timeouts) > 0 and self.timeouts[0][2].complete:
+				heapq.heappop(self.timeouts)
+			wait = max(0, self.timeouts[0][0] - time.time())
+			# held back for memory, look again in a bit
+			if len(self.pending) > 0:
+				wait = min(wait, self.admission.recheck)
+			polling = any(cmd.pidfd < 0 for cmd in self.active)
+			if polling:
+				wait = min(wait, self.pollperiod)
+			check = set(self.active) if polling else set()
+			for key, mask in self.sel.select(wait):
+				cmd = key.data
+				if key.fileobj == cmd.pidfd:
+					# the child has exited, the fd stays readable from now on
+					self.sel.unregister(cmd.pidfd)
+				elif cmd.read() == False:
+					self.sel.unregister(key.fileobj)
+				check.add(cmd)
 			# remove completed cmds from active queue (active -> completed)
-			for cmd in self.active:
-				if cmd.complete:
-					self.rmq.append(cmd)
-					self.complete.append(cmd)
-					if cmd.terminated:
-						fails.append(cmd.cmd)
+			for cmd in check:
+				if cmd.done():
+					self.stop(cmd, fails)
+			now = time.time()
+			while len(self.timeouts) > 0 and self.timeouts[0][0] <= now:
+				end, i, cmd = heapq.heappop(self.timeouts)
+				if not cmd.complete:
+					cmd.terminate()
+					self.stop(cmd, fails)
+		self.sel.close()
+		return fails
+
+def forkjob(func, args, memcap, conn):
+	# runs in a process forked from the pool
+	if memcap > 0:
+		resource.setrlimit(resource.RLIMIT_AS, (memcap, memcap))
+	try:
+		ret = 0 if func(*args) != False else 1
+	except MemoryError:
+		ret = 3
+	# tell the pool the peak memory use of this job
+	conn.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+	conn.close()
+	sys.exit(ret)
+
+class ForkPool:
+	# runs python calls in processes forked from this one, so anything
+	# already imported here is never imported again by a job. Each job gets
+	# its own process, killed at timeout, with an optional address space
+	# cap in bytes. retry(job) can return a new job to run in place of a
+	# failed one. Don't use this while other threads are running.
+	def __init__(self, timeout=360, memcap=0, verbose=False, jobmem=0):
+		self.timeout = timeout
+		self.memcap = memcap
+		self.verbose = verbose
+		self.jobmem = jobmem
+		self.ctx = multiprocessing.get_context('fork')
+	def cpucount(self):
+		return cpulimit()
+	def run(self, jobs, count=0, retry=None):
+		# jobs is a list of (func, args), returns the jobs that failed
+		pending, active, fails = list(jobs), dict(), []
+		# a fork starts out sharing all of our pages, they aren't its own
+		self.admission = Admission(count if count > 0 else self.cpucount(),
+			self.jobmem, treerss(os.getpid()))
+		while len(pending) > 0 or len(active) > 0:
+			while len(pending) > 0 and \
+				self.admission.admit([a[0].pid for a in active.values()]):
+				job = pending.pop(0)
+				r, w = self.ctx.Pipe(False)
+				p = self.ctx.Process(target=forkjob,
+					args=(job[0], job[1], self.memcap, w))
+				p.start()
+				w.close()
+				active[p.sentinel] = (p, job, time.time() + self.timeout, r)
+				if self.verbose:
+					print('START: %s%s' % (job[0].__name__, job[1]))
+			wait = max(0, min([a[2] for a in active.values()]) - time.time())
+			# held back for memory, look again in a bit
+			if len(pending) > 0:
+				wait = min(wait, self.admission.recheck)
+			ready = mpwait(list(active), wait)
+			now = time.time()
+			for s in list(active):
+				p, job, end, r = active[s]
+				if s not in ready and now < end:
+					continue
+				if s not in ready:
+					p.kill()
+				p.join()
+				ok = s in ready and p.exitcode == 0
+				p.close()
+				try:
+					if r.poll():
+						self.admission.record(r.recv())
+				except:
+					pass
+				r.close()
+				del active[s]
+				if ok:
 					if self.verbose:
-						if cmd.terminated:
-							print('TERMINATED: %s' % cmd.cmd)
-						else:
-							print('COMPLETE: %s' % cmd.cmd)
-			self.emptytrash(self.active)
-			# fill active queue with pending cmds (pending -> active)
-			for cmd in self.pending:
-				if len(self.active) >= count:
-					break
-				self.rmq.append(cmd)
-				self.active.append(cmd)
+						print('COMPLETE: %s%s' % (job[0].__name__, job[1]))
+					continue
 				if self.verbose:
-					print('START: %s' % cmd.cmd)
-				cmd.runcmdasync(saveout)
-			self.emptytrash(self.pending)
-			time.sleep(1)
+					print('%s: %s%s' % ('FAILED' if s in ready else 'TERMINATED',
+						job[0].__name__, job[1]))
+				newjob = retry(job) if retry else None
+				if newjob:
+					pending.append(newjob)
+				else:
+					fails.append(job)
 		return fails
 
 class AsyncCall:
 	func = 0
 	args = 0
 	result = 0
+	error = ''
 	complete = False
-	def __init__(self, myfunc, myargs):
+	def __init__(self, myfunc, myargs, done=None):
 		self.func = myfunc
 		self.args = myargs
+		self.done = done
 	def wrapper(self, tid):
-		self.result = self.func(*self.args)
-		self.complete = True
+		try:
+			self.result = self.func(*self.args)
+		except (Exception, SystemExit) as e:
+			# result stays 0, the caller checks error for why
+			self.error = '%s: %s' % (type(e).__name__, e)
+		finally:
+			self.complete = True
+			if self.done:
+				self.done.put(self)
 	def run(self):
 		self.thread = Thread(target=self.wrapper, args=(0,))
 		self.thread.start()
 
 class MultiCall:
-	pending = []
-	active = []
-	complete = []
-	rmq = []
 	def __init__(self, func, arglist):
+		self.finished = Queue()
+		self.pending = []
+		self.active = []
+		self.complete = []
 		for args in arglist:
-			self.pending.append(AsyncCall(func, args))
-	def emptytrash(self, tgt):
-		for item in self.rmq:
-			tgt.remove(item)
-		self.rmq = []
+			self.pending.append(AsyncCall(func, args, self.finished))
 	def run(self, count=10):
 		while len(self.pending) > 0 or len(self.active) > 0:
-			# remove completed cmds from active queue (active -> completed)
-			for cmd in self.active:
-				if cmd.complete:
-					self.rmq.append(cmd)
-					self.complete.append(cmd)
-			self.emptytrash(self.active)
 			# fill active queue with pending cmds (pending -> active)
-			for cmd in self.pending:
-				if len(self.active) >= count:
-					break
-				self.rmq.append(cmd)
+			while len(self.pending) > 0 and len(self.active) < count:
+				cmd = self.pending.pop(0)
 				self.active.append(cmd)
 				cmd.run()
-			self.emptytrash(self.pending)
-			time.sleep(1)
+			# block until a call finishes (active -> completed)
+			cmd = self.finished.get()
+			self.active.remove(cmd)
+			self.complete.append(cmd)
 		return
 	def results(self):
 		out = []
@@ -291,6 +978,37 @@ class MultiCall:
 			out.append(cmd.result)
 		return out
 
+class CallQueue:
+	# MultiCall for calls that arrive over time, at most count run at once
+	def __init__(self, count=0):
+		self.slots = Semaphore(count if count > 0 else cpulimit())
+		self.finished = Queue()
+		self.active = []
+	def call(self, func, args):
+		with self.slots:
+			return func(*args)
+	def add(self, func, args):
+		cmd = AsyncCall(self.call, [func, args], self.finished)
+		self.active.append(cmd)
+		cmd.run()
+		return cmd
+	def results(self, block=False):
+		# the calls that have finished since the last check
+		out = []
+		while len(self.active) > 0:
+			try:
+				cmd = self.finished.get(block and len(out) == 0)
+			except Empty:
+				break
+			self.active.remove(cmd)
+			out.append(cmd)
+		return out
+	def stop(self):
+		out = []
+		while len(self.active) > 0:
+			out += self.results(True)
+		return out
+
 # ----------------- MAIN --------------------
 # exec start (skipped if script is loaded as library)
 if __name__ == '__main__':
@@ -301,10 +1019,38 @@ if __name__ == '__main__':
 		help='Timeout in seconds for each process')
 	parser.add_argument('-multi', metavar='number', type=int, default=0,
 		help='Maximum concurrent processes to be run')
-	parser.add_argument('cmdfile', metavar='file',
+	parser.add_argument('-jobmem', metavar='MB', type=int, default=0,
+		help='Expected peak memory of each process, until one has finished')
+	parser.add_argument('-limits', action='store_true',
+		help='Print the cpu and memory limits used to admit processes')
+	parser.add_argument('-bench', metavar='number', type=int, default=0,
+		help='Time the scheduler on this many short commands (cmdfile not needed)')
+	parser.add_argument('cmdfile', metavar='file', nargs='?',
 		help='A text file with the list of commands to be run')
 	args = parser.parse_args()
 
+	if args.limits:
+		avail, cgfree = memavailable(), cgroupmem()
+		print('cpus      : %d usable (%d in affinity mask, cgroup quota %s)' % \
+			(cpulimit(), len(os.sched_getaffinity(0)), cgroupcpus() or 'none'))
+		print('memory    : %d MB available (cgroup headroom %s)' % (avail >> 20,
+			'%d MB' % (cgfree >> 20) if cgfree >= 0 else 'none'))
+		print('pressure  : %.2f%% (new jobs wait above %.0f%%)' % \
+			(mempressure(), Admission.pressure))
+		sys.exit(0)
+	if args.bench > 0:
+		start = time.time()
+		mp = MultiProcess(['true'] * args.bench, args.timeout)
+		fails = mp.run(args.multi, True)
+		t = time.time() - start
+		print('%d commands, %d at a time: %.3fs total, %.2fms per command, %d failed' % \
+			(args.bench, args.multi if args.multi > 0 else mp.cpus, t,
+			t * 1000 / args.bench, len(fails)))
+		sys.exit(0)
+	if not args.cmdfile:
+		parser.print_help()
+		sys.exit(1)
+
 	commands = []
 	try:
 		fp = open(args.cmdfile, 'r')
@@ -316,5 +1062,5 @@ if __name__ == '__main__':
 		print('ERROR: failed to read cmdfile %s' % args.cmdfile)
 		sys.exit(1)
 
-	mp = MultiProcess(commands, args.timeout, True)
+	mp = MultiProcess(commands, args.timeout, True, args.jobmem * 1024 * 1024)
 	mp.run(args.multi)
@@ -23,7 +23,13 @@ import os
 import sys
 import re
 import time
-from subprocess import call, Popen, PIPE
+import fcntl
+import socket
+import random
+import os.path as op
+from queue import Queue
+from threading import Thread, Condition
+from subprocess import call, Popen, PIPE, DEVNULL
 from lib.parallel import AsyncProcess, AsyncCall
 
 class RemoteMachine:
@@ -37,6 +43,15 @@ class RemoteMachine:
 	grubfile = '/etc/default/grub'
 	grubfileorig = '/etc/default/grub.stresstest.orig'
 	grubfilemine = '/etc/default/grub.stresstest'
+	# ssh/scp/rsync share one persistent connection per machine, except
+	# commands that span a suspend or reboot, the master's keepalive gives
+	# up on a machine that's asleep and takes its sessions down with it
+	multiplex = True
+	muxpersist = 600
+	muxcheck = 30
+	# boot polling starts at bootpoll seconds and backs off to bootpollmax
+	bootpoll = 1
+	bootpollmax = 8
 	def __init__(self, user, host, addr, reset=None, on=None, off=None,
 		dstart=None, dstop=None, reserve=None, release=None):
 		self.user = user
@@ -49,6 +64,76 @@ class RemoteMachine:
 		self.dstopcmd = dstop
 		self.reservecmd = reserve
 		self.releasecmd = release
+		self.muxchecked = 0
+		self.muxup = False
+		self.lastbootid = ''
+		self.rebooting = False
+		self.boottime = 0
+	def muxpath(self):
+		dir = '/tmp/pm-graph-ssh-%d' % os.getuid()
+		if not os.path.isdir(dir):
+			try:
+				os.makedirs(dir, 0o700)
+			except:
+				pass
+		return '%s/%s@%s' % (dir, self.user, self.addr)
+	def muxctl(self, op):
+		cmd = ['ssh', '-oControlPath=%s' % self.muxpath(), '-O', op,
+			'%s@%s' % (self.user, self.addr)]
+		try:
+			return call(cmd, stdin=DEVNULL, stdout=DEVNULL,
+				stderr=DEVNULL, timeout=10) == 0
+		except:
+			return False
+	def mux_start(self):
+		cmd = ['ssh', '-MNf', '-oBatchMode=yes', '-oStrictHostKeyChecking=no',
+			'-oConnectTimeout=10', '-oControlPath=%s' % self.muxpath(),
+			'-oControlPersist=%d' % self.muxpersist,
+			'-oServerAliveInterval=10', '-oServerAliveCountMax=3',
+			'%s@%s' % (self.user, self.addr)]
+		try:
+			# -f backgrounds the master once it has authenticated
+			return call(cmd, stdin=DEVNULL, stdout=DEVNULL,
+				stderr=DEVNULL, timeout=30) == 0
+		except:
+			return False
+	def mux_check(self):
+		path = self.muxpath()
+		if self.muxctl('check'):
+			return True
+		# a master that was killed leaves its socket behind
+		if os.path.exists(path):
+			try:
+				os.remove(path)
+			except:
+				pass
+		return False
+	def mux_stop(self):
+		if os.path.exists(self.muxpath()):
+			self.muxctl('exit')
+		self.muxup = False
+		self.muxchecked = 0
+	def mux(self):
+		if not self.multiplex:
+			return False
+		now = time.time()
+		if now - self.muxchecked < self.muxcheck:
+			return self.muxup
+		# other processes may be driving the same machine
+		lock = open(self.muxpath()+'.lock', 'w')
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		self.muxup = self.mux_check() or \
+			(self.ping(3) and self.mux_start() and self.mux_check())
+		fcntl.flock(lock, fcntl.LOCK_UN)
+		lock.close()
+		self.muxchecked = time.time()
+		return self.muxup
+	def sshopts(self):
+		# only use the socket once the master is known to be up, ssh
+		# falls back to a direct connection if it goes away later
+		if not self.mux():
+			return ''
+		return '-oControlMaster=no -oControlPath=%s' % self.muxpath()
 	def sshcopyid(self, userinput):
 		if userinput:
 			res = call('ssh-copy-id %s@%s' % (self.user, self.addr), shell=True)
@@ -105,22 +190,28 @@ class RemoteMachine:
 	def setupordie(self):
 		if not self.setup():
 			sys.exit(1)
-	def sshproc(self, cmd, timeout=60, userinput=False, ping=True):
+	def sshproc(self, cmd, timeout=60, userinput=False, ping=True, mux=True):
 		if userinput:
 			cmdfmt = 'ssh %s@%s -oStrictHostKeyChecking=no "{0}"'
 		else:
-			cmdfmt = 'nohup ssh -oBatchMode=yes -oStrictHostKeyChecking=no %s@%s "{0}"'
-		cmdline = (cmdfmt % (self.user, self.addr)).format(cmd)
+			cmdfmt = 'nohup ssh %s -oBatchMode=yes -oStrictHostKeyChecking=no %s@%s "{0}"'
+		if userinput:
+			cmdline = (cmdfmt % (self.user, self.addr)).format(cmd)
+		else:
+			cmdline = (cmdfmt % (self.sshopts() if mux else '',
+				self.user, self.addr)).format(cmd)
 		if ping:
 			return AsyncProcess(cmdline, timeout, self.addr)
 		return AsyncProcess(cmdline, timeout)
-	def sshcmd(self, cmd, timeout=60, fatal=False, userinput=False, ping=True):
-		ap = self.sshproc(cmd, timeout, userinput, ping)
+	def sshcmd(self, cmd, timeout=60, fatal=False, userinput=False, ping=True, mux=True):
+		ap = self.sshproc(cmd, timeout, userinput, ping, mux)
 		out = ap.runcmd()
 		if out.startswith('nohup:'):
 			tmp = out.split('\n')
 			out = '\n'.join(tmp[1:])
 		if ap.terminated:
+			# the connection may be dead, recheck the master next time
+			self.muxchecked = 0
 			if fatal:
 				print('SSH TIMEOUT: %s' % cmd)
 				self.die()
@@ -128,11 +219,28 @@ class RemoteMachine:
 				return('SSH TIMEOUT: %s' % cmd)
 		return out
 	def scpfile(self, file, dir):
-		res = call('scp %s %s@%s:%s/' % (file, self.user, self.addr, dir), shell=True)
+		res = call('scp %s %s %s@%s:%s/' % (self.sshopts(), file,
+			self.user, self.addr, dir), shell=True)
 		return res == 0
 	def scpfileget(self, file, dir):
-		res = call('scp %s@%s:%s %s/' % (self.user, self.addr, file, dir), shell=True)
+		res = call('scp %s %s@%s:%s %s/' % (self.sshopts(),
+			self.user, self.addr, file, dir), shell=True)
 		return res == 0
+	def rsyncget(self, src, dst, timeout=1800):
+		return AsyncProcess('rsync -ur -e "ssh %s" %s@%s:%s %s' % \
+			(self.sshopts(), self.user, self.addr, src, dst), timeout)
+	def manifest(self, dir):
+		# sizes of the files under a remote folder, None if ssh failed
+		cmd = 'cd %s 2>/dev/null && find . -type f -printf \'%%s %%P\\n\'; '\
+			'echo MANIFEST-END' % dir
+		out, files = self.sshcmd(cmd, 60), dict()
+		if 'MANIFEST-END' not in out:
+			return None
+		for line in out.split('\n'):
+			v = line.strip().split(' ', 1)
+			if len(v) == 2 and v[0].isdigit():
+				files[v[1]] = int(v[0])
+		return files
 	def openshell(self):
 		call('ssh -X %s@%s' % (self.user, self.addr), shell=True)
 	def sshcmdfancy(self, cmd, timeout, fatal=True):
@@ -456,7 +564,8 @@ class RemoteMachine:
 				self.data_stop_collection(serialout)
 			self.die()
 		print('RESTARTING %s...' % self.host)
-		i, rebooted = 0, False
+		self.mux_stop()
+		rebooted = False
 		if (self.wmac and self.wip) or (self.emac and self.eip):
 			self.wakeonlan()
 		elif not self.resetcmd:
@@ -467,24 +576,72 @@ class RemoteMachine:
 		else:
 			self.reset_machine()
 			rebooted = True
-		while not self.ping(3):
-			if i >= 30:
-				print('Machine is dead: %s' % self.host)
-				if serialout:
-					self.data_stop_collection(serialout)
-				self.die()
-			elif i != 0 and i % 10 == 0:
+		# a woken machine keeps its boot id, any answer will do
+		for i in range(3):
+			if i > 0:
 				print('restarting again...')
 				self.reset_machine()
 				rebooted = True
-			time.sleep(10)
-			i += 1
+			if self.wait_ready(130, False):
+				break
+		else:
+			print('Machine is dead: %s' % self.host)
+			if serialout:
+				self.data_stop_collection(serialout)
+			self.die()
 		if not rebooted:
 			# wait a few seconds to allow sleepgraph to finish
 			time.sleep(10)
 			return
 		self.bootsetup()
 		self.wifisetup(True)
+	def port_open(self, port=22, timeout=2):
+		try:
+			socket.create_connection((self.addr, port), timeout).close()
+		except:
+			return False
+		return True
+	def bootinfo(self, timeout=20):
+		# (kernel release, boot id) or None if ssh isn't working yet
+		out = self.sshcmd('uname -r; cat /proc/sys/kernel/random/boot_id',
+			timeout, False, False, False).strip().split('\n')
+		if len(out) < 2:
+			return None
+		kver, id = out[-2].strip(), out[-1].strip()
+		if not kver or ' ' in kver or \
+			not re.match(r'^[0-9a-f]{8}-[0-9a-f-]{27}$', id):
+			return None
+		return (kver, id)
+	def sshreboot(self, cmd='sudo shutdown -r now', timeout=60):
+		# note the boot id so wait_ready doesn't mistake the old boot for the new
+		info = self.bootinfo()
+		self.lastbootid = info[1] if info else ''
+		self.rebooting = True
+		out = self.sshcmd(cmd, timeout, mux=False)
+		self.mux_stop()
+		return out
+	def wait_ready(self, timeout, newboot=True):
+		# poll until sshd answers, after an sshreboot it must be on a new
+		# boot: a different boot id, or if the old one couldn't be read,
+		# sshd has to go away first. returns the kernel or '' on timeout
+		start, delay, down = time.time(), self.bootpoll, False
+		while True:
+			if not self.port_open():
+				down = True
+			else:
+				info = self.bootinfo()
+				if info and (not newboot or not self.rebooting or \
+					(info[1] != self.lastbootid if self.lastbootid else down)):
+					# only the next sshreboot should arm the boot check
+					self.boottime = time.time() - start
+					self.lastbootid, self.rebooting = '', False
+					print('%s ready in %.1fs' % (self.host, self.boottime))
+					return info[0]
+			left = timeout - (time.time() - start)
+			if left <= 0:
+				return ''
+			time.sleep(min(left, delay * random.uniform(0.5, 1.5)))
+			delay = min(delay * 2, self.bootpollmax)
 	def reboot(self, kver, default=False):
 		os = self.oscheck()
 		if os in ['ubuntu']:
@@ -495,35 +652,93 @@ class RemoteMachine:
 				else:
 					self.sshcmd('sudo grub-reboot \'1>%s\'' % uuid, 60)
 		print('REBOOTING %s...' % self.host)
-		print(self.sshcmd('sudo shutdown -r now', 60))
+		print(self.sshreboot())
 	def wait_for_boot(self, kver, timeout):
-		error, start = 'offline', time.time()
-		time.sleep(10)
-		while (time.time() - start < timeout):
-			error = self.checkhost(False)
-			if not error:
-				break
+		k = self.wait_ready(timeout)
+		if not k:
+			return 'offline'
+		error = self.checkhost(False)
 		if error:
 			return error
-		if kver:
-			k = self.kernel_version()
-			if k != kver:
-				return 'wrong kernel (tgt=%s, actual=%s)' % (kver, k)
+		if kver and k != kver:
+			return 'wrong kernel (tgt=%s, actual=%s)' % (kver, k)
 		return ''
 	def reboot_or_die(self, kver, default=False):
 		self.bootsetup()
 		self.reboot(kver, default)
-		time.sleep(20)
-		i = 0
-		while not self.ping(3):
-			if i >= 15:
-				print('Machine failed to come back: %s' % self.host)
-				self.die()
-			time.sleep(10)
-			i += 1
+		if not self.wait_ready(240):
+			print('Machine failed to come back: %s' % self.host)
+			self.die()
 		self.bootsetup()
 		self.wifisetup(True)
 		print('Machine is back: %s' % self.host)
 	def die(self):
 		self.release_machine()
+		self.mux_stop()
 		sys.exit(1)
+
+class TransferQueue:
+	# copies remote folders to local ones in a background thread so
+	# the caller can keep using the machine, each copy is retried until
+	# the local files match the sizes in the remote manifest
+	retries = 3
+	retrydelay = 10
+	def __init__(self, machine, timeout=300):
+		self.m = machine
+		self.timeout = timeout
+		self.queue = Queue()
+		self.status = dict()
+		self.cond = Condition()
+		self.failed = []
+		self.thread = Thread(target=self.worker, daemon=True)
+		self.thread.start()
+	def add(self, src, dst, manifest=None):
+		with self.cond:
+			self.status[src] = 'queued'
+		self.queue.put((src, dst, manifest))
+	def verify(self, dst, manifest):
+		for file in manifest:
+			local = op.join(dst, file)
+			if not op.exists(local) or op.getsize(local) != manifest[file]:
+				return False
+		return True
+	def copy(self, src, dst, manifest):
+		local = op.join(dst, op.basename(src.rstrip('/')))
+		for i in range(self.retries):
+			if i > 0:
+				time.sleep(self.retrydelay * i)
+			ap = self.m.rsyncget(src, dst, self.timeout)
+			ap.runcmd()
+			if ap.terminated or ap.process.returncode != 0:
+				continue
+			if manifest is None or self.verify(local, manifest):
+				return True
+		return False
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			src, dst, manifest = item
+			ok = self.copy(src, dst, manifest)
+			with self.cond:
+				self.status[src] = 'done' if ok else 'failed'
+				if not ok:
+					self.failed.append(src)
+				self.cond.notify_all()
+	def wait(self, src=''):
+		# block until src (or everything queued) is done, True if it worked
+		with self.cond:
+			while True:
+				if src:
+					state = self.status.get(src, 'done')
+				else:
+					state = 'queued' if 'queued' in self.status.values() else 'done'
+				if state != 'queued':
+					return state == 'done'
+				self.cond.wait()
+	def stop(self):
+		self.wait()
+		self.queue.put(None)
+		self.thread.join()
+		return len(self.failed) == 0
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# TestIndex library
+# Copyright (c) 2020, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Authors:
+#    Todd Brandt <todd.e.brandt@linux.intel.com>
+#
+# Description:
+#    Fast discovery of multitest folders in large data trees. Directory
+#    listings are kept in a persistent index along with their mtimes, so
+#    repeat scans only list the directories that have changed, and test
+#    folders (suspend-YYMMDD-HHMMSS) are never descended into.
+
+import os
+import re
+import json
+import fcntl
+import os.path as op
+
+testre = re.compile('suspend-[0-9]*-[0-9]*$')
+
+def defaultpaths():
+	home = os.getenv('HOME')
+	if not home:
+		return ('', '')
+	return (op.join(home, '.multitests.idx'), op.join(home, '.multitests'))
+
+def isunder(path, folder):
+	return path == folder or path.startswith(folder.rstrip('/')+'/')
+
+class TestIndex:
+	version = 1
+	def __init__(self, file='', textfile=''):
+		self.file = file
+		# abspath -> [mtime_ns, is multitest, non-test subdirs]
+		self.dirs = dict()
+		self.updated = set()
+		self.removed = set()
+		self.listed = self.stats = 0
+		if file:
+			self.dirs = self.read()
+			if not op.exists(file) and textfile and op.exists(textfile):
+				self.importtext(textfile)
+	def read(self):
+		if not self.file or not op.exists(self.file):
+			return dict()
+		try:
+			with open(self.file, 'r') as fp:
+				data = json.load(fp)
+		except:
+			return dict()
+		if not isinstance(data, dict) or data.get('version') != self.version:
+			return dict()
+		return data.get('dirs', dict())
+	def writable(self):
+		if not self.file:
+			return False
+		if op.exists(self.file):
+			return os.access(self.file, os.W_OK)
+		return os.access(op.dirname(op.abspath(self.file)), os.W_OK)
+	def save(self):
+		if not self.writable() or (not self.updated and not self.removed):
+			return False
+		lock = open(self.file+'.lock', 'w')
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		# merge our changes into whatever other processes have written
+		dirs = self.read()
+		for dir in self.removed:
+			if dir in dirs:
+				del dirs[dir]
+		for dir in self.updated:
+			if dir in self.dirs:
+				dirs[dir] = self.dirs[dir]
+		tmp = '%s.%d' % (self.file, os.getpid())
+		with open(tmp, 'w') as fp:
+			json.dump({'version': self.version, 'dirs': dirs}, fp)
+		os.rename(tmp, self.file)
+		fcntl.flock(lock, fcntl.LOCK_UN)
+		lock.close()
+		self.dirs = dirs
+		self.updated, self.removed = set(), set()
+		return True
+	def importtext(self, file):
+		with open(file, 'r') as fp:
+			self.add([line.strip() for line in fp if line.strip()])
+	def add(self, multitests):
+		for dir in multitests:
+			dir = op.abspath(dir)
+			if dir in self.dirs and self.dirs[dir][1]:
+				continue
+			# mtime 0 forces a real listing on the next scan
+			self.dirs[dir] = [0, True, []]
+			self.updated.add(dir)
+			self.removed.discard(dir)
+	def drop(self, dir):
+		if dir in self.dirs:
+			del self.dirs[dir]
+			self.removed.add(dir)
+		self.updated.discard(dir)
+	def listdir(self, dir, mtime):
+		multi, subdirs = False, []
+		self.listed += 1
+		try:
+			with os.scandir(dir) as it:
+				for e in it:
+					try:
+						if not e.is_dir():
+							continue
+					except OSError:
+						continue
+					if testre.match(e.name):
+						multi = True
+					else:
+						subdirs.append(e.name)
+		except OSError:
+			pass
+		entry = [mtime, multi, sorted(subdirs)]
+		self.dirs[dir] = entry
+		self.updated.add(dir)
+		return entry
+	def scan(self, folder, cb=None):
+		folder = op.abspath(folder)
+		out, visited, listings = [], set(), dict()
+		# each folder goes on the stack with the folders above it
+		stack = [(folder, ())]
+		while len(stack) > 0:
+			dir, parents = stack.pop()
+			self.stats += 1
+			try:
+				st = os.stat(dir)
+			except OSError:
+				continue
+			# symlinks are followed and every path is walked, a folder
+			# that is one of its own parents is a loop and is skipped
+			key = (st.st_dev, st.st_ino)
+			if key in parents:
+				continue
+			visited.add(dir)
+			entry = self.dirs.get(dir)
+			if not entry or entry[0] != st.st_mtime_ns:
+				# another path to a folder listed in this scan reuses it
+				if key in listings and listings[key][0] == st.st_mtime_ns:
+					entry = self.dirs[dir] = list(listings[key])
+					self.updated.add(dir)
+				else:
+					entry = self.listdir(dir, st.st_mtime_ns)
+			listings[key] = entry
+			if entry[1]:
+				out.append(dir)
+				if cb:
+					cb(dir)
+			for sub in reversed(entry[2]):
+				stack.append((op.join(dir, sub), parents + (key,)))
+		# forget anything under this folder that has gone away
+		for dir in list(self.dirs):
+			if isunder(dir, folder) and dir not in visited:
+				self.drop(dir)
+		return out
+	def roots(self, folder):
+		folder, out = op.abspath(folder), []
+		for dir in sorted(self.dirs):
+			if self.dirs[dir][1] and isunder(dir, folder) and op.exists(dir):
+				out.append(dir)
+		return out
+
+def scanlinks(folder):
+	# yield (path, target) for every directory symlink under folder,
+	# symlinks are not followed
+	stack = [folder]
+	while len(stack) > 0:
+		dir = stack.pop()
+		try:
+			entries = sorted(os.scandir(dir), key=lambda e:e.name, reverse=True)
+		except OSError:
+			continue
+		for e in entries:
+			try:
+				if e.is_symlink():
+					if e.is_dir():
+						yield (e.path, os.readlink(e.path))
+				elif e.is_dir(follow_symlinks=False):
+					stack.append(e.path)
+			except OSError:
+				continue
+
+# ----------------- MAIN --------------------
+# exec start (skipped if script is loaded as library)
+if __name__ == '__main__':
+	import argparse
+
+	dfile, tfile = defaultpaths()
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-index', metavar='file', default=dfile,
+		help='multitest index file (default: ~/.multitests.idx)')
+	parser.add_argument('-scan', metavar='folder',
+		help='scan a folder for multitests and update the index')
+	parser.add_argument('-list', metavar='folder', nargs='?', const='/',
+		help='list the indexed multitests under a folder (default: all)')
+	args = parser.parse_args()
+
+	index = TestIndex(args.index, tfile if args.index == dfile else '')
+	if args.scan:
+		out = index.scan(args.scan)
+		index.save()
+		print('%d multitests found (%d dirs checked, %d listed)' % \
+			(len(out), index.stats, index.listed))
+	if args.list:
+		for dir in index.roots(args.list):
+			print(dir)
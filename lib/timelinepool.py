@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# TimelinePool library
+# Copyright (c) 2020, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Authors:
+#    Todd Brandt <todd.e.brandt@linux.intel.com>
+#
+# Description:
+#    Regenerate sleepgraph html timelines from dmesg/ftrace logs in a pool
+#    of processes forked from one which has already imported sleepgraph,
+#    instead of starting a new interpreter for each one.
+
+import os
+import sys
+import os.path as op
+# sleepgraph and lib are in the pm-graph folder above this one
+pmgraph = op.dirname(op.dirname(op.realpath(__file__)))
+if pmgraph not in sys.path:
+	sys.path.insert(0, pmgraph)
+from lib.parallel import ForkPool
+import sleepgraph
+
+def regen_timeline(dmesg, ftrace, dev=True):
+	# same as: sleepgraph -dmesg dmesg -ftrace ftrace [-dev -skipkprobe udelay]
+	dev = dev and ftrace
+	res = sleepgraph.analyze(dmesg, ftrace, options={'usedevsrc': dev},
+		skipkprobe='udelay' if dev and dmesg else '', quiet=False)
+	return len(res.testruns) > 0
+
+def retry_without_dev(job):
+	# a timeline that fails or times out with -dev is retried without it
+	func, args = job
+	dmesg, ftrace, dev = args
+	if not dev:
+		return None
+	return (func, (dmesg, ftrace, False))
+
+def regen_timelines(files, count=0, timeout=360, memcap=0, verbose=False,
+	jobmem=0):
+	# files is a list of (dmesg, ftrace), returns the pairs that failed.
+	# count 0 runs as many as the cpus and memory allow
+	pool = ForkPool(timeout, memcap, verbose, jobmem)
+	jobs = [(regen_timeline, (d, f, True)) for d, f in files]
+	fails = pool.run(jobs, count, retry_without_dev)
+	return [(args[0], args[1]) for func, args in fails]
+
+# ----------------- MAIN --------------------
+# exec start (skipped if script is loaded as library)
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-timeout', metavar='seconds', type=int, default=360,
+		help='Timeout in seconds for each timeline')
+	parser.add_argument('-multi', metavar='number', type=int, default=0,
+		help='Maximum concurrent timelines (default: cpu count)')
+	parser.add_argument('-memcap', metavar='MB', type=int, default=0,
+		help='Address space limit for each timeline in MB')
+	parser.add_argument('-jobmem', metavar='MB', type=int, default=0,
+		help='Expected peak memory of each timeline, until one has finished')
+	parser.add_argument('folder',
+		help='Folder containing sleepgraph test output')
+	args = parser.parse_args()
+
+	files = []
+	for dirname, dirnames, filenames in os.walk(args.folder):
+		dmesg = ftrace = ''
+		for filename in filenames:
+			if filename.endswith('_dmesg.txt') or filename.endswith('_dmesg.txt.gz'):
+				dmesg = op.join(dirname, filename)
+			elif filename.endswith('_ftrace.txt') or filename.endswith('_ftrace.txt.gz'):
+				ftrace = op.join(dirname, filename)
+		if dmesg and ftrace:
+			files.append((dmesg, ftrace))
+	fails = regen_timelines(files, args.multi, args.timeout,
+		args.memcap * 1024 * 1024, True, args.jobmem * 1024 * 1024)
+	print('%d timelines, %d failed' % (len(files), len(fails)))
+	sys.exit(1 if len(fails) > 0 else 0)
@@ -58,11 +58,13 @@ import re
 import platform
 import signal
 import codecs
+import copy
+import contextvars
 from datetime import datetime, timedelta
 import struct
 import configparser
 import gzip
-from threading import Thread
+from threading import Thread, Event
 from subprocess import call, Popen, PIPE
 import base64
 import traceback
@@ -83,8 +85,8 @@ def ascii(text):
 
 # Class: SystemValues
 # Description:
-#	 A global, single-instance container used to
-#	 store system values and test parameters
+#	 A container used to store system values and test parameters,
+#	 the global instance is used by the command line tool
 class SystemValues:
 	title = 'SleepGraph'
 	version = '5.13'
@@ -171,6 +173,7 @@ class SystemValues:
 	usekprobes = True
 	usedevsrc = False
 	useprocmon = False
+	procinterval = 100
 	notestrun = False
 	cgdump = False
 	devdump = False
@@ -381,11 +384,21 @@ class SystemValues:
 	cmdline = '%s %s' % \
 			(os.path.basename(sys.argv[0]), ' '.join(sys.argv[1:]))
 	sudouser = ''
-	def __init__(self):
+	errormsg = ''
+	# class defaults which are modified in place, copied for each instance
+	mutables = ['multitest', 'devprops', 'cfgdef', 'platinfo', 'traceevents',
+		'tracefuncs', 'dev_tracefuncs', 'devicefilter', 'cgfilter',
+		'cgblacklist', 'kprobes']
+	def __init__(self, probe=True):
+		for name in self.mutables:
+			setattr(self, name, copy.deepcopy(getattr(self, name)))
 		self.archargs = 'args_'+platform.machine()
 		self.hostname = platform.node()
 		if(self.hostname == ''):
 			self.hostname = 'localhost'
+		# parsing existing logs doesn't need anything from this system
+		if not probe:
+			return
 		rtc = "rtc0"
 		if os.path.exists('/dev/rtc'):
 			rtc = os.readlink('/dev/rtc')
@@ -973,6 +986,8 @@ class SystemValues:
 				fp.write('# wifi %s\n' % test['wifi'])
 			if 'netfix' in test:
 				fp.write('# netfix %s\n' % test['netfix'])
+			if 'procmon' in test:
+				fp.write('# procmon %s\n' % test['procmon'])
 			if test['error'] or len(testdata) > 1:
 				fp.write('# enter_sleep_error %s\n' % test['error'])
 		return fp
@@ -1469,7 +1484,20 @@ class SystemValues:
 			self.dlog('stop ftrace tracing')
 			self.fsetVal('0', 'tracing_on')
 
-sysvals = SystemValues()
+# Class: ContextValues
+# Description:
+#	 Stands in for the SystemValues of the running context, attributes
+#	 are read from and written to the instance given to runWith in this
+#	 thread, or to the global instance used by the command line tool
+class ContextValues:
+	__slots__ = ()
+	def __getattribute__(self, name):
+		return getattr(currentvals.get(), name)
+	def __setattr__(self, name, value):
+		setattr(currentvals.get(), name, value)
+
+currentvals = contextvars.ContextVar('sysvals', default=SystemValues())
+sysvals = ContextValues()
 switchvalues = ['enable', 'disable', 'on', 'off', 'true', 'false', '1', '0']
 switchoff = ['disable', 'off', 'false', '0']
 suspendmodename = {
@@ -1599,6 +1627,7 @@ class Data:
 		self.enterfail = ''
 		self.currphase = ''
 		self.pstl = dict()    # process timeline
+		self.procinterval = 0 # process monitor sample interval
 		self.testnumber = num
 		self.idstr = idchar[num]
 		self.dmesgtext = []   # dmesg text file in memory
@@ -2227,6 +2256,10 @@ class Data:
 				tlast = t
 				continue
 			if name in self.pstl[t] and self.pstl[t][name] > 0:
+				# idle samples aren't logged, so a sample covers at most
+				# one interval back from its marker
+				if self.procinterval > 0:
+					tlast = max(tlast, t - self.procinterval)
 				if start < 0:
 					start = tlast
 				end, key = t, (tlast, t)
@@ -3079,6 +3112,7 @@ class TestProps:
 	pinfofmt   = r'# platform-(?P<val>[a-z,A-Z,0-9,_]*): (?P<info>.*)'
 	tracertypefmt = r'# tracer: (?P<t>.*)'
 	firmwarefmt = r'# fwsuspend (?P<s>[0-9]*) fwresume (?P<r>[0-9]*)$'
+	procmonfmt = r'^# procmon interval (?P<i>[0-9]*)ms (?P<stat>.*)'
 	procexecfmt = r'ps - (?P<ps>.*)$'
 	procmultifmt = r'@(?P<n>[0-9]*)\|(?P<ps>.*)$'
 	ftrace_line_fmt_fg = \
@@ -3101,6 +3135,7 @@ class TestProps:
 		self.turbostat = []
 		self.wifi = []
 		self.fwdata = []
+		self.procmon = ''
 		self.ftrace_line_fmt = self.ftrace_line_fmt_nop
 		self.cgformat = False
 		self.data = 0
@@ -3132,6 +3167,9 @@ class TestProps:
 		elif re.match(self.firmwarefmt, line):
 			self.fwdata.append(line)
 			return True
+		elif re.match(self.procmonfmt, line):
+			self.procmon = line
+			return True
 		elif(re.match(self.devpropfmt, line)):
 			self.parseDevprops(line, sv)
 			return True
@@ -3206,6 +3244,10 @@ class TestProps:
 				data.wifi = {'dev': m.group('d'), 'stat': m.group('s'),
 					'time': float(m.group('t'))}
 				data.stamp['wifi'] = m.group('d')
+		# process monitor sample interval
+		m = re.match(self.procmonfmt, self.procmon)
+		if m:
+			data.procinterval = int(m.group('i')) / 1000.0
 		# sleep mode enter errors
 		if len(self.testerror) > data.testnumber:
 			m = re.match(self.testerrfmt, self.testerror[data.testnumber])
@@ -3264,31 +3306,54 @@ class TestRun:
 
 class ProcessMonitor:
 	maxchars = 512
-	def __init__(self):
+	def __init__(self, interval=100):
 		self.proclist = dict()
 		self.running = False
+		self.interval = interval / 1000.0
+		self.event = Event()
+		self.fd = -1
+		self.samples = self.writes = 0
+		self.cputime = self.elapsed = 0.0
+	def readstat(self, pid):
+		try:
+			with open('/proc/%s/stat' % pid, 'rb') as fp:
+				data = fp.read()
+		except:
+			return None
+		# the name can hold spaces and parens, so split after the last ')'
+		i, j = data.find(b'('), data.rfind(b')')
+		f = data[j+2:].split()
+		if i < 0 or j < i or len(f) < 13:
+			return None
+		name = re.sub('[ ,]', '_', data[i+1:j].decode('utf-8', 'ignore'))
+		return (name, int(f[11]), int(f[12]))
 	def procstat(self):
-		c = ['cat /proc/[1-9]*/stat 2>/dev/null']
-		process = Popen(c, shell=True, stdout=PIPE)
-		running = dict()
-		for line in process.stdout:
-			data = ascii(line).split()
-			pid = data[0]
-			name = re.sub('[()]', '', data[1])
-			user = int(data[13])
-			kern = int(data[14])
-			kjiff = ujiff = 0
-			if pid not in self.proclist:
-				self.proclist[pid] = {'name' : name, 'user' : user, 'kern' : kern}
-			else:
-				val = self.proclist[pid]
-				ujiff = user - val['user']
-				kjiff = kern - val['kern']
-				val['user'] = user
-				val['kern'] = kern
-			if ujiff > 0 or kjiff > 0:
-				running[pid] = ujiff + kjiff
-		process.wait()
+		running, proclist = dict(), dict()
+		try:
+			it = os.scandir('/proc')
+		except:
+			return
+		with it:
+			for e in it:
+				if not e.name.isdigit():
+					continue
+				pid, stat = e.name, self.readstat(e.name)
+				if not stat:
+					continue
+				name, user, kern = stat
+				# pids are only compared against the last sample, which
+				# also keeps a reused pid from inheriting old counts
+				if pid in self.proclist and self.proclist[pid]['name'] == name:
+					val = self.proclist[pid]
+					jiffies = (user - val['user']) + (kern - val['kern'])
+					if jiffies > 0:
+						running[pid] = jiffies
+				proclist[pid] = {'name' : name, 'user' : user, 'kern' : kern}
+		self.proclist = proclist
+		self.samples += 1
+		# only the processes which ran since the last sample are logged
+		if len(running) < 1:
+			return
 		out = ['']
 		for pid in running:
 			jiffies = running[pid]
@@ -3300,18 +3365,49 @@ class ProcessMonitor:
 			out[-1] += '%s-%s %d' % (val['name'], pid, jiffies)
 		if len(out) > 1:
 			for line in out:
-				sysvals.fsetVal('ps - @%d|%s' % (len(out), line), 'trace_marker')
+				self.mark('ps - @%d|%s' % (len(out), line))
 		else:
-			sysvals.fsetVal('ps - %s' % out[0], 'trace_marker')
+			self.mark('ps - %s' % out[0])
+	def mark(self, msg):
+		try:
+			os.write(self.fd, msg.encode())
+			self.writes += 1
+		except:
+			pass
 	def processMonitor(self, tid):
+		cpu, tnext = time.thread_time(), time.time()
 		while self.running:
 			self.procstat()
+			tnext += self.interval
+			wait = tnext - time.time()
+			if wait < 0:
+				tnext, wait = time.time(), 0
+			self.event.wait(wait)
+		self.cputime = time.thread_time() - cpu
 	def start(self):
+		try:
+			self.fd = os.open(sysvals.tpath+'trace_marker', os.O_WRONLY)
+		except:
+			pprint('WARNING: process monitor cannot open trace_marker')
+			return
 		self.thread = Thread(target=self.processMonitor, args=(0,))
 		self.running = True
+		self.tstart = time.time()
+		self.event.clear()
 		self.thread.start()
 	def stop(self):
+		if not self.running:
+			return
 		self.running = False
+		self.event.set()
+		self.thread.join()
+		self.elapsed = time.time() - self.tstart
+		os.close(self.fd)
+		self.fd = -1
+	def summary(self):
+		pct = 100.0 * self.cputime / self.elapsed if self.elapsed > 0 else 0
+		return 'interval %dms samples %d writes %d cpu %.3fs (%.2f%%)' % \
+			(self.interval * 1000, self.samples, self.writes, self.cputime, pct)
 
 # ----------------- FUNCTIONS --------------------
 
@@ -5548,7 +5644,7 @@ def addScriptCode(hf, testruns):
 #	 Execute system suspend through the sysfs interface, then copy the output
 #	 dmesg and ftrace files to the test output directory.
 def executeSuspend(quiet=False):
-	sv, tp, pm = sysvals, sysvals.tpath, ProcessMonitor()
+	sv, tp, pm = sysvals, sysvals.tpath, ProcessMonitor(sysvals.procinterval)
 	if sv.wifi:
 		wifi = sv.checkWifi()
 		sv.dlog('wifi check, connected device is "%s"' % wifi)
@@ -5664,6 +5760,11 @@ def executeSuspend(quiet=False):
 			sv.dlog('read the ACPI FPDT')
 			tdata['fw'] = getFPDT(False)
 		testdata.append(tdata)
+	if sv.useftrace and sv.useprocmon and pm.elapsed > 0:
+		testdata[-1]['procmon'] = pm.summary()
+		sv.dlog('process monitor, %s' % testdata[-1]['procmon'])
+		if not quiet:
+			pprint('PROCESS MONITOR: %s' % testdata[-1]['procmon'])
 	sv.dlog('cmdinfo after')
 	cmdafter = sv.cmdinfo(False)
 	# grab a copy of the dmesg output
@@ -6194,6 +6295,7 @@ def doError(msg, help=False):
 	if(help == True):
 		printHelp()
 	pprint('ERROR: %s\n' % msg)
+	sysvals.errormsg = msg
 	sysvals.outputResult({'error':msg})
 	sys.exit(1)
 
@@ -6305,10 +6407,11 @@ def processData(live=False, quiet=False):
 		stamp['error'] = error
 	return (testruns, stamp)
 
-# Function: rerunTest
+# Function: rerunData
 # Description:
 #	 generate an output from an existing set of ftrace/dmesg logs
-def rerunTest(htmlfile=''):
+#	 and return the testruns along with the stamp
+def rerunData(htmlfile='', quiet=False):
 	if sysvals.ftracefile:
 		doesTraceLogHaveTraceEvents()
 	if not sysvals.dmesgfile and not sysvals.usetraceevents:
@@ -6322,10 +6425,76 @@ def rerunTest(htmlfile=''):
 			doError('a directory already exists with this name: %s' % sysvals.htmlfile)
 		elif not os.access(sysvals.htmlfile, os.W_OK):
 			doError('missing permission to write to %s' % sysvals.htmlfile)
-	testruns, stamp = processData()
+	return processData(False, quiet)
+
+# Function: rerunTest
+# Description:
+#	 generate an output from an existing set of ftrace/dmesg logs
+def rerunTest(htmlfile=''):
+	testruns, stamp = rerunData(htmlfile)
 	sysvals.resetlog()
 	return stamp
 
+# Class: Result
+# Description:
+#	 The output of a single analyze call, sysvals is the private
+#	 SystemValues instance the call used
+class Result:
+	def __init__(self, sv, testruns, stamp):
+		self.sysvals = sv
+		self.testruns = testruns
+		self.stamp = stamp
+		self.htmlfile = sv.htmlfile
+		self.log = sv.logmsg
+		self.error = stamp['error'] if 'error' in stamp else ''
+
+# Function: runWith
+# Description:
+#	 call func with sv as the sysvals it sees, the module sysvals is
+#	 context local so calls in other threads each see their own, and
+#	 nested calls restore the outer one when they return
+def runWith(sv, func, *args, **kwargs):
+	token = currentvals.set(sv)
+	try:
+		return func(*args, **kwargs)
+	finally:
+		currentvals.reset(token)
+
+def analyzeRun(htmlfile, quiet):
+	if sysvals.dmesgfile and not os.path.exists(sysvals.dmesgfile):
+		doError('%s does not exist' % sysvals.dmesgfile)
+	if sysvals.ftracefile and not os.path.exists(sysvals.ftracefile):
+		doError('%s does not exist' % sysvals.ftracefile)
+	testruns, stamp = rerunData(htmlfile, quiet)
+	return Result(currentvals.get(), testruns, stamp)
+
+# Function: analyze
+# Description:
+#	 Re-entrant equivalent of "sleepgraph -dmesg dmesg -ftrace ftrace",
+#	 all the state for the run is kept in a new SystemValues instance.
+#	 options are SystemValues attributes to set, e.g. {'usedevsrc': True},
+#	 skipkprobe is a comma separated list of kprobes to leave out.
+# Output:
+#	 a Result, the html timeline is written to htmlfile if given or
+#	 to the default name next to the logs
+def analyze(dmesg='', ftrace='', htmlfile='', options=dict(), skipkprobe='',
+	quiet=True):
+	sv = SystemValues()
+	sv.notestrun = True
+	sv.dmesgfile, sv.ftracefile = dmesg, ftrace
+	for name in options:
+		if not hasattr(sv, name):
+			raise AttributeError('unknown sleepgraph option: %s' % name)
+		setattr(sv, name, options[name])
+	if skipkprobe:
+		sv.skipKprobes(skipkprobe)
+	sv.cpuInfo()
+	try:
+		return runWith(sv, analyzeRun, htmlfile, quiet)
+	except SystemExit:
+		# doError exits for the command line tool, not for the caller
+		return Result(sv, [], {'error': sv.errormsg})
+
 # Function: runTest
 # Description:
 #	 execute a suspend/resume, gather the logs, and generate the output
@@ -6626,6 +6795,8 @@ def configFromFile(file):
 				sysvals.usedevsrc = checkArgBool(option, value)
 			elif(option == 'proc'):
 				sysvals.useprocmon = checkArgBool(option, value)
+			elif(option == 'procinterval'):
+				sysvals.procinterval = getArgInt('procinterval', value, 1, 60000, False)
 			elif(option == 'x2'):
 				if checkArgBool(option, value):
 					sysvals.execcount = 2
@@ -6850,6 +7021,7 @@ def printHelp():
 	'   -gzip        Gzip the trace and dmesg logs to save space\n'\
 	'   -cmd {s}     Run the timeline over a custom command, e.g. "sync -d"\n'\
 	'   -proc        Add usermode process info into the timeline (default: disabled)\n'\
+	'   -procinterval t Sample the -proc process info every t ms (default: 100 ms)\n'\
 	'   -dev         Add kernel function calls and threads to the timeline (default: disabled)\n'\
 	'   -x2          Run two suspend/resumes back to back (default: disabled)\n'\
 	'   -x2delay t   Include t ms delay between multiple test runs (default: 0 ms)\n'\
@@ -6962,6 +7134,8 @@ if __name__ == '__main__':
 			sysvals.verbose = True
 		elif(arg == '-proc'):
 			sysvals.useprocmon = True
+		elif(arg == '-procinterval'):
+			sysvals.procinterval = getArgInt('-procinterval', args, 1, 60000)
 		elif(arg == '-dev'):
 			sysvals.usedevsrc = True
 		elif(arg == '-sync'):
@@ -7209,8 +7383,8 @@ if __name__ == '__main__':
 
 	# if instructed, re-analyze existing data files
 	if(sysvals.notestrun):
-		stamp = rerunTest(sysvals.outdir)
-		sysvals.outputResult(stamp)
+		res = analyzeRun(sysvals.outdir, False)
+		sysvals.outputResult(res.stamp)
 		sys.exit(0)
 
 	# verify that we can run a test
@@ -23,10 +23,16 @@ import re
 import shutil
 import time
 import pickle
+import errno
 import fcntl
-from distutils.dir_util import copy_tree
+import tarfile
+import zipfile
+import threading
+import signal
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile, mkdtemp
-from subprocess import call, Popen, PIPE
+from subprocess import call, Popen, PIPE, STDOUT, DEVNULL
 from datetime import datetime
 import argparse
 import smtplib
@@ -36,7 +42,11 @@ import os.path as op
 from lib.googleapi import setupGoogleAPIs, initGoogleAPIs, gdrive_command_simple,\
 	google_api_command, gdrive_find, gdrive_mkdir, gdrive_backup
 from lib.parallel import MultiProcess, permission_to_run
+from lib.datacache import opencache, defaultpaths
+from lib.testindex import TestIndex, scanlinks, defaultpaths as testindexpaths
 from lib.common import printRecursive
+from lib.timelinepool import regen_timelines
+from lib.ingest import IngestQueue, FolderWatch, isarchive, checksum, writestatus
 
 suspendmodename = {
 	'standby': 'S1 (standby))',
@@ -51,11 +61,9 @@ trash = []
 mystarttime = time.time()
 testdetails = dict()
 machswap = dict()
-try:
-	testcache = op.join(os.getenv('HOME'), '.multitests')
-	datacache = op.join(os.getenv('HOME'), '.multitestdata')
-except:
-	testcache = datacache = ''
+threadvals = threading.local()
+testcache, testcachetxt = testindexpaths()
+datacache = defaultpaths()[0]
 
 def pprint(msg, withtime=True):
 	if withtime:
@@ -1271,9 +1279,9 @@ def createTestSpreadsheet(testruns, devall, issues, mybugs, folder, urlhost, tit
 	formatTestSpreadsheet(id, urlhost)
 	pprint('GOOGLESHEET FORMAT SHEET DONE: %s' % folder)
 
-	# move the spreadsheet into its proper folder
+	# move the spreadsheet into its proper folder, new sheets start in root
 	pprint('GOOGLESHEET MOVE SHEET: %s' % folder)
-	file = google_api_command('move', id, pid)
+	file = google_api_command('move', id, pid, 'root')
 	pprint('GOOGLESHEET MOVE SHEET DONE: %s' % folder)
 	pprint('spreadsheet id: %s' % id)
 	if 'spreadsheetUrl' not in sheet:
@@ -1660,7 +1668,7 @@ def createSummarySpreadsheet(args, data, deviceinfo, buglist, prefs=''):
 	}
 
 	if args.bugzilla:
-		fmt['requests'].append([
+		fmt['requests'].extend([
 			{'repeatCell': {
 				'range': {
 					'sheetId': 6, 'startRowIndex': 1,
@@ -1683,9 +1691,9 @@ def createSummarySpreadsheet(args, data, deviceinfo, buglist, prefs=''):
 	response = google_api_command('formatsheet', id, fmt)
 	pprint('{0} cells updated.'.format(len(response.get('replies'))));
 
-	# move the spreadsheet into its proper folder
+	# move the spreadsheet into its proper folder, new sheets start in root
 	pprint('moving the spreadsheet into its folder')
-	file = google_api_command('move', id, kfid)
+	file = google_api_command('move', id, kfid, 'root')
 	pprint('spreadsheet id: %s' % id)
 	if 'spreadsheetUrl' in sheet:
 		pprint('SUCCESS: spreadsheet created -> %s' % sheet['spreadsheetUrl'])
@@ -1729,15 +1737,22 @@ def files_from_test(testdir):
 					found[i] = '%s/%s' % (testdir, file)
 	return found
 
+def parsevals():
+	# one parse only SystemValues per thread, reused for every html
+	if not hasattr(threadvals, 'sv'):
+		threadvals.sv = sg.SystemValues(False)
+	threadvals.sv.resetlog()
+	return threadvals.sv
+
 def data_from_html(file, out, indir, issues):
-	myout = sg.data_from_html(file, indir, issues, True)
+	myout = sg.runWith(parsevals(), sg.data_from_html, file, indir,
+		issues, True)
 	if not myout:
 		return False
 	for key in myout:
 		out[key] = myout[key]
 	if 'sysinfo' in out:
 		out['machine'] = '_'.join(out['sysinfo'].split('<i>with</i>')[0].strip().split())
-	sg.sysvals.logmsg = ''
 	if 'mode' in out:
 		if out['mode'] == 's2idle':
 			out['mode'] = 'freeze'
@@ -2014,9 +2029,9 @@ def timeline_regen_cmd(dmesg, ftrace):
 	else:
 		return ''
 
-def genHtml(subdir, count=0, force=False):
+def timeline_files(subdir, force=False):
 	sv = sg.sysvals
-	cmds = []
+	files = []
 	for dirname, dirnames, filenames in os.walk(subdir):
 		sv.dmesgfile = sv.ftracefile = sv.htmlfile = ''
 		for filename in filenames:
@@ -2029,48 +2044,31 @@ def genHtml(subdir, count=0, force=False):
 		sv.setOutputFile()
 		if sv.dmesgfile and sv.ftracefile and sv.htmlfile and \
 			(force or not sv.usable(sv.htmlfile, True)):
-			cmd = timeline_regen_cmd(sv.dmesgfile, sv.ftracefile)
-			if not cmd:
-				continue
-			cmds.append(cmd)
-	if len(cmds) < 1:
-		return
-	pprint('generating %d timelines' % len(cmds))
-	mp = MultiProcess(cmds, 360)
-	fails = mp.run(count)
-	if len(fails) < 1:
+			files.append((sv.dmesgfile, sv.ftracefile))
+	return files
+
+def genHtml(files, count=0):
+	if len(files) < 1:
 		return
-	cmds = []
-	for cmd in fails:
-		if cmd.endswith(' -dev'):
-			cmds.append(cmd[:-5])
-	if len(cmds) > 0:
-		pprint('retrying %d timelines' % len(cmds))
-		mp = MultiProcess(cmds, 360)
-		mp.run(count)
+	pprint('generating %d timelines' % len(files))
+	fails = regen_timelines(files, count, 360)
+	if len(fails) > 0:
+		pprint('%d timelines failed' % len(fails))
+
+def open_cache():
+	if not testcache:
+		return TestIndex()
+	return TestIndex(testcache, testcachetxt)
 
 def load_cache(folder):
-	cache = []
-	if testcache and os.access(testcache, os.R_OK):
-		fp, ap = open(testcache, 'r'), op.abspath(folder)
-		for line in fp:
-			line = line.strip()
-			if (line.startswith(ap+'/') or ap == line) and op.exists(line):
-				cache.append(line)
-		fp.close()
-	return cache
+	return open_cache().roots(folder)
 
 def update_cache(folder, multitests):
-	if not testcache or (op.exists(testcache) and \
-		not os.access(testcache, os.W_OK)):
+	index = open_cache()
+	if not index.writable():
 		return
-	oldcache = load_cache(folder)
-	fp = open(testcache, 'a')
-	for indir, urlprefix in multitests:
-		a = op.abspath(indir)
-		if a not in oldcache:
-			fp.write('%s\n' % a)
-	fp.close()
+	index.add([indir for indir, urlprefix in multitests])
+	index.save()
 
 def update_data_cache(args, verbose=False):
 	global datacache, testdetails
@@ -2089,57 +2087,37 @@ def update_data_cache(args, verbose=False):
 		info['gid'] = gdrive_gid(args.tpath, info)
 		if verbose:
 			printDetail(indir, info)
-	# read existing data from cache for a full rewrite
-	keylist = ['datetime', 'rc', 'kernel', 'fullmode', 'host', 'machine',
-		'target', 'count', 'pass', 'testtime', 'smax', 'smed', 'smin',
-		'rmax', 'rmed', 'rmin', 's0ix', 'gid', 'pc10', 'wifi',
-		'biosdate', 'wifidrv']
-	oldcache = dict()
-	if op.exists(datacache):
-		fp = open(datacache, 'r')
-		fcntl.flock(fp, fcntl.LOCK_EX)
-		for line in fp:
-			val = line.split('|')
-			if len(val) > 0:
-				oldcache[val[0].strip()] = line.strip()
-	# update any existing entries and add new ones
+	# upsert the new data into the cache, one row per multitest
+	entries = dict()
 	for indir in sorted(testdetails):
 		info = testdetails[indir]
-		a = op.abspath(indir)
 		if 'target' not in info or 'count' not in info:
 			continue
-		line = [a]
-		for key in keylist:
-			line.append(info[key])
-		oldcache[a] = '|'.join(line)
-	# completely rewrite the cache file with the new data
-	fp = open(datacache, 'w')
-	fcntl.flock(fp, fcntl.LOCK_EX)
-	for indir in sorted(oldcache):
-		fp.write('%s\n' % oldcache[indir])
-	fcntl.flock(fp, fcntl.LOCK_UN)
-	fp.close()
+		entries[op.abspath(indir)] = info
+	cache = opencache(datacache)
+	if not cache:
+		pprint('WARNING: unable to open the data cache %s' % datacache)
+		return
+	count = cache.upsert(entries)
+	cache.close()
+	pprint('DATA CACHE UPDATED: %d multitests' % count)
 
 def find_sorted_multitests(args):
 	multitests, folder, urlprefix = [], args.folder, args.urlprefix
 	if not args.sortdir or not args.webdir:
 		return multitests
 	pprint('searching sort folder for multitest data')
-	for dirname, dirnames, filenames in os.walk(folder, followlinks=False):
-		for dir in dirnames:
-			absdir = op.join(dirname, dir)
-			if not op.islink(absdir):
-				continue
-			link = os.readlink(absdir)
-			if not link.startswith(op.abspath(args.webdir)):
-				continue
-			r = op.relpath(link, args.webdir)
-			if urlprefix:
-				urlp = urlprefix if r == '.' else op.join(urlprefix, r)
-			else:
-				urlp = ''
-			multitests.append((link, urlp))
-			pprint('(%d) %s' % (len(multitests), r))
+	webdir = op.abspath(args.webdir)
+	for absdir, link in scanlinks(folder):
+		if not link.startswith(webdir):
+			continue
+		r = op.relpath(link, args.webdir)
+		if urlprefix:
+			urlp = urlprefix if r == '.' else op.join(urlprefix, r)
+		else:
+			urlp = ''
+		multitests.append((link, urlp))
+		pprint('(%d) %s' % (len(multitests), r))
 	pprint('%d multitest folders found' % len(multitests))
 	return multitests
 
@@ -2147,7 +2125,7 @@ def find_multitests(args, usecache=True):
 	folder, urlprefix, cacheonly = args.folder, args.urlprefix, args.cache
 	# load up multitests folder cache
 	multitests = []
-	if usecache and cacheonly and testcache and os.access(testcache, os.R_OK):
+	if usecache and cacheonly and testcache:
 		oldcache, ap = load_cache(folder), op.abspath(folder)
 		for a in oldcache:
 			r = op.relpath(a, ap)
@@ -2162,38 +2140,42 @@ def find_multitests(args, usecache=True):
 			doError('no cached folders matching "%s"' % folder)
 		pprint('%d multitest folders found' % len(multitests))
 		return multitests
-	# search for stress test output folders with at least one test
+	# search for stress test output folders with at least one test, the
+	# index lets us skip listing any directory that hasn't changed
 	pprint('searching folder for multitest data')
-	for dirname, dirnames, filenames in os.walk(folder, followlinks=True):
-		for dir in dirnames:
-			if re.match('suspend-[0-9]*-[0-9]*$', dir):
-				r = op.relpath(dirname, folder)
-				if urlprefix:
-					urlp = urlprefix if r == '.' else op.join(urlprefix, r)
-				else:
-					urlp = ''
-				multitests.append((dirname, urlp))
-				pprint('(%d) %s' % (len(multitests), r))
-				break
+	index = open_cache() if usecache else TestIndex()
+	ap = op.abspath(folder)
+	for a in index.scan(folder):
+		r = op.relpath(a, ap)
+		dirname = op.normpath(op.join(folder, r))
+		if urlprefix:
+			urlp = urlprefix if r == '.' else op.join(urlprefix, r)
+		else:
+			urlp = ''
+		multitests.append((dirname, urlp))
+		pprint('(%d) %s' % (len(multitests), r))
+	if usecache:
+		index.save()
+	pprint('%d dirs checked, %d listed' % (index.stats, index.listed))
 	if len(multitests) < 1:
 		pprint('ERROR: no data found in %s' % args.folder)
 		return multitests
-	if usecache:
-		update_cache(folder, multitests)
 	pprint('%d multitest folders found' % len(multitests))
 	return multitests
 
 def generate_test_timelines(args, multitests):
 	pprint('GENERATING SLEEPGRAPH TIMELINES')
 	sg.sysvals.usedevsrc = True
-	i = 1
+	i, files = 1, []
 	for indir, urlprefix in multitests:
 		pprint('(%d) %s' % (i, indir))
 		i += 1
 		if args.parallel >= 0:
-			genHtml(indir, args.parallel, args.regenhtml)
+			files += timeline_files(indir, args.regenhtml)
 		else:
 			sg.genHtml(indir, args.regenhtml)
+	# one pool for every multitest so the workers are never idle
+	genHtml(files, args.parallel)
 
 def generate_test_spreadsheets(args, multitests, buglist):
 	if args.parallel < 0 or len(multitests) < 2:
@@ -2327,44 +2309,202 @@ def tempfolder(args, name):
 	os.mkdir(out)
 	return out
 
-def uncompress_archive(tsubdir, file):
-	pprint('Extracting %s...' % file)
-	os.mkdir(tsubdir)
-	res = 0
-	if file.endswith('.zip'):
-		res = call('unzip -d %s %s > /dev/null' % (tsubdir, file), shell=True)
-	elif file.endswith('.tar.xz'):
-		res = call('tar -C %s -xJf %s > /dev/null' % (tsubdir, file), shell=True)
-	elif file.endswith('.tar.gz'):
-		res = call('tar -C %s -xzf %s > /dev/null' % (tsubdir, file), shell=True)
-	else:
-		doError('%s is an unrecognized archive type, aborting...' % file, False)
-	if res != 0:
-		doError('%s is a broken archive, aborting...' % file, False)
-
-def archives_within_archives(folder):
-	idx = 1
-	for dirname, dirnames, filenames in os.walk(folder, followlinks=False):
-		for filename in filenames:
-			if not filename.endswith('tar.gz') and not filename.endswith('tar.xz'):
-				continue
-			subdir = op.join(folder, 'archive%d' % idx)
-			uncompress_archive(subdir, op.join(dirname, filename))
-			idx += 1
+class ArchiveExtractor:
+	# reads each uploaded archive once as a stream, extracting nested
+	# archives in a worker pool while the stream moves on, and calls
+	# ready(folder) once each multitest folder is fully on disk, i.e. the
+	# stream has moved past its members (tar and zip write a folder's
+	# members together) and any archives inside it are out. if a later
+	# member lands in a folder already released, ready(folder, True) is
+	# called again for it once the whole archive has been read
+	def __init__(self, workers=0, skip=[], ready=None):
+		self.pool = ThreadPoolExecutor(max_workers=workers if workers > 0 else os.cpu_count())
+		self.skip = skip
+		self.ready = ready
+		self.idx = 1
+		self.jobs = []
+		self.done = set()
+		self.complete = set()
+		self.again = set()
+		self.pending = dict()
+		self.lock = threading.Lock()
+		self.skipped = 0
+	def wanted(self, name):
+		# never write outside the target, and drop anything in -skip
+		parts = name.split('/')
+		if name.startswith('/') or '..' in parts:
+			return False
+		for pat in self.skip:
+			if fnmatch(parts[-1], pat):
+				return False
+		return True
+	def isarchive(self, name):
+		return name.endswith('tar.gz') or name.endswith('tar.xz')
+	def multitest(self, root, name):
+		# the multitest folder holding this member, if it's in a test
+		parts = name.strip('/').split('/')
+		for i in range(len(parts)):
+			if re.match('suspend-[0-9]*-[0-9]*$', parts[i]) and \
+				(i < len(parts) - 1 or name.endswith('/')):
+				return op.normpath(op.join(root, *parts[:i])) if i > 0 else root
+		return ''
+	def notify(self, folder):
+		with self.lock:
+			if folder in self.done:
+				return
+			self.done.add(folder)
+			again = folder in self.again
+		if self.ready:
+			self.ready(folder, again)
+	def advance(self, root, cur, name, mt):
+		# the stream is at member name, release the multitest it was in
+		# if it's moved past that folder, returns the current multitest
+		path = op.normpath(op.join(root, name))
+		if cur and path != cur and not path.startswith(cur+'/'):
+			self.settle(set([cur]))
+			cur = ''
+		with self.lock:
+			dir = path
+			while dir.startswith(root+'/'):
+				if dir in self.done:
+					self.again.add(dir)
+					break
+				dir = op.dirname(dir)
+		return mt if mt else cur
+	def reopen(self):
+		# folders written to after they were released go out again
+		with self.lock:
+			self.done -= self.again
+	def busy(self, folder):
+		# a nested archive is still being extracted somewhere in folder
+		for dir in self.pending:
+			if self.pending[dir] > 0 and (dir == folder or dir.startswith(folder+'/')):
+				return True
+		return False
+	def settle(self, folders=set()):
+		with self.lock:
+			self.complete |= folders
+			ready = [f for f in self.complete - self.done if not self.busy(f)]
+		for folder in sorted(ready):
+			self.notify(folder)
+	def nested(self, file):
+		# the archive is extracted next to itself, so any multitest above
+		# it isn't done until the job is
+		dir = op.dirname(file)
+		with self.lock:
+			tsubdir = op.join(dir, 'archive%d' % self.idx)
+			self.idx += 1
+			self.pending[dir] = self.pending.get(dir, 0) + 1
+			self.jobs.append((file, self.pool.submit(self.nestedjob, file, tsubdir)))
+	def nestedjob(self, file, tsubdir):
+		try:
+			os.mkdir(tsubdir)
+			flag = '-xJf' if file.endswith('.tar.xz') else '-xzf'
+			res = call(['tar', '-C', tsubdir, flag, file], stdout=PIPE, stderr=PIPE)
+			if res != 0:
+				return False
+			# archives inside this one are extracted too, at any depth
+			found = set()
+			for dirname, dirnames, filenames in os.walk(tsubdir, followlinks=False):
+				for dir in dirnames:
+					if re.match('suspend-[0-9]*-[0-9]*$', dir):
+						found.add(dirname)
+				for filename in filenames:
+					if self.isarchive(filename):
+						self.nested(op.join(dirname, filename))
+			with self.lock:
+				self.complete |= found
+			return True
+		finally:
+			with self.lock:
+				self.pending[op.dirname(file)] -= 1
+			self.settle()
+	def extract(self, file, tsubdir):
+		pprint('Extracting %s...' % file)
+		os.mkdir(tsubdir)
+		try:
+			if file.endswith('.zip'):
+				self.extractzip(file, tsubdir)
+			elif file.endswith('.tar.xz') or file.endswith('.tar.gz'):
+				self.extracttar(file, tsubdir)
+			else:
+				doError('%s is an unrecognized archive type, aborting...' % file, False)
+		except (tarfile.TarError, zipfile.BadZipFile, EOFError, OSError):
+			doError('%s is a broken archive, aborting...' % file, False)
+	def extracttar(self, file, tsubdir):
+		found, cur = set(), ''
+		with tarfile.open(file, 'r|*') as tf:
+			for m in tf:
+				if not self.wanted(m.name) or not (m.isfile() or m.isdir() or m.issym()):
+					self.skipped += 1
+					continue
+				mt = self.multitest(tsubdir, m.name + ('/' if m.isdir() else ''))
+				if mt:
+					found.add(mt)
+				cur = self.advance(tsubdir, cur, m.name, mt)
+				if hasattr(tarfile, 'data_filter'):
+					tf.extract(m, tsubdir, filter='data')
+				else:
+					tf.extract(m, tsubdir)
+				if m.isfile() and self.isarchive(m.name):
+					self.nested(op.join(tsubdir, m.name))
+		self.reopen()
+		self.settle(found)
+	def extractzip(self, file, tsubdir):
+		found, cur = set(), ''
+		with zipfile.ZipFile(file) as zf:
+			for m in zf.infolist():
+				if not self.wanted(m.filename):
+					self.skipped += 1
+					continue
+				mt = self.multitest(tsubdir, m.filename)
+				if mt:
+					found.add(mt)
+				cur = self.advance(tsubdir, cur, m.filename, mt)
+				zf.extract(m, tsubdir)
+				if not m.is_dir() and self.isarchive(m.filename):
+					self.nested(op.join(tsubdir, m.filename))
+		self.reopen()
+		self.settle(found)
+	def wait(self):
+		# jobs add their own nested jobs before they finish
+		i = 0
+		while i < len(self.jobs):
+			file, job = self.jobs[i]
+			if not job.result():
+				doError('%s is a broken archive, aborting...' % file, False)
+			i += 1
+		self.pool.shutdown()
+		if self.skipped:
+			pprint('%d archive members skipped' % self.skipped)
 
 def folder_as_tarball(args, folders):
 	if not args.webdir:
 		doError('you must supply a -webdir when processing a tarball')
 	tdir, idx = tempfolder(args, 'sleepgraph-multitest-data-'), 1
 	out = [tdir]
+	# categorize each multitest in the background as soon as it's extracted
+	catpool = ThreadPoolExecutor(max_workers=1)
+	catjobs = []
+	def ready(folder, again=False):
+		def categorize():
+			# a folder that got more files after it was categorized
+			if again:
+				testdetails.pop(op.abspath(folder), None)
+			categorize_by_timeline(args, [(folder, '')])
+		catjobs.append(catpool.submit(categorize))
+	ex = ArchiveExtractor(args.parallel if args.parallel > 0 else 0,
+		args.skip if args.skip else [], ready)
 	for tball in folders:
 		tsubdir = op.join(tdir, 'multitest%d' % idx)
-		uncompress_archive(tsubdir, tball)
-		if tball.endswith('.zip'):
-			archives_within_archives(tsubdir)
+		ex.extract(tball, tsubdir)
 		if args.rmtar:
 			out.append(tball)
 		idx += 1
+	ex.wait()
+	for job in catjobs:
+		job.result()
+	catpool.shutdown()
 	args.folder = tdir
 	return out
 
@@ -2427,6 +2567,120 @@ def categorize_by_summary(args, multitests, verbose=False):
 					pprint('BAD MULTITEST - %s' % indir)
 	return testdetails
 
+FICLONE = 0x40049409
+
+def clone_file(src, dst):
+	# reflink if the filesystem supports it, else an in-kernel copy,
+	# else a plain userspace copy
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		try:
+			fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+			return 'reflink'
+		except OSError:
+			pass
+		size = os.fstat(fsrc.fileno()).st_size
+		try:
+			done = 0
+			while done < size:
+				n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - done)
+				if n == 0:
+					break
+				done += n
+			if done == size:
+				return 'copy_file_range'
+		except (OSError, AttributeError):
+			pass
+		fsrc.seek(0)
+		fdst.seek(0)
+		fdst.truncate()
+		shutil.copyfileobj(fsrc, fdst, 1024*1024)
+	return 'copy'
+
+def ingest_file(src, dst, mode, stats):
+	if op.islink(src):
+		if op.lexists(dst):
+			os.remove(dst)
+		os.symlink(os.readlink(src), dst)
+		if mode == 'move':
+			os.remove(src)
+		stats['copy'] += 1
+		return
+	if mode == 'move':
+		try:
+			os.replace(src, dst)
+			stats['rename'] += 1
+			return
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+	elif mode == 'link':
+		try:
+			if op.lexists(dst):
+				os.remove(dst)
+			os.link(src, dst)
+			stats['link'] += 1
+			return
+		except OSError as e:
+			if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+				raise
+	# write to a temp name so a partial file never appears in dst
+	tmp = op.join(op.dirname(dst), '.%s.ingest' % op.basename(dst))
+	try:
+		stats[clone_file(src, tmp)] += 1
+		shutil.copystat(src, tmp)
+		if os.stat(src).st_size != os.stat(tmp).st_size:
+			raise OSError(errno.EIO, 'size mismatch copying %s' % src)
+		os.replace(tmp, dst)
+	except:
+		if op.exists(tmp):
+			os.remove(tmp)
+		raise
+	# the source is only removed once its copy is complete
+	if mode == 'move':
+		os.remove(src)
+
+def ingest_tree(src, dst, mode='move'):
+	# merge the src tree into dst like copy_tree but without copying data
+	# where possible: move renames whole subtrees (files one at a time
+	# across filesystems, so the data is never held twice), link
+	# hardlinks, and both fall back to reflink, copy_file_range, or copy
+	stats = {'rename': 0, 'link': 0, 'reflink': 0,
+		'copy_file_range': 0, 'copy': 0}
+	if mode == 'move' and (not op.exists(dst) or \
+		(op.isdir(dst) and len(os.listdir(dst)) == 0)):
+		try:
+			os.rename(src, dst)
+			stats['rename'] += 1
+			return stats
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+	stack = [(src, dst)]
+	while len(stack) > 0:
+		sdir, ddir = stack.pop()
+		if not op.isdir(ddir):
+			os.makedirs(ddir)
+			shutil.copystat(sdir, ddir)
+		for name in sorted(os.listdir(sdir)):
+			s, d = op.join(sdir, name), op.join(ddir, name)
+			if op.isdir(s) and not op.islink(s):
+				if mode == 'move' and not op.lexists(d):
+					try:
+						os.rename(s, d)
+						stats['rename'] += 1
+						continue
+					except OSError as e:
+						if e.errno != errno.EXDEV:
+							raise
+				stack.append((s, d))
+			else:
+				ingest_file(s, d, mode, stats)
+	if mode == 'move':
+		# only empty dirs are left, rmdir fails rather than lose data
+		for dirname, dirnames, filenames in os.walk(src, topdown=False):
+			os.rmdir(dirname)
+	return stats
+
 def sort_and_copy(args, multitestdata):
 	if not args.webdir:
 		doError('you must supply a -webdir when processing a tarball')
@@ -2459,7 +2713,9 @@ def sort_and_copy(args, multitestdata):
 			except:
 				pprint('WARNING: failed to make %s, skipping %s ...' % (outdir, indir))
 				continue
-		copy_tree(indir, outdir)
+		stats = ingest_tree(indir, outdir, args.ingest)
+		pprint('INGEST %s -> %s (%s)' % (indir, outdir,
+			', '.join(['%s %d' % (k, stats[k]) for k in sorted(stats) if stats[k]])))
 		info[outdir] = info[indir]
 		if args.urlprefix:
 			urlprefix = op.join(args.urlprefix, op.relpath(outdir, args.webdir))
@@ -2530,6 +2786,185 @@ def timeline_fixer(html, colidx, values):
 	if cmd:
 		call(cmd, shell=True)
 
+class IngestDaemon:
+	# watches an intake folder and processes each new archive with this
+	# same command line in a fixed number of worker processes, the jobs
+	# are kept in a sqlite queue in the intake so a restart loses nothing.
+	# archives are checksummed in a thread so a big one doesn't hold up
+	# the loop, the queue itself is only touched from the loop
+	settle = 5
+	rescan = 60
+	def __init__(self, args):
+		self.intake = op.abspath(args.folder)
+		self.workers = args.workers if args.workers > 0 else 2
+		self.maxqueue = args.maxqueue if args.maxqueue > 0 else 100
+		self.rmtar = args.rmtar
+		self.cmd = self.command(args)
+		for dir in ['.done', '.failed', '.logs']:
+			os.makedirs(op.join(self.intake, dir), exist_ok=True)
+		self.queue = IngestQueue(op.join(self.intake, '.ingest.db'), True)
+		self.watch = FolderWatch(self.intake)
+		self.procs = dict()
+		self.hasher = ThreadPoolExecutor(max_workers=1)
+		self.hashing = dict()
+		self.unsettled = self.backlog = self.stopping = False
+	def command(self, args):
+		# the daemon options are dropped, and so is -rmtar since a worker
+		# removes its tarball even when it fails, the daemon retires them
+		argv, skip = [], 0
+		for arg in sys.argv[1:]:
+			if skip:
+				skip -= 1
+			elif arg in ['-workers', '-maxqueue']:
+				skip = 1
+			elif arg not in ['-daemon', '-rmtar']:
+				argv.append(arg)
+		if args.folder in argv:
+			del argv[len(argv) - 1 - argv[::-1].index(args.folder)]
+		return [sys.executable, op.abspath(sys.argv[0])] + argv
+	def retire(self, file, ok):
+		if not op.exists(file):
+			return
+		if ok and self.rmtar:
+			os.remove(file)
+			return
+		dir = op.join(self.intake, '.done' if ok else '.failed')
+		out = op.join(dir, op.basename(file))
+		if op.exists(out):
+			out = op.join(dir, '%s-%s' % (datetime.now().strftime('%y%m%d-%H%M%S'),
+				op.basename(file)))
+		os.rename(file, out)
+	def scan(self, names=None):
+		# a full scan only takes files that have stopped changing, inotify
+		# names are only reported once the writer has closed them
+		full, now = names is None, time.time()
+		if full:
+			names = os.listdir(self.intake)
+			self.unsettled = self.backlog = False
+		pending = self.queue.pending()
+		queued = self.queue.counts()['queued'] + len(self.hashing)
+		for name in sorted(names):
+			file = op.join(self.intake, name)
+			if not isarchive(name) or file in pending or file in self.hashing:
+				continue
+			try:
+				st = os.stat(file)
+			except OSError:
+				continue
+			if not op.isfile(file):
+				continue
+			if queued >= self.maxqueue:
+				# leave the rest in the intake until there's room
+				self.backlog = True
+				break
+			if full and now - st.st_mtime < self.settle:
+				self.unsettled = True
+				continue
+			self.hashing[file] = (self.hasher.submit(checksum, file,
+				lambda:self.stopping), st)
+			queued += 1
+	def collect(self):
+		# queue the archives whose checksums are done
+		for file in list(self.hashing):
+			job, st = self.hashing[file]
+			if not job.done():
+				continue
+			del self.hashing[file]
+			try:
+				sum, now = job.result(), os.stat(file)
+			except:
+				continue
+			if not sum or (now.st_size, now.st_mtime) != (st.st_size, st.st_mtime):
+				# changed while it was read, the next scan takes it again
+				self.unsettled = True
+				continue
+			name = op.basename(file)
+			id = self.queue.add(file, sum, st.st_size)
+			if id:
+				pprint('QUEUED job %d: %s' % (id, name))
+			else:
+				pprint('DUPLICATE %s, already submitted' % name)
+				self.retire(file, True)
+	def start(self):
+		while len(self.procs) < self.workers:
+			job = self.queue.claim()
+			if not job:
+				break
+			id, file = job
+			if not op.exists(file):
+				pprint('MISSING job %d: %s' % (id, file))
+				self.queue.finish(id, -1)
+				continue
+			log = None
+			try:
+				log = open(op.join(self.intake, '.logs', '%s-%d.log' % \
+					(op.basename(file), id)), 'w')
+				proc = Popen(self.cmd + [file], stdin=DEVNULL, stdout=log, stderr=STDOUT)
+			except Exception as e:
+				if log:
+					log.close()
+				pprint('FAILED job %d, could not start it (%s): %s' % \
+					(id, e, op.basename(file)))
+				self.queue.finish(id, -1)
+				self.retire(file, False)
+				continue
+			self.procs[id] = (proc, file, log, time.time())
+			pprint('STARTED job %d: %s' % (id, op.basename(file)))
+	def reap(self):
+		count = 0
+		for id in list(self.procs):
+			proc, file, log, start = self.procs[id]
+			rc = proc.poll()
+			if rc is None:
+				continue
+			log.close()
+			del self.procs[id]
+			self.queue.finish(id, rc)
+			self.retire(file, rc == 0)
+			pprint('%s job %d in %.0fs: %s' % ('FINISHED' if rc == 0 else 'FAILED',
+				id, time.time() - start, op.basename(file)))
+			count += 1
+		return count
+	def status(self):
+		info = self.queue.counts()
+		info.update({'workers': self.workers, 'maxqueue': self.maxqueue,
+			'full': info['queued'] >= self.maxqueue, 'pid': os.getpid(),
+			'time': time.time()})
+		writestatus(op.join(self.intake, '.ingest-status'), info)
+	def stop(self, signum, frame):
+		self.stopping = True
+	def run(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		pprint('WATCHING %s (%s, %d workers, queue limit %d)' % \
+			(self.intake, self.watch.mode(), self.workers, self.maxqueue))
+		self.scan()
+		last = time.time()
+		while not self.stopping:
+			self.collect()
+			self.start()
+			self.status()
+			names = self.watch.wait(1 if self.procs or self.unsettled or \
+				self.hashing else 5)
+			if self.reap() and self.backlog:
+				names = None
+			if names is None or self.unsettled or time.time() - last > self.rescan:
+				self.scan()
+				last = time.time()
+			elif names:
+				self.scan(names)
+		# unfinished jobs are still marked running and are redone next time
+		for id in self.procs:
+			self.procs[id][0].terminate()
+		for id in self.procs:
+			self.procs[id][0].wait()
+			self.procs[id][2].close()
+		self.hasher.shutdown(cancel_futures=True)
+		pprint('STOPPED with %d jobs unfinished' % len(self.procs))
+		self.watch.close()
+		self.queue.close()
+		return 0
+
 def doError(msg, help=False):
 	global trash
 	if(help == True):
@@ -2588,6 +3023,24 @@ def printHelp():
 	'  -maxproc count\n'\
 	'      Maximum instances of stresstester that can run concurrently. If exceeded,\n'\
 	'      this exec will wait until one other process completes.\n'\
+	'  -ingest move/link/copy\n'\
+	'      How extracted tarball data is put into the webdir (default: move).\n'\
+	'      move renames the data, link hardlinks it, copy duplicates it. Copies\n'\
+	'      use reflinks or copy_file_range when the filesystem supports them.\n'\
+	'  -skip pattern\n'\
+	'      Don\'t extract tarball files whose name matches the pattern, e.g.\n'\
+	'      "*.png". Can be used multiple times. Any tar.gz/tar.xz files found\n'\
+	'      in a tarball or zip are extracted too, at any depth, next to the\n'\
+	'      original which is kept.\n'\
+	'  -daemon\n'\
+	'      Watch indir for new tarballs and process each one with the other\n'\
+	'      options given. Jobs are kept in a queue in indir which survives a\n'\
+	'      restart, and a tarball already submitted is skipped by checksum.\n'\
+	'  -workers count\n'\
+	'      Number of tarballs -daemon processes at once (default: 2).\n'\
+	'  -maxqueue count\n'\
+	'      Stop taking new tarballs from indir when this many are waiting\n'\
+	'      to be processed (default: 100).\n'\
 	'Initial Setup:\n'\
 	'  -setup                     Enable access to google drive apis via your account\n'\
 	'  --noauth_local_webserver   Dont use local web browser\n'\
@@ -2652,7 +3105,13 @@ if __name__ == '__main__':
 	parser.add_argument('-htmlonly', action='store_true')
 	parser.add_argument('-maxproc', metavar='count', type=int, default=0)
 	parser.add_argument('-tempdisk', metavar='path', default='')
+	parser.add_argument('-ingest', metavar='value',
+		choices=['move', 'link', 'copy'], default='move')
+	parser.add_argument('-skip', metavar='pattern', action='append')
 	parser.add_argument('-summary', action='store_true')
+	parser.add_argument('-daemon', action='store_true')
+	parser.add_argument('-workers', metavar='count', type=int, default=0)
+	parser.add_argument('-maxqueue', metavar='count', type=int, default=0)
 	# hidden arguments for testing only
 	parser.add_argument('-bugtest', metavar='file')
 	parser.add_argument('-bugfile', metavar='file')
@@ -2697,6 +3156,13 @@ if __name__ == '__main__':
 				info(file, [], args, timeline_fixer)
 		sys.exit(0)
 
+	if args.daemon:
+		if not op.exists(args.folder) or not op.isdir(args.folder):
+			doError('%s is not an existing folder' % args.folder, False)
+		if not args.webdir:
+			doError('you must supply a -webdir when processing tarballs')
+		sys.exit(IngestDaemon(args).run())
+
 	if args.maxproc > 0:
 		runlock = permission_to_run('stresstester', args.maxproc, 86400, pprint)
 	for dir in [args.webdir, args.datadir, args.sortdir]:
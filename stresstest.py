@@ -8,13 +8,15 @@ import sys
 import re
 import shutil
 import time
+import copy
 from subprocess import call, Popen, PIPE
 from datetime import date, datetime, timedelta
 import argparse
 import os.path as op
-from lib.parallel import AsyncProcess, MultiProcess, findProcess
+from lib.parallel import AsyncProcess, MultiProcess, MultiCall, CallQueue, findProcess
 from lib.argconfig import args_from_config, arg_to_path
-from lib.remotemachine import RemoteMachine
+from lib.remotemachine import RemoteMachine, TransferQueue
+from lib.fleet import Fleet
 from lib import kernel
 from lib.common import mystarttime, pprint, printlines, ascii, runcmd, userprompt, userprompt_yesno
 
@@ -56,6 +58,12 @@ def turbostatBuild(args):
 def specialConditions(args):
 	return False
 
+def buildCache(args):
+	if not args.kcache:
+		return None
+	size = args.kcachesize if args.kcachesize > 0 else 20
+	return kernel.BuildCache(args.kcache, size*1024*1024*1024)
+
 def kernelBuild(args):
 	if not args.pkgfmt or not args.kcfg:
 		doError('kernel build is missing arguments')
@@ -90,7 +98,8 @@ def kernelBuild(args):
 	kernel.clean(args.ksrc, kconfig, False)
 
 	# build the kernel
-	outdir, kver, packages = kernel.build(args.ksrc, args.pkgfmt, args.kname)
+	outdir, kver, packages = kernel.build(args.ksrc, args.pkgfmt, args.kname,
+		cache=buildCache(args))
 	if cloned:
 		shutil.rmtree(args.ksrc)
 		args.ksrc = ''
@@ -295,7 +304,8 @@ def kernelBisect(args, m=0):
 		# build the latest commit package
 		while True:
 			pprint('BUILD %s from commit %s' % (name, commit))
-			outdir, kver, packages = kernel.build(args.ksrc, args.pkgfmt, name)
+			outdir, kver, packages = kernel.build(args.ksrc, args.pkgfmt, name,
+				cache=buildCache(args))
 			if len(packages) > 0:
 				args.kernel = kver
 				break
@@ -353,7 +363,7 @@ def kernelBisect(args, m=0):
 					continue
 				doError('Bisect failed due to installation issue')
 			pprint('REBOOT %s' % args.host)
-			m.sshcmd('sudo reboot', 30)
+			m.sshreboot('sudo reboot', 30)
 
 			# wait for the system to boot the kernel, else restart once then ask for help
 			while True:
@@ -399,7 +409,7 @@ def kernelBisect(args, m=0):
 					out, error, ktest = "", 'SCP FAILED', op.basename(args.ktest)
 					if m.scpfile(args.ktest, '/tmp'):
 						m.sshcmd('chmod 755 /tmp/%s' % ktest, 30)
-						out = m.sshcmd('/tmp/%s' % ktest, 300, False, False, False)
+						out = m.sshcmd('/tmp/%s' % ktest, 300, False, False, False, False)
 						error = out.strip().split('\n')[-1]
 					if error in ['GOOD', 'BAD']:
 						state = error.lower()
@@ -428,6 +438,115 @@ def kernelBisect(args, m=0):
 			return
 		kernel.configure(args.ksrc, args.kcfg, True)
 
+def bisectTree(args, m):
+	return op.join(op.abspath(args.ksrc)+'-bisect', m.host, 'linux')
+
+def bisectTest(args, m, commit, jobs):
+	# build, install, boot, and ktest one commit on one machine, returns
+	# good/bad/skip or '' if the machine failed and the commit is untested.
+	# the machine's worktree is already checked out at commit
+	wt = bisectTree(args, m)
+	# named by commit so a rebuild of it can come from the cache
+	name = 'bisect%s' % commit[:12]
+	pprint('%s: BUILD %s from commit %s' % (m.host, name, commit))
+	# a build that blows up says nothing about the machine, skip the commit
+	try:
+		kernel.configure(wt, args.kcfg, False)
+		outdir, kver, packages = kernel.build(wt, args.pkgfmt, name, jobs,
+			buildCache(args))
+	except (Exception, SystemExit) as e:
+		pprint('%s: BUILD ERROR %s (%s: %s)' % (m.host, commit, type(e).__name__, e))
+		return ('skip', '')
+	if len(packages) < 1:
+		pprint('%s: BUILD ERROR %s' % (m.host, commit))
+		return ('skip', '')
+	margs = copy.copy(args)
+	margs.user, margs.host, margs.addr, margs.kernel = m.user, m.host, m.addr, kver
+	if args.pkgout:
+		kernel.move_packages(outdir, args.pkgout, packages)
+	else:
+		margs.pkgout = outdir
+	error = m.wait_for_boot('', 180)
+	if error:
+		pprint('%s: CONNECTION ERROR %s' % (m.host, error))
+		return ('', kver)
+	pprint('%s: INSTALL %s' % (m.host, kver))
+	if not kernelInstall(margs, m, False, False):
+		return ('', kver)
+	m.sshreboot('sudo reboot', 30)
+	error = m.wait_for_boot(kver, 180)
+	if error:
+		pprint('%s: BOOT ERROR %s' % (m.host, error))
+		m.reset_machine()
+		return ('bad' if args.bisecthangbad else 'skip', kver)
+	out, error, ktest = '', 'SCP FAILED', op.basename(args.ktest)
+	if m.scpfile(args.ktest, '/tmp'):
+		m.sshcmd('chmod 755 /tmp/%s' % ktest, 30)
+		out = m.sshcmd('/tmp/%s' % ktest, 300, False, False, False, False)
+		error = out.strip().split('\n')[-1]
+	if error in ['GOOD', 'BAD']:
+		return (error.lower(), kver)
+	elif 'SSH TIMEOUT' in error and args.ktesthangbad:
+		return ('bad', kver)
+	pprint('%s: KTEST ERROR (%s): %s' % (m.host, ktest, error))
+	return ('', kver)
+
+def kernelBisectMulti(args, machlist):
+	if not (args.kgood and args.kbad and args.ksrc and args.kcfg and \
+		args.pkgfmt and args.ktest):
+		doError('multi machine bisect requires -kgood, -kbad, -ksrc, -kcfg, -pkgfmt, -ktest')
+	if not kernel.isgit(args.ksrc):
+		doError('kernel source folder is not a git tree')
+	machines = [machlist[h] for h in sorted(machlist)]
+	if len(machines) < 1:
+		doError('no machines available for bisect')
+	file = args.kstate if args.kstate else op.abspath(args.ksrc)+'-bisect.json'
+	bs = kernel.BisectState(file, args.ksrc, args.kgood, args.kbad, args.kpath)
+	pprint('BISECT STATE: %s (%d results)' % (file, len(bs.results)))
+
+	# each round tests one commit per machine, builds run concurrently
+	fails = dict()
+	while not bs.done() and len(machines) > 0:
+		commits = bs.pick(len(machines))
+		jobs = max(1, len(os.sched_getaffinity(0)) // len(commits))
+		pprint('ROUND: %d candidates, testing %d' % \
+			(len(bs.candidates()), len(commits)))
+		# git worktree add isn't safe to run concurrently, so the
+		# checkouts are done one at a time before the builds start
+		arglist = []
+		for i in range(len(commits)):
+			kernel.worktree(args.ksrc, bisectTree(args, machines[i]), commits[i])
+			arglist.append([args, machines[i], commits[i], jobs])
+		mc = MultiCall(bisectTest, arglist)
+		mc.run(len(arglist))
+		for job in mc.complete:
+			m, commit = job.args[1], job.args[2]
+			state, kver = job.result if job.result else ('', '')
+			if not job.result:
+				pprint('%s: FAILED %s (%s)' % (m.host, commit,
+					job.error if job.error else 'no result'))
+			if not state:
+				# the machine failed, the commit will be picked again
+				fails[m.host] = fails.get(m.host, 0) + 1
+				if fails[m.host] >= 2:
+					pprint('%s: too many failures, dropping from the bisect' % m.host)
+					machines.remove(m)
+				continue
+			fails[m.host] = 0
+			pprint('STATE is %s for %s (%s)' % (state.upper(), commit, m.host))
+			bs.record(commit, state, m.host, kver)
+	for m in machines:
+		kernel.worktree_remove(args.ksrc, bisectTree(args, m))
+	if not bs.done():
+		doError('Bisect failed, no working machines left (resume with %s)' % file)
+	left = bs.remaining()
+	if len(left) == 1:
+		print('\nBAD COMMIT: %s' % left[0])
+	else:
+		print('\nBAD COMMIT is one of (skipped commits remain):')
+		for c in left:
+			print(c)
+
 def pm_graph_multi_download(args, m, dotar=False, doscp=False):
 	if not (args.user and args.host and args.addr and args.kernel):
 		doError('getmulti is missing arguments (kernel)')
@@ -550,11 +669,42 @@ def pm_graph_multi(args):
 
 	cmd = 'sudo sleepgraph -dev -sync -wifi -netfix -display on -gzip '
 	cmd += '-rtcwake %s -m %s -multi %s 0 -o %s' % (rtcwake, args.mode, info, sshout)
-	mycmd = 'ssh -n -f %s@%s "%s > %s/pm-graph.log 2>&1 &"' % \
-		(args.user, args.addr, cmd, sshout)
+	mycmd = 'ssh -n -f %s %s@%s "%s > %s/pm-graph.log 2>&1 &"' % \
+		(m.sshopts(), args.user, args.addr, cmd, sshout)
 	call(mycmd, shell=True)
 	return 1
 
+def regen_status(job):
+	# regen_html returns (status, testdir), unless it threw an exception,
+	# job.args is [regen_html, its args] from CallQueue
+	if isinstance(job.result, tuple) and len(job.result) == 2:
+		return job.result
+	return ('FAILED', '%s (%s)' % (job.args[1][-1],
+		job.error if job.error else 'no result'))
+
+def regen_html(transfer, src, f, found, testdir):
+	if not transfer.wait(src):
+		return ('FAILED', '%s (copy failed)' % testdir)
+	cmdbase = 'sleepgraph -dmesg %s -ftrace %s' % (f['dmesg'], f['ftrace'])
+	cmd = '%s -dev' % cmdbase
+	if 'result' not in found:
+		cmd += ' -result %s' % f['result']
+	if op.getsize(f['ftrace']) > 100000:
+		cmd += ' -addlogdmesg'
+	else:
+		cmd += ' -addlogs'
+	ap = AsyncProcess(cmd, 360, False)
+	ap.runcmd()
+	if ap.terminated:
+		if os.path.exists(f['html']):
+			os.remove(f['html'])
+		pprint('REGEN HTML PLAIN: %s' % testdir)
+		ap = AsyncProcess(cmdbase, 360, False)
+		ap.runcmd()
+	if ap.terminated or not os.path.exists(f['html']):
+		return ('FAILED', testdir)
+	return ('DONE', testdir)
+
 def pm_graph(args, m, badmodeok=False):
 	if not (args.user and args.host and args.addr and args.kernel and \
 		args.mode) or (args.count < 1 and args.duration < 1):
@@ -652,7 +802,11 @@ def pm_graph(args, m, badmodeok=False):
 
 	outres = True
 	failcount = i = 0
+	transfer = TransferQueue(m)
+	regen = CallQueue()
 	while datetime.now() < finish and i < count:
+		for job in regen.results():
+			pprint('REGEN HTML %s: %s' % regen_status(job))
 		if args.failmax and failcount >= args.failmax:
 			pprint('Testing aborted after %d fails' % failcount)
 			break
@@ -692,7 +846,7 @@ def pm_graph(args, m, badmodeok=False):
 		# set magic packets to fire after rtcwake does
 		if basemode == 'disk':
 			m.wolwake(int(rtcwake) + 30)
-		out = m.sshcmd(cmd, 300, False, False, False)
+		out = m.sshcmd(cmd, 300, False, False, False, False)
 		with open('%s/sshtest.log' % testout, 'w') as fp:
 			fp.write(out)
 			fp.close()
@@ -708,72 +862,60 @@ def pm_graph(args, m, badmodeok=False):
 		elif not m.ping(5):
 			pprint('PING FAILED: %s' % testdir)
 			m.restart_or_die(serialfile)
-		ap = AsyncProcess('scp -q -r %s@%s:%s %s' % \
-			(m.user, m.addr, testout_ssh, localout), 300)
-		ap.runcmd()
-		if ap.terminated:
-			pprint('SCP FAILED')
+		# check which files were created without waiting for the copy
+		manifest = m.manifest(testout_ssh)
+		if manifest is None:
+			pprint('REMOTE CHECK FAILED')
 			m.restart_or_die(serialfile)
-			ap.runcmd()
-			if ap.terminated:
-				pprint('Testing aborted from SCP FAIL')
+			manifest = m.manifest(testout_ssh)
+			if manifest is None:
+				pprint('Testing aborted from REMOTE CHECK FAIL')
 				outres = False
 				break
-		# check to see which files are available
 		f = dict()
 		found = []
 		for t in testfiles:
 			f[t] = testfiles[t].format(testdir)
-			if os.path.exists(f[t]):
+			if op.relpath(f[t], testout) in manifest:
 				found.append(t)
 		# hang if all files are missing
 		if all(v not in found for v in ['html', 'dmesg', 'ftrace', 'result']):
 			pprint('HANG: %s' % testdir)
+			transfer.add(testout_ssh, localout, manifest)
 			failcount += 1
 			i += 1
 			continue
-		# if html missing and gz files found, regen the html
-		if 'html' not in found and 'dmesg' in found and 'ftrace' in found:
-			pprint('REGEN HTML: %s' % testdir)
-			cmdbase = 'sleepgraph -dmesg %s -ftrace %s' % (f['dmesg'], f['ftrace'])
-			cmd = '%s -dev' % cmdbase
-			if 'result' not in found:
-				cmd += ' -result %s' % f['result']
-			if os.path.getsize(f['ftrace']) > 100000:
-				cmd += ' -addlogdmesg'
-			else:
-				cmd += ' -addlogs'
-			ap = AsyncProcess(cmd, 360, False)
-			ap.runcmd()
-			if ap.terminated:
-				if os.path.exists(testfiles['html']):
-					os.remove(testfiles['html'])
-				pprint('REGEN HTML PLAIN: %s' % testdir)
-				ap = AsyncProcess(cmdbase, 360, False)
-				ap.runcmd()
 		# crash is one or more files is missing
 		if any(v not in found for v in ['html', 'dmesg', 'ftrace', 'result']):
 			pprint('MISSING OUTPUT FILES: %s' % testdir)
 			m.sshcmd('dmesg > %s/dmesg-crash.log' % testout_ssh, 120)
-			m.scpfileget('%s/dmesg-crash.log' % testout_ssh, testout)
+		# fetch this test's output while the next one runs
+		transfer.add(testout_ssh, localout, manifest)
+		# if html missing and gz files found, regen the html in the
+		# background once the files arrive, it doesn't change the outcome
+		if 'html' not in found and 'dmesg' in found and 'ftrace' in found:
+			pprint('REGEN HTML: %s' % testdir)
+			regen.add(regen_html, [transfer, testout_ssh, f, found, testdir])
+		if any(v not in found for v in ['html', 'dmesg', 'ftrace', 'result']):
 			pprint('corrupt output!')
 			failcount += 1
 		else:
-			with open('%s/%s/result.txt' % (localout, testdir), 'r') as fp:
-				out = fp.read()
-				if 'result: pass' in out:
-					failcount = 0
-				else:
-					failcount += 1
-				fp.close()
-				printlines(out)
+			out = m.sshcmd('cat %s/result.txt' % testout_ssh, 60)
+			if 'result: pass' in out:
+				failcount = 0
+			else:
+				failcount += 1
+			printlines(out)
 		i += 1
 
 	# sync the files
 	pprint('Syncing data...')
+	if not transfer.stop():
+		pprint('COPY FAILED: %s' % ', '.join(transfer.failed))
+	for job in regen.stop():
+		pprint('REGEN HTML %s: %s' % regen_status(job))
 	m.data_stop_collection(serialfile)
-	ap = AsyncProcess('rsync -ur %s@%s:%s %s' % \
-		(m.user, m.addr, sshout, hostout), 1800)
+	ap = m.rsyncget(sshout, hostout)
 	ap.runcmd()
 	if ap.terminated:
 		pprint('RSYNC FAILED')
@@ -859,9 +1001,12 @@ def spawnMachineCmds(args, machlist, command):
 		cmdfmt += ' -releasecmd "%s"' % args.releasecmd
 	cmdsuffix = ' -host {0} -user {1} -addr {2} %s' % command
 
+	# output goes straight to each host's log, only the tail is kept
+	words = ['FAILURE', 'ERROR', 'Error', 'fatal', 'TIMEOUT', 'OFFLINE']
 	for host in machlist:
 		m = machlist[host]
-		cmds.append(cmdfmt+cmdsuffix.format(m.host, m.user, m.addr))
+		cmds.append(AsyncProcess(cmdfmt+cmdsuffix.format(m.host, m.user, m.addr),
+			1800, logfile='/tmp/%s.log' % m.host, maxout=65536, watch=words))
 
 	pprint('%sing on %d hosts ...' % (command, len(machlist)))
 	mp = MultiProcess(cmds, 1800)
@@ -869,22 +1014,20 @@ def spawnMachineCmds(args, machlist, command):
 	for acmd in mp.complete:
 		m = re.match(r'.* -host (?P<h>\S*) .*', acmd.cmd)
 		host = m.group('h')
-		fp = open('/tmp/%s.log' % host, 'w')
-		fp.write(acmd.output)
-		fp.close()
 		pprint('LOG AT: /tmp/%s.log' % host)
 		if host not in machlist:
 			continue
 		m = machlist[host]
-		o = acmd.output
-		if acmd.terminated or 'FAILURE' in o or 'ERROR' in o:
+		found = acmd.capture.found
+		if acmd.terminated or 'FAILURE' in found or 'ERROR' in found:
 			m.status = False
 		elif command == 'tools' and \
-			('Error' in o or 'fatal' in o or 'TIMEOUT' in o or 'OFFLINE' in o):
+			('Error' in found or 'fatal' in found or 'TIMEOUT' in found or \
+			'OFFLINE' in found):
 			m.status = False
 		else:
 			if command == 'install':
-				m.sshcmd('sudo reboot', 30)
+				m.sshreboot('sudo reboot', 30)
 #				m.power_off_machine()
 			m.status = True
 #	if command == 'install':
@@ -892,6 +1035,14 @@ def spawnMachineCmds(args, machlist, command):
 #		for acmd in mp.complete:
 #			m.power_on_machine()
 
+def writeMachineList(file, lines):
+	# replace the file in one step so it's never seen half written
+	tmp = '%s.%d' % (file, os.getpid())
+	with open(tmp, 'w') as fp:
+		for line in lines:
+			fp.write(line+'\n')
+	os.rename(tmp, file)
+
 def resetMachineList(args):
 	file, kfile = args.machines, ''
 	if args.kernel:
@@ -910,10 +1061,7 @@ def resetMachineList(args):
 			continue
 		out.append(line[len(f[0]):].strip())
 	fp.close()
-	fp = open(file, 'w')
-	for line in out:
-		fp.write(line+'\n')
-	fp.close()
+	writeMachineList(file, out)
 	if kfile:
 		if op.exists(kfile):
 			os.remove(kfile)
@@ -929,6 +1077,7 @@ def runStressCmd(args, cmd, mlist=None):
 	else:
 		file = args.machines
 	changed, machlist, out, fp = False, dict(), [], open(file)
+	checks = []
 
 	for line in fp.read().split('\n'):
 		out.append(line)
@@ -953,6 +1102,9 @@ def runStressCmd(args, cmd, mlist=None):
 		elif cmd == 'online':
 			if flag:
 				continue
+			if not args.userinput:
+				checks.append((len(out) - 1, machine))
+				continue
 			res = machine.checkhost(args.userinput)
 			if res:
 				pprint('%30s: %s' % (host, res))
@@ -987,17 +1139,7 @@ def runStressCmd(args, cmd, mlist=None):
 		elif cmd == 'ready':
 			if flag != 'O' and flag != 'I':
 				continue
-			res = machine.checkhost(args.userinput)
-			if res:
-				pprint('%30s: %s' % (host, res))
-				continue
-			kver = machine.kernel_version()
-			if args.kernel != kver:
-				pprint('%30s: wrong kernel (actual=%s)' % (host, kver))
-				continue
-			pprint('%30s: ready' % host)
-			out[-1] = 'R'+line[1:]
-			changed = True
+			checks.append((len(out) - 1, machine))
 		# RUN - look at R machines
 		elif cmd == 'run':
 			if flag != 'R':
@@ -1064,12 +1206,28 @@ def runStressCmd(args, cmd, mlist=None):
 			print('%s bootclean' % host)
 			machine.bootclean()
 	fp.close()
+
+	# the online and ready checks run on all the machines at once
+	if len(checks) > 0:
+		fleet = Fleet(count=args.hostmax)
+		if cmd == 'online':
+			res = fleet.sweep([c[1] for c in checks], fleet.online)
+		else:
+			res = fleet.sweep([c[1] for c in checks], fleet.ready, args.kernel)
+		fleet.close()
+		for idx, machine in checks:
+			host, line = machine.host, out[idx]
+			if res[host]:
+				pprint('%30s: %s' % (host, res[host]))
+				if cmd == 'online':
+					machlist[host] = machine
+				continue
+			pprint('%30s: %s' % (host, cmd))
+			out[idx] = 'O '+line if cmd == 'online' else 'R'+line[1:]
+			changed = True
 	if changed:
 		pprint('LOGGING AT: %s' % file)
-		fp = open(file, 'w')
-		for line in out[:-1]:
-			fp.write(line.strip()+'\n')
-		fp.close()
+		writeMachineList(file, [l.strip() for l in out[:-1]])
 	return machlist
 
 if __name__ == '__main__':
@@ -1089,6 +1247,8 @@ if __name__ == '__main__':
 	g.add_argument('-machines', metavar='file', default='',
 		help='input file with remote machine list for running on multiple '+\
 		'systems simultaneously (includes host, addr, user on each line)')
+	g.add_argument('-hostmax', metavar='count', type=int, default=0,
+		help='maximum number of machines checked at once (default: 32)')
 	# kernel build
 	g = parser.add_argument_group('kernel build (build)')
 	g.add_argument('-pkgfmt', metavar='type',
@@ -1102,6 +1262,10 @@ if __name__ == '__main__':
 	g.add_argument('-kname', metavar='string', default='',
 		help='kernel name as "<version>-<name>" '+\
 		'(default: blank, use version only)')
+	g.add_argument('-kcache', metavar='folder', default='',
+		help='cache built kernel packages here and reuse them (default: off)')
+	g.add_argument('-kcachesize', metavar='GB', type=int, default=0,
+		help='maximum size of the kernel package cache (default: 20)')
 	g.add_argument('-kcfg', metavar='folder', default='',
 		help='config & patches folder '+\
 		'(default: use .config in ksrc and apply no patches)')
@@ -1163,6 +1327,8 @@ if __name__ == '__main__':
 		help='Interpret a failure to boot the bisect kernel as "bad"')
 	g.add_argument('-kpath', metavar='dir', default='',
 		help='Narrow the bisect to a specific folder')
+	g.add_argument('-kstate', metavar='file', default='',
+		help='Multi machine bisect state file (default: <ksrc>-bisect.json)')
 	# command
 	g = parser.add_argument_group('command')
 	g.add_argument('command', choices=['init', 'build', 'turbostat',
@@ -1179,7 +1345,8 @@ if __name__ == '__main__':
 
 	if args.failmax < 1:
 		args.failmax = 20
-	arg_to_path(args, ['ksrc', 'kcfg', 'pkgout', 'machines', 'testout'])
+	arg_to_path(args, ['ksrc', 'kcfg', 'pkgout', 'machines', 'testout', 'kstate',
+		'kcache'])
 
 	# single machine commands
 	if cmd == 'build':
@@ -1188,6 +1355,9 @@ if __name__ == '__main__':
 	elif cmd == 'turbostat':
 		turbostatBuild(args)
 		sys.exit(0)
+	elif cmd == 'bisect' and args.machines and not args.host:
+		kernelBisectMulti(args, runStressCmd(args, 'find:O,I,R'))
+		sys.exit(0)
 	elif cmd == 'bisect' and not (args.user and args.host and args.addr):
 		if not (args.kgood and args.kbad and args.ksrc and args.kcfg):
 			doError('bisect requires -kgood, -kbad, -ksrc, -kcfg')
@@ -2,15 +2,33 @@
 
 import os
 import sys
-from tempfile import mktemp
+import re
+import shutil
+import json
+import shlex
+import socket
+import hashlib
 from datetime import datetime
-from subprocess import call, Popen, PIPE
+from subprocess import call, Popen, PIPE, DEVNULL
 from lib.parallel import AsyncProcess
 
+testre = re.compile('suspend-[0-9]*-[0-9]*$')
+
 class DataServer:
-	def __init__(self, user, host):
+	# folders are streamed into intake/<source> (relative to the server
+	# home), source being this host and folder, and only the tests not
+	# already listed in its manifest are sent. tests are listed again in
+	# its .processed file once multitest has handled them, so anything
+	# received but never processed is handed over by the next upload
+	intake = 'multitest-intake'
+	batchsize = 1024*1024*1024
+	def __init__(self, user, host, watch=''):
 		self.host = host
 		self.user = user
+		# intake folder of a stressreport -daemon on the server, if any
+		self.watch = watch
+		# server command marking the uploaded tests processed, if any
+		self.mark = ''
 	def sshcopyid(self):
 		res = call('ssh-copy-id %s@%s' % (self.user, self.host), shell=True)
 		return res == 0
@@ -45,46 +63,235 @@ class DataServer:
 	def scpfile(self, file, dir):
 		res = call('scp %s %s@%s:%s/' % (file, self.user, self.host, dir), shell=True)
 		return res == 0
-	def tarfolder(self, folder):
-		pdir, tdir = os.path.dirname(folder), os.path.basename(folder)
-		pdir = pdir if pdir else '.'
-		tarball = mktemp(prefix='multitest-data-', suffix='.tar.gz')
-		print('Taring up %s for transport...' % folder)
-		res = call('cd %s; tar cvzf %s %s > /dev/null' % (pdir, tarball, tdir), shell=True)
-		if res != 0:
-			print('ERROR: failed to create the tarball')
+	def findtests(self, folder):
+		# test folders (relative to the parent of folder) -> their files,
+		# and the files which aren't in a test folder
+		pdir = os.path.dirname(os.path.abspath(folder))
+		tests, others = dict(), []
+		for dir, dirs, files in os.walk(folder):
+			rel = os.path.relpath(dir, pdir)
+			if testre.match(os.path.basename(dir)):
+				tlist = []
+				for tdir, tdirs, tfiles in os.walk(dir):
+					trel = os.path.relpath(tdir, pdir)
+					tlist += [os.path.join(trel, f) for f in tfiles]
+				tests[rel] = sorted(tlist)
+				dirs[:] = []
+				continue
+			others += [os.path.join(rel, f) for f in files]
+		return (pdir, tests, sorted(others))
+	def checksum(self, pdir, files):
+		h = hashlib.sha256()
+		for file in files:
+			h.update(('%s\n' % file).encode())
+			with open(os.path.join(pdir, file), 'rb') as fp:
+				for data in iter(lambda: fp.read(1048576), b''):
+					h.update(data)
+		return h.hexdigest()
+	def source(self, folder):
+		# intake subdir for this folder, so same named folders from other
+		# hosts or other paths on this one never share a copy or manifest
+		path = os.path.abspath(folder)
+		host = socket.gethostname().split('.')[0]
+		return '%s/%s-%s' % (self.intake, host,
+			hashlib.sha256(path.encode()).hexdigest()[:12])
+	def readmanifest(self, text):
+		manifest = dict()
+		for line in text.split('\n'):
+			v = line.strip().split(' ', 1)
+			if len(v) == 2 and re.match('^[0-9a-f]{64}$', v[0]):
+				manifest[v[1]] = v[0]
+		return manifest
+	def remoteinfo(self, rdir, tdir):
+		# the server's received and processed manifests for this folder
+		# and its compressors
+		cmd = 'cat %s/%s.manifest 2>/dev/null; echo PROCESSED; '\
+			'cat %s/%s.processed 2>/dev/null; echo TOOLS; '\
+			'command -v zstd pigz gzip' % (rdir, tdir, rdir, tdir)
+		out = self.sshcmd(cmd, 60)
+		if 'PROCESSED' not in out or 'TOOLS' not in out:
+			print('ERROR: could not read the server manifest')
+			self.die()
+		tools = []
+		text, out = out.split('PROCESSED', 1)
+		ptext, tlist = out.split('TOOLS', 1)
+		for line in tlist.split('\n'):
+			if line.strip():
+				tools.append(os.path.basename(line.strip()))
+		return (self.readmanifest(text), self.readmanifest(ptext), tools)
+	def compressor(self, tools):
+		# (local compress command, server decompress command)
+		if 'zstd' in tools and shutil.which('zstd'):
+			return (['zstd', '-q', '-T0', '-3'], 'zstd -dc')
+		if shutil.which('pigz'):
+			return (['pigz', '-c'], 'gzip -dc')
+		return (['gzip', '-c'], 'gzip -dc')
+	def streamfiles(self, pdir, files, tests, rdir, comp, decomp):
+		# tar | compress | ssh | decompress | tar, nothing touches disk.
+		# the server's old copy of each test is removed first so files
+		# which are gone from a changed test don't linger
+		tar = Popen(['tar', 'cf', '-', '-C', pdir, '--null', '-T', '-'],
+			stdin=PIPE, stdout=PIPE)
+		zip = Popen(comp, stdin=tar.stdout, stdout=PIPE)
+		tar.stdout.close()
+		rcmd = 'mkdir -p %s && cd %s' % (rdir, rdir)
+		if tests:
+			rcmd += ' && rm -rf %s' % ' '.join([shlex.quote(t) for t in tests])
+		rcmd += ' && %s | tar xf -' % decomp
+		ssh = Popen(['ssh', '%s@%s' % (self.user, self.host), rcmd],
+			stdin=zip.stdout, stdout=DEVNULL)
+		zip.stdout.close()
+		try:
+			tar.stdin.write(b'\0'.join([f.encode() for f in files]))
+			tar.stdin.close()
+		except BrokenPipeError:
+			pass
+		res = [ssh.wait(), zip.wait(), tar.wait()]
+		return res == [0, 0, 0]
+	def writeremote(self, file, lines, append=True):
+		ssh = Popen(['ssh', '%s@%s' % (self.user, self.host),
+			'cat %s %s' % ('>>' if append else '>', file)], stdin=PIPE)
+		ssh.communicate(''.join(lines).encode())
+		return ssh.returncode == 0
+	def packfiles(self, rdir, files, zip, rtarball):
+		# tarball of just these files from the server's copy
+		ssh = Popen(['ssh', '%s@%s' % (self.user, self.host),
+			'cd %s && tar cf - --null -T - | %s > %s && echo PACKED' % \
+			(rdir, zip, rtarball)], stdin=PIPE, stdout=PIPE)
+		out = ssh.communicate(b'\0'.join([f.encode() for f in files]))[0]
+		return ssh.returncode == 0 and b'PACKED' in out
+	def batches(self, pdir, tests):
+		# groups of tests of about batchsize bytes each
+		out, batch, size = [], [], 0
+		for test in sorted(tests):
+			batch.append(test)
+			size += sum([os.path.getsize(os.path.join(pdir, f)) for f in tests[test]])
+			if size >= self.batchsize:
+				out.append(batch)
+				batch, size = [], 0
+		if len(batch) > 0:
+			out.append(batch)
+		return out
+	def streamfolder(self, folder):
+		tdir = os.path.basename(os.path.abspath(folder))
+		rdir = self.source(folder)
+		pdir, tests, others = self.findtests(folder)
+		print('Checking %d tests against the server...' % len(tests))
+		manifest, processed, tools = self.remoteinfo(rdir, tdir)
+		comp, decomp = self.compressor(tools)
+		sums, new = dict(), dict()
+		for test in tests:
+			sums[test] = self.checksum(pdir, tests[test])
+			if manifest.get(test) != sums[test]:
+				new[test] = tests[test]
+		# anything received by an upload that died before multitest
+		# finished goes again, along with the new tests
+		unprocessed = [t for t in sorted(tests) if processed.get(t) != sums[t]]
+		print('%d tests are new or changed, %d already on the server, '\
+			'%d to process' % (len(new), len(tests) - len(new), len(unprocessed)))
+		if len(unprocessed) < 1:
+			return ''
+		# the other files are small and always sent, with the first batch
+		batches = self.batches(pdir, new)
+		if len(batches) < 1:
+			batches = [[]]
+		for i in range(len(batches)):
+			files = list(others) if i == 0 else []
+			for test in batches[i]:
+				files += new[test]
+			print('Streaming batch %d of %d (%d tests) with %s...' % \
+				(i + 1, len(batches), len(batches[i]), comp[0]))
+			for attempt in range(3):
+				if self.streamfiles(pdir, files, batches[i], rdir, comp, decomp):
+					break
+				print('WARNING: stream failed, retrying...')
+			else:
+				print('ERROR: could not upload %s' % folder)
+				self.die()
+			lines = ['%s %s\n' % (sums[t], t) for t in batches[i]]
+			if lines and not self.writeremote('%s/%s.manifest' % (rdir, tdir), lines):
+				print('ERROR: could not update the server manifest')
+				self.die()
+		# the server keeps taking a tarball, built from its own copy of
+		# only the tests it hasn't processed, so nothing is done twice
+		rtarball = '/tmp/multitest-data-%s-%d.tar.gz' % \
+			(datetime.now().strftime('%y%m%d-%H%M%S'), os.getpid())
+		zip = 'pigz' if 'pigz' in tools else 'gzip'
+		files = list(others)
+		for test in unprocessed:
+			files += tests[test]
+		if not self.packfiles(rdir, files, zip, rtarball):
+			print('ERROR: could not package the data on the server')
+			self.die()
+		# they're marked processed once multitest or the queue has them
+		plist = rtarball + '.processed'
+		if not self.writeremote(plist, ['%s %s\n' % (sums[t], t) \
+			for t in unprocessed], False):
+			print('ERROR: could not update the server manifest')
 			self.die()
-		return tarball
+		self.mark = 'cat %s >> %s/%s.processed; rm -f %s' % (plist, rdir, tdir, plist)
+		return rtarball
 	def uploadfolder(self, folder, monitor):
 		if not os.path.exists(folder):
 			print('ERROR: %s does not exist' % folder)
 			self.die()
-		tarball = self.tarfolder(folder) if os.path.isdir(folder) else folder
-		print('Sending tarball to server...')
-		if not self.scpfile(tarball, '/tmp'):
-			print('ERROR: could not upload the tarball')
-			self.die()
-		rtarball = '/tmp/' + os.path.basename(tarball)
+		if os.path.isdir(folder):
+			rtarball = self.streamfolder(folder)
+			if not rtarball:
+				print('No new tests to process')
+				print('Upload Complete')
+				return
+		else:
+			print('Sending tarball to server...')
+			if not self.scpfile(folder, '/tmp'):
+				print('ERROR: could not upload the tarball')
+				self.die()
+			rtarball = '/tmp/' + os.path.basename(folder)
+		if self.watch:
+			self.submit(rtarball)
+			if self.mark:
+				self.sshcmd(self.mark, 60)
+			return
+		# the tests are marked processed if multitest succeeds, and the
+		# tarball in /tmp goes once multitest is done with it
+		rcmd = 'multitest %s; rc=$?' % rtarball
+		if self.mark:
+			rcmd += '; [ $rc -eq 0 ] && %s' % self.mark
+		rcmd += '; rm -f %s; exit $rc' % rtarball
 		if monitor:
 			print('Processing the data on the server...')
-			res = call('ssh %s@%s "multitest %s"' % \
-				(self.user, self.host, rtarball), shell=True)
+			res = call(['ssh', '%s@%s' % (self.user, self.host), rcmd])
 		else:
 			print('Notifying server of new data...')
 			logfile = self.logfile()
-			res = call('ssh -n -f %s@%s "multitest %s > %s 2>&1 &"' % \
-				(self.user, self.host, rtarball, logfile), shell=True)
+			res = call(['ssh', '-n', '-f', '%s@%s' % (self.user, self.host),
+				'(%s) > %s 2>&1 &' % (rcmd, logfile)])
 			print('Logging at %s' % logfile)
 			print('ssh %s@%s "tail -f %s"' % (self.user, self.host, logfile))
 		if res != 0:
 			print('ERROR: server processing failed')
 			self.die()
-		if os.path.isdir(folder):
-			os.remove(tarball)
 		print('Upload Complete')
+	def submit(self, rtarball):
+		# hidden until it's all in the folder, then renamed so the daemon
+		# only ever sees a finished tarball
+		name = os.path.basename(rtarball)
+		out = self.sshcmd('mv %s %s/.%s && mv %s/.%s %s/%s && echo SUBMITTED' % \
+			(rtarball, self.watch, name, self.watch, name, self.watch, name), 600)
+		if 'SUBMITTED' not in out:
+			print('ERROR: could not submit %s to %s' % (name, self.watch))
+			self.die()
+		print('Submitted %s to the server queue' % name)
 	def openshell(self):
 		call('ssh -X %s@%s' % (self.user, self.host), shell=True)
 	def hasbandwidth(self):
+		if self.watch:
+			out = self.sshcmd('cat %s/.ingest-status 2>/dev/null' % self.watch)
+			try:
+				info = json.loads(out)
+			except:
+				return True
+			return not info.get('full', False)
 		out = self.sshcmd('ps aux')
 		count = 0
 		for line in out.split('\n'):
@@ -117,6 +324,8 @@ if __name__ == '__main__':
 		 help='setup password-less access by copying ssh keys')
 	parser.add_argument('-monitor', action='store_true',
 		 help='Monitor server processing and wait for completion')
+	parser.add_argument('-watch', metavar='folder', default='',
+		 help='server intake folder watched by stressreport -daemon')
 	parser.add_argument('folder',  nargs='?',
 		help='multitest folder, or "shell" to open an ssh shell')
 	args = parser.parse_args()
@@ -127,7 +336,7 @@ if __name__ == '__main__':
 		print('ERROR: %s is not a valid file or folder' % args.folder)
 		sys.exit(1)
 
-	ds = DataServer('sleepgraph', 'otcpl-stress.ostc.intel.com')
+	ds = DataServer('sleepgraph', 'otcpl-stress.ostc.intel.com', args.watch)
 
 	if args.sshkeysetup:
 		ds.setupordie()
@@ -6,8 +6,8 @@ WEBDIR="$HOME/pm-graph-test"
 SORTDIR="$HOME/pm-graph-sort"
 MS="$HOME/.machswap"
 GS="python3 $HOME/workspace/pm-graph/stressreport.py"
-CACHE="$HOME/.multitests"
-DATACACHE="$HOME/.multitestdata"
+TI="python3 $HOME/workspace/pm-graph/lib/testindex.py"
+DC="python3 $HOME/workspace/pm-graph/lib/datacache.py"
 
 printUsage() {
 	echo "USAGE: intel-updatecache command"
@@ -23,8 +23,8 @@ if [ $# -gt 2 -o $# -lt 1 ]; then printUsage; fi
 if [ $1 = "help" ]; then
 	printUsage
 elif [ $1 = "showmissing" ]; then
-	cat $DATACACHE | sed "s/|.*//g" | sort > /tmp/check2.txt
-	cat $CACHE | sort > /tmp/check1.txt
+	$DC -export | sed "s/|.*//g" | sort > /tmp/check2.txt
+	$TI -list | sort > /tmp/check1.txt
 	diff /tmp/check1.txt /tmp/check2.txt | grep / | sed -e "s/< //g" > /tmp/check3.txt
 	for p in `cat /tmp/check3.txt`
 	do
@@ -5,8 +5,9 @@ import string
 import os
 import argparse
 from subprocess import call, Popen, PIPE
+from lib.datacache import opencache, defaultpaths
 
-DATACACHE="~/.multitestdata"
+DATACACHE, DATACACHETXT = defaultpaths()
 TESTCACHE="~/.multitests"
 ansi = False
 
@@ -14,10 +15,9 @@ def sanityCheck():
 	global DATACACHE, TESTCACHE, ansi
 
 	if 'HOME' in os.environ:
-		DATACACHE = DATACACHE.replace('~', os.environ['HOME'])
 		TESTCACHE = TESTCACHE.replace('~', os.environ['HOME'])
 
-	if not os.path.exists(DATACACHE):
+	if not os.path.exists(DATACACHE) and not os.path.exists(DATACACHETXT):
 		print('ERROR: %s does not exist' % DATACACHE)
 		sys.exit(1)
 
@@ -46,19 +46,19 @@ if __name__ == '__main__':
 	print('Compare performance between [%s] and [%s]' %\
 		(args.kernel1, args.kernel2))
 	data = dict()
-	fp = open(DATACACHE, 'r')
-	for line in fp:
-		vals = line.strip().split('|')
-		kernel = vals[3]
-		if kernel != args.kernel1 and kernel != args.kernel2:
-			continue
+	cache = opencache(DATACACHE)
+	if not cache:
+		print('ERROR: %s is not accessible' % DATACACHE)
+		sys.exit(1)
+	for row in cache.kernels([args.kernel1, args.kernel2]):
+		kernel = row['kernel']
 		try:
-			smed = float(vals[12])
-			rmed = float(vals[15])
+			smed = float(row['smed'])
+			rmed = float(row['rmed'])
 		except:
 			continue
-		mode = vals[4]
-		host = vals[5]
+		mode = row['fullmode']
+		host = row['host']
 		if host not in data:
 			data[host] = dict()
 		if mode not in data[host]:
@@ -67,6 +67,7 @@ if __name__ == '__main__':
 			data[host][mode][kernel] = {'smed': -1, 'rmed': -1}
 		data[host][mode][kernel]['smed'] = smed
 		data[host][mode][kernel]['rmed'] = rmed
+	cache.close()
 
 	fullout = ''
 	for host in sorted(data):